@@ -1,157 +1,356 @@
 import numpy as np
 from scipy.special import softmax, logsumexp
 import itertools
+import json
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from episodes import EpisodeStore
+from metrics import NULL_METRICS
+
+
+def to_cdf(prob_matrix):
+    # Cumulative sums over the last (outcome) axis, last column pinned to 1
+    cdf = np.cumsum(prob_matrix, axis=-1)
+    cdf[..., -1] = 1.0
+    return cdf
+
+
+def sample_categorical(cdf, rng=None):
+    # Inverse-CDF sampling, one draw per row of a (..., K) cdf array
+    rng = np.random if rng is None else rng
+    uniform_samples = rng.random(cdf.shape[:-1])
+    sampled_ids = (uniform_samples[..., None] >= cdf).sum(axis=-1)
+    return np.minimum(sampled_ids, cdf.shape[-1]-1)
+
+
+def build_guide(cdf):
+    """
+    Guide table of every row of a (R, V) cdf for indexed search : guide[row, j] counts the
+    entries whose cdf falls in a cell before [j/V, (j+1)/V), so the inverse-CDF draw of a
+    uniform in cell j is at or after guide[row, j], on average within a couple of entries.
+    """
+    num_rows, vocab_size = cdf.shape
+    cells = np.minimum(np.floor(cdf * vocab_size).astype(np.int64), vocab_size)
+    counts = np.bincount(
+        (np.arange(num_rows)[:, None]*(vocab_size+1) + cells).ravel(), minlength=num_rows*(vocab_size+1)
+    ).reshape(num_rows, vocab_size+1)
+    guide = np.zeros((num_rows, vocab_size), dtype=np.int64)
+    guide[:, 1:] = np.cumsum(counts, axis=-1)[:, :vocab_size-1]
+    return guide
+
+
+class CategoricalTable(object):
+    """
+    Sampler of a (..., V) table of conditional distributions, one uniform per draw, with the
+    same draws as sample_categorical over the gathered cdf rows. Vocabularies up to
+    max_cdf_vocab compare against the whole row (O(V) per draw), larger ones start the
+    search from a guide table (O(1) expected per draw), so sampling N rows stays O(N) for
+    any vocabulary size.
+    """
+    def __init__(self, prob_matrix, max_cdf_vocab=16):
+        self.shape = prob_matrix.shape[:-1]
+        self.vocab_size = prob_matrix.shape[-1]
+        self.cdf = to_cdf(prob_matrix)
+        self.guide = None
+        if self.vocab_size > max_cdf_vocab:
+            self.guide = build_guide(self.cdf.reshape(-1, self.vocab_size)).ravel()
+            self.flat_cdf = self.cdf.ravel()
+
+    def sample(self, index=(), rng=None, size=None):
+        # One draw per row selected by the tuple of id arrays index, size draws of an unconditional table
+        rng = np.random if rng is None else rng
+        if self.guide is None:
+            cdf = self.cdf[index] if size is None else np.broadcast_to(self.cdf, (size, self.vocab_size))
+            return sample_categorical(cdf, rng)
+
+        if size is None:
+            rows = np.ravel_multi_index(np.broadcast_arrays(*index), self.shape)
+        else:
+            rows = np.zeros(size, dtype=np.int64)
+        uniform_samples = rng.random(rows.shape)
+        cells = np.minimum((uniform_samples * self.vocab_size).astype(np.int64), self.vocab_size-1)
+        flat_ids = rows*self.vocab_size + self.guide[rows*self.vocab_size + cells]
+        # Step forward past every cdf entry <= u, the last entry is pinned to 1
+        active = np.flatnonzero(self.flat_cdf[flat_ids] <= uniform_samples)
+        while active.shape[0] > 0:
+            flat_ids[active] += 1
+            active = active[self.flat_cdf[flat_ids[active]] <= uniform_samples[active]]
+        return flat_ids - rows*self.vocab_size
+
+
+def read_spec_file(path):
+    # Generator spec from a JSON file, or a YAML file when PyYAML is installed
+    with open(path) as spec_file:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("Reading YAML specs needs PyYAML (pip install pyyaml), or use a JSON spec")
+            return yaml.safe_load(spec_file)
+        return json.load(spec_file)
+
+
+def to_json_value(value):
+    if isinstance(value, dict):
+        return {key: to_json_value(val) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_value(val) for val in value]
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    return value
+
+
+# Generator instance shared by the blocks a worker process generates
+_worker_generator = None
+
+
+def _init_generation_worker(generator):
+    global _worker_generator
+    _worker_generator = generator
+
+
+def _generate_block_in_worker(block_id, num_data, interaction_length, seed):
+    return block_id, _worker_generator.generate_block(block_id, num_data, interaction_length, seed)
+
+
+def default_spec():
+    # The hand written study design, in the format of MarkovDataGenerator.table_spec()
+    type_vals = ["1", "2", "3"]
+    trust_vals = ["T", "N", "D"]
+
+    # New outcome vals
+    # self.acceptance_vals = ["A", "R", "N"]
+    ai_advice_vals = ["X", "Y", "W"]
+    human_answer_values = ["X", "Y"]
+    case_data_vals = [
+        "T1", "T2", "T3", "T4", "T5", "T6", "T7", "T8", "T9", "T10", "T11", "T12", "T13", "T14", "T15"
+    ]
+    outcome_vals = ["G", "B"]
+
+    # Init probs for latent vars
+    type_probs = {"1": 0.5, "2":0.3, "3": 0.2}
+
+    # Initial attitude to AI
+    init_trust_prior = {"1":{"T":0.8, "N": 0.1, "D":0.1}, "2":{"T":0.2, "N": 0.6, "D":0.2}, "3":{"T":0.1, "N": 0.2, "D":0.7}}
+    
+    # T2, T5, T10 AI agent is mostly wrong
+    # t4 AI agent mostly witholds but is still right if advises
+    # t11 AI agent mostly witholds but is wrong if advises
+    # Rest of it mostly right
+    # This could be changed for different data generation process
+
+    ai_advice_probs = {
+        "T1": {"X": 0.8, "Y": 0.1, "W": 0.1},
+        "T2": {"X": 0.1, "Y": 0.8, "W": 0.1},
+        "T3": {"X": 0.1, "Y": 0.8, "W": 0.1},
+        "T4": {"X": 0.0, "Y": 0.1, "W": 0.9},
+        "T5": {"X": 0.8, "Y": 0.1, "W": 0.1},
+        "T6": {"X": 0.1, "Y": 0.8, "W": 0.1},
+        "T7": {"X": 0.8, "Y": 0.1, "W": 0.1},
+        "T8": {"X": 0.8, "Y": 0.1, "W": 0.1},
+        "T9": {"X": 0.1, "Y": 0.8, "W": 0.1},
+        "T10": {"X": 0.8, "Y": 0.1, "W": 0.1},
+        "T11": {"X": 0.0, "Y": 0.2, "W": 0.8},
+        "T12": {"X": 0.1, "Y": 0.8, "W": 0.1},
+        "T13": {"X": 0.8, "Y": 0.1, "W": 0.1},
+        "T14": {"X": 0.8, "Y": 0.1, "W": 0.1},
+        "T15": {"X": 0.1, "Y": 0.8, "W": 0.1},
+    }
+
+    # 
+    outcome_probs={
+        "T1": {"X": {"G": 1.0, "B": 0.0}, "Y": {"G": 0.0, "B": 1.0}},
+        "T2": {"X": {"G": 1.0, "B": 0.0}, "Y": {"G": 0.0, "B": 1.0}},
+        "T3": {"X": {"G": 0.0, "B": 1.0}, "Y": {"G": 1.0, "B": 0.0}},
+        "T4": {"X": {"G": 0.0, "B": 1.0}, "Y": {"G": 1.0, "B": 0.0}},
+        "T5": {"X": {"G": 0.0, "B": 1.0}, "Y": {"G": 1.0, "B": 0.0}},
+        "T6": {"X": {"G": 0.0, "B": 1.0}, "Y": {"G": 1.0, "B": 0.0}},
+        "T7": {"X": {"G": 1.0, "B": 0.0}, "Y": {"G": 0.0, "B": 1.0}},
+        "T8": {"X": {"G": 1.0, "B": 0.0}, "Y": {"G": 0.0, "B": 1.0}},
+        "T9": {"X": {"G": 0.0, "B": 1.0}, "Y": {"G": 1.0, "B": 0.0}},
+        "T10": {"X": {"G": 0.0, "B": 1.0}, "Y": {"G": 1.0, "B": 0.0}},
+        "T11": {"X": {"G": 1.0, "B": 0.0}, "Y": {"G": 0.0, "B": 1.0}},
+        "T12": {"X": {"G": 0.0, "B": 1.0}, "Y": {"G": 1.0, "B": 0.0}},
+        "T13": {"X": {"G": 1.0, "B": 0.0}, "Y": {"G": 0.0, "B": 1.0}},
+        "T14": {"X": {"G": 1.0, "B": 0.0}, "Y": {"G": 0.0, "B": 1.0}},
+        "T15": {"X": {"G": 0.0, "B": 1.0}, "Y": {"G": 1.0, "B": 0.0}},
+    }
+
+    acceptance_probs = {
+        # Agent 1 expert at T7-T15
+        # Otherwise will accept advice from AI if its trustful enough
+        "1":{
+            "T1": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
+            "T2": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
+            "T3": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
+            "T4": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.6, "Y":0.4}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.6, "Y":0.4},}},
+            "T5": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
+            "T6": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.6, "Y":0.4}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.6, "Y":0.4},}},
+            "T7": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "Y":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "W":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}},
+            "T8": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "Y":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "W":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}},
+            "T9": {"X":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "W":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}},
+            "T10": {"X":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "W":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}},
+            "T11": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "Y":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "W":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}},
+            "T12": {"X":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "W":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}},
+            "T13": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "Y":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "W":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}},
+            "T14": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "Y":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "W":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}},
+            "T15": {"X":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "W":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}},
+        },
+        # Agent 2 expert at T1-8
+        # Otherwise will accept advice from AI if its trustful enough
+        "2":{
+            "T1": {"X":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "Y":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "W":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}},
+            "T2": {"X":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "Y":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "W":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}},
+            "T3": {"X":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "Y":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "W":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}},
+            "T4": {"X":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "Y":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "W":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}},
+            "T5": {"X":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "Y":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "W":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}},
+            "T6": {"X":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "Y":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "W":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}},
+            "T7": {"X":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "Y":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "W":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}},
+            "T8": {"X":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "Y":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "W":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}},
+            "T9": {"X":{"T":{"X":0.7, "Y": 0.3}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.3, "Y": 0.7},}, "Y":{"T":{"X":0.3, "Y": 0.7}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.7, "Y": 0.3},}, "W":{"T":{"X":0.55, "Y": 0.45}, "N":{"X":0.55, "Y": 0.45}, "D":{"X":0.55, "Y": 0.45},}},
+            "T10": {"X":{"T":{"X":0.7, "Y": 0.3}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.3, "Y": 0.7},}, "Y":{"T":{"X":0.3, "Y": 0.7}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.7, "Y": 0.3},}, "W":{"T":{"X":0.45, "Y": 0.55}, "N":{"X":0.45, "Y": 0.55}, "D":{"X":0.45, "Y": 0.55},}},
+            "T11": {"X":{"T":{"X":0.7, "Y": 0.3}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.3, "Y": 0.7},}, "Y":{"T":{"X":0.3, "Y": 0.7}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.7, "Y": 0.3},}, "W":{"T":{"X":0.55, "Y": 0.45}, "N":{"X":0.55, "Y": 0.45}, "D":{"X":0.55, "Y": 0.45},}},
+            "T12": {"X":{"T":{"X":0.7, "Y": 0.3}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.3, "Y": 0.7},}, "Y":{"T":{"X":0.3, "Y": 0.7}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.7, "Y": 0.3},}, "W":{"T":{"X":0.55, "Y": 0.45}, "N":{"X":0.55, "Y": 0.45}, "D":{"X":0.55, "Y": 0.45},}},
+            "T13": {"X":{"T":{"X":0.7, "Y": 0.3}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.3, "Y": 0.7},}, "Y":{"T":{"X":0.3, "Y": 0.7}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.7, "Y": 0.3},}, "W":{"T":{"X":0.45, "Y": 0.55}, "N":{"X":0.45, "Y": 0.55}, "D":{"X":0.45, "Y": 0.55},}},
+            "T14": {"X":{"T":{"X":0.7, "Y": 0.3}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.3, "Y": 0.7},}, "Y":{"T":{"X":0.3, "Y": 0.7}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.7, "Y": 0.3},}, "W":{"T":{"X":0.45, "Y": 0.55}, "N":{"X":0.45, "Y": 0.55}, "D":{"X":0.45, "Y": 0.55},}},
+            "T15": {"X":{"T":{"X":0.7, "Y": 0.3}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.3, "Y": 0.7},}, "Y":{"T":{"X":0.3, "Y": 0.7}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.7, "Y": 0.3},}, "W":{"T":{"X":0.55, "Y": 0.45}, "N":{"X":0.55, "Y": 0.45}, "D":{"X":0.55, "Y": 0.45},}},
+        },
+        # Agent 3 expert at T1-3 AND T12-15
+        # Otherwise will accept advice from AI if its trustful enough
+        "3":{
+            "T1": {"X":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "Y":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "W":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}},
+            "T2": {"X":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "Y":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "W":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}},
+            "T3": {"X":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "Y":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "W":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}},
+            "T4": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
+            "T5": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.6, "Y":0.4}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.6, "Y":0.4},}},
+            "T6": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
+            "T7": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
+            "T8": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.6, "Y":0.4}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.6, "Y":0.4},}},
+            "T9": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.6, "Y":0.4}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.6, "Y":0.4},}},
+            "T10": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
+            "T11": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
+            "T12": {"X":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "W":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}},
+            "T13": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "Y":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "W":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}},
+            "T14": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "Y":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "W":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}},
+            "T15": {"X":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "W":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}},
+        },
+    }
+
+    # Trust dynamics (see per_type_trust_update). After a case the trust level moves one step
+    # towards "T" or "D" with the per type and per case rate below. Users move slower on
+    # the cases they are expert at.
+    trust_update_rates = {
+        "1": {"T1": 0.6, "T2": 0.6, "T3": 0.6, "T4": 0.6, "T5": 0.6, "T6": 0.6, "T7": 0.4, "T8": 0.4, "T9": 0.4, "T10": 0.4, "T11": 0.4, "T12": 0.4, "T13": 0.4, "T14": 0.4, "T15": 0.4},
+        "2": {"T1": 0.3, "T2": 0.3, "T3": 0.3, "T4": 0.3, "T5": 0.3, "T6": 0.3, "T7": 0.3, "T8": 0.3, "T9": 0.7, "T10": 0.7, "T11": 0.7, "T12": 0.7, "T13": 0.7, "T14": 0.7, "T15": 0.7},
+        "3": {"T1": 0.3, "T2": 0.3, "T3": 0.3, "T4": 0.7, "T5": 0.7, "T6": 0.7, "T7": 0.7, "T8": 0.7, "T9": 0.7, "T10": 0.7, "T11": 0.7, "T12": 0.3, "T13": 0.3, "T14": 0.3, "T15": 0.3},
+    }
+
+    # Cases where the user judges the advice by agreement alone and ignores the outcome
+    outcome_blind_cases = {
+        "1": [],
+        "2": [],
+        "3": ["T1", "T2", "T3", "T12", "T13", "T14", "T15"],
+    }
+
+    return {
+        "type_vals": type_vals,
+        "trust_vals": trust_vals,
+        "ai_advice_vals": ai_advice_vals,
+        "human_answer_values": human_answer_values,
+        "case_data_vals": case_data_vals,
+        "outcome_vals": outcome_vals,
+        "num_case_features": 2,
+        "type_probs": type_probs,
+        "init_trust_prior": init_trust_prior,
+        "ai_advice_probs": ai_advice_probs,
+        "outcome_probs": outcome_probs,
+        "acceptance_probs": acceptance_probs,
+        "trust_update_rates": trust_update_rates,
+        "outcome_blind_cases": outcome_blind_cases,
+    }
+
 
 class MarkovDataGenerator(object):
-    def __init__(self) -> None:
+    def __init__(self, spec=None, verify_tables=False, metrics=None) -> None:
         super(MarkovDataGenerator, self).__init__()
-        self.num_case_features = 2
-        self.type_vals = ["1", "2", "3"]
-        self.trust_vals = ["T", "N", "D"]
-
-        # New outcome vals
-        # self.acceptance_vals = ["A", "R", "N"]
-        self.ai_advice_vals = ["X", "Y", "W"]
-        self.human_answer_values = ["X", "Y"]
-        self.case_data_vals = [
-            "T1", "T2", "T3", "T4", "T5", "T6", "T7", "T8", "T9", "T10", "T11", "T12", "T13", "T14", "T15"
-        ]
-        self.outcome_vals = ["G", "B"]
-
-        self.type_vals_mapping = {}
-        for idx, out in enumerate(self.type_vals):
-            self.type_vals_mapping[out] = idx
-
-        self.trust_vals_mapping = {}
-        for idx, out in enumerate(self.trust_vals):
-            self.trust_vals_mapping[out] = idx
-
-        self.human_ans_vals_mapping = {}
-        for idx, out in enumerate(self.human_answer_values):
-            self.human_ans_vals_mapping[out] = idx
-
-        self.ai_advice_vals_mapping = {}
-        for idx, out in enumerate(self.ai_advice_vals):
-            self.ai_advice_vals_mapping[out] = idx
-
-        self.case_data_vals_mapping = {}
-        for idx, out in enumerate(self.case_data_vals):
-            self.case_data_vals_mapping[out] = idx
-
-        self.outcome_vals_mapping = {}
-        for idx, out in enumerate(self.outcome_vals):
-            self.outcome_vals_mapping[out] = idx
-
-        # Init probs for latent vars
-        self.type_probs = {"1": 0.5, "2":0.3, "3": 0.2}
-
-        # Initial attitude to AI
-        self.init_trust_prior = {"1":{"T":0.8, "N": 0.1, "D":0.1}, "2":{"T":0.2, "N": 0.6, "D":0.2}, "3":{"T":0.1, "N": 0.2, "D":0.7}}
-        
-        # T2, T5, T10 AI agent is mostly wrong
-        # t4 AI agent mostly witholds but is still right if advises
-        # t11 AI agent mostly witholds but is wrong if advises
-        # Rest of it mostly right
-        # This could be changed for different data generation process
-
-        self.ai_advice_probs = {
-            "T1": {"X": 0.8, "Y": 0.1, "W": 0.1},
-            "T2": {"X": 0.1, "Y": 0.8, "W": 0.1},
-            "T3": {"X": 0.1, "Y": 0.8, "W": 0.1},
-            "T4": {"X": 0.0, "Y": 0.1, "W": 0.9},
-            "T5": {"X": 0.8, "Y": 0.1, "W": 0.1},
-            "T6": {"X": 0.1, "Y": 0.8, "W": 0.1},
-            "T7": {"X": 0.8, "Y": 0.1, "W": 0.1},
-            "T8": {"X": 0.8, "Y": 0.1, "W": 0.1},
-            "T9": {"X": 0.1, "Y": 0.8, "W": 0.1},
-            "T10": {"X": 0.8, "Y": 0.1, "W": 0.1},
-            "T11": {"X": 0.0, "Y": 0.2, "W": 0.8},
-            "T12": {"X": 0.1, "Y": 0.8, "W": 0.1},
-            "T13": {"X": 0.8, "Y": 0.1, "W": 0.1},
-            "T14": {"X": 0.8, "Y": 0.1, "W": 0.1},
-            "T15": {"X": 0.1, "Y": 0.8, "W": 0.1},
-        }
+        # Sampling phase timings and episode counts go to metrics (see metrics.Metrics)
+        self.metrics = NULL_METRICS if metrics is None else metrics
 
-        # 
-        self.outcome_probs={
-            "T1": {"X": {"G": 1.0, "B": 0.0}, "Y": {"G": 0.0, "B": 1.0}},
-            "T2": {"X": {"G": 1.0, "B": 0.0}, "Y": {"G": 0.0, "B": 1.0}},
-            "T3": {"X": {"G": 0.0, "B": 1.0}, "Y": {"G": 1.0, "B": 0.0}},
-            "T4": {"X": {"G": 0.0, "B": 1.0}, "Y": {"G": 1.0, "B": 0.0}},
-            "T5": {"X": {"G": 0.0, "B": 1.0}, "Y": {"G": 1.0, "B": 0.0}},
-            "T6": {"X": {"G": 0.0, "B": 1.0}, "Y": {"G": 1.0, "B": 0.0}},
-            "T7": {"X": {"G": 1.0, "B": 0.0}, "Y": {"G": 0.0, "B": 1.0}},
-            "T8": {"X": {"G": 1.0, "B": 0.0}, "Y": {"G": 0.0, "B": 1.0}},
-            "T9": {"X": {"G": 0.0, "B": 1.0}, "Y": {"G": 1.0, "B": 0.0}},
-            "T10": {"X": {"G": 0.0, "B": 1.0}, "Y": {"G": 1.0, "B": 0.0}},
-            "T11": {"X": {"G": 1.0, "B": 0.0}, "Y": {"G": 0.0, "B": 1.0}},
-            "T12": {"X": {"G": 0.0, "B": 1.0}, "Y": {"G": 1.0, "B": 0.0}},
-            "T13": {"X": {"G": 1.0, "B": 0.0}, "Y": {"G": 0.0, "B": 1.0}},
-            "T14": {"X": {"G": 1.0, "B": 0.0}, "Y": {"G": 0.0, "B": 1.0}},
-            "T15": {"X": {"G": 0.0, "B": 1.0}, "Y": {"G": 1.0, "B": 0.0}},
-        }
+        # Seeded generation works on fixed blocks of episodes, each with its own random stream,
+        # so the data only depends on the seed and not on how blocks are batched together
+        self.seed_block_size = 4096
+        # spec : a table_spec() style dict or the path of a JSON / YAML spec file, the
+        # hand written 15 case study design (default_spec()) by default
+        self.set_spec(default_spec() if spec is None else spec)
 
-        self.acceptance_probs = {
-            # Agent 1 expert at T7-T15
-            # Otherwise will accept advice from AI if its trustful enough
-            "1":{
-                "T1": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
-                "T2": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
-                "T3": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
-                "T4": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.6, "Y":0.4}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.6, "Y":0.4},}},
-                "T5": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
-                "T6": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.6, "Y":0.4}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.6, "Y":0.4},}},
-                "T7": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "Y":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "W":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}},
-                "T8": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "Y":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "W":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}},
-                "T9": {"X":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "W":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}},
-                "T10": {"X":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "W":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}},
-                "T11": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "Y":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "W":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}},
-                "T12": {"X":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "W":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}},
-                "T13": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "Y":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "W":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}},
-                "T14": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "Y":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "W":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}},
-                "T15": {"X":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "W":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}},
-            },
-            # Agent 2 expert at T1-8
-            # Otherwise will accept advice from AI if its trustful enough
-            "2":{
-                "T1": {"X":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "Y":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "W":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}},
-                "T2": {"X":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "Y":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "W":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}},
-                "T3": {"X":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "Y":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "W":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}},
-                "T4": {"X":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "Y":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "W":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}},
-                "T5": {"X":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "Y":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "W":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}},
-                "T6": {"X":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "Y":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "W":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}},
-                "T7": {"X":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "Y":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "W":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}},
-                "T8": {"X":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "Y":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "W":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}},
-                "T9": {"X":{"T":{"X":0.7, "Y": 0.3}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.3, "Y": 0.7},}, "Y":{"T":{"X":0.3, "Y": 0.7}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.7, "Y": 0.3},}, "W":{"T":{"X":0.55, "Y": 0.45}, "N":{"X":0.55, "Y": 0.45}, "D":{"X":0.55, "Y": 0.45},}},
-                "T10": {"X":{"T":{"X":0.7, "Y": 0.3}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.3, "Y": 0.7},}, "Y":{"T":{"X":0.3, "Y": 0.7}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.7, "Y": 0.3},}, "W":{"T":{"X":0.45, "Y": 0.55}, "N":{"X":0.45, "Y": 0.55}, "D":{"X":0.45, "Y": 0.55},}},
-                "T11": {"X":{"T":{"X":0.7, "Y": 0.3}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.3, "Y": 0.7},}, "Y":{"T":{"X":0.3, "Y": 0.7}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.7, "Y": 0.3},}, "W":{"T":{"X":0.55, "Y": 0.45}, "N":{"X":0.55, "Y": 0.45}, "D":{"X":0.55, "Y": 0.45},}},
-                "T12": {"X":{"T":{"X":0.7, "Y": 0.3}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.3, "Y": 0.7},}, "Y":{"T":{"X":0.3, "Y": 0.7}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.7, "Y": 0.3},}, "W":{"T":{"X":0.55, "Y": 0.45}, "N":{"X":0.55, "Y": 0.45}, "D":{"X":0.55, "Y": 0.45},}},
-                "T13": {"X":{"T":{"X":0.7, "Y": 0.3}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.3, "Y": 0.7},}, "Y":{"T":{"X":0.3, "Y": 0.7}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.7, "Y": 0.3},}, "W":{"T":{"X":0.45, "Y": 0.55}, "N":{"X":0.45, "Y": 0.55}, "D":{"X":0.45, "Y": 0.55},}},
-                "T14": {"X":{"T":{"X":0.7, "Y": 0.3}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.3, "Y": 0.7},}, "Y":{"T":{"X":0.3, "Y": 0.7}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.7, "Y": 0.3},}, "W":{"T":{"X":0.45, "Y": 0.55}, "N":{"X":0.45, "Y": 0.55}, "D":{"X":0.45, "Y": 0.55},}},
-                "T15": {"X":{"T":{"X":0.7, "Y": 0.3}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.3, "Y": 0.7},}, "Y":{"T":{"X":0.3, "Y": 0.7}, "N":{"X":0.5, "Y": 0.5}, "D":{"X":0.7, "Y": 0.3},}, "W":{"T":{"X":0.55, "Y": 0.45}, "N":{"X":0.55, "Y": 0.45}, "D":{"X":0.55, "Y": 0.45},}},
-            },
-            # Agent 3 expert at T1-3 AND T12-15
-            # Otherwise will accept advice from AI if its trustful enough
-            "3":{
-                "T1": {"X":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "Y":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "W":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}},
-                "T2": {"X":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "Y":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}, "W":{"T":{"X":0.8, "Y": 0.2}, "N":{"X":0.8, "Y": 0.2}, "D":{"X":0.8, "Y": 0.2},}},
-                "T3": {"X":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "Y":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}, "W":{"T":{"X":0.2, "Y": 0.8}, "N":{"X":0.2, "Y": 0.8}, "D":{"X":0.2, "Y": 0.8},}},
-                "T4": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
-                "T5": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.6, "Y":0.4}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.6, "Y":0.4},}},
-                "T6": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
-                "T7": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
-                "T8": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.6, "Y":0.4}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.6, "Y":0.4},}},
-                "T9": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.6, "Y":0.4}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.6, "Y":0.4},}},
-                "T10": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
-                "T11": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.6, "Y":0.4}, "D":{"X":0.3, "Y":0.7},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.7, "Y":0.3},}, "W":{"T":{"X":0.4, "Y":0.6}, "N":{"X":0.4, "Y":0.6}, "D":{"X":0.4, "Y":0.6},}},
-                "T12": {"X":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "W":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}},
-                "T13": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "Y":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "W":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}},
-                "T14": {"X":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "Y":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}, "W":{"T":{"X":0.9, "Y":0.1}, "N":{"X":0.9, "Y":0.1}, "D":{"X":0.9, "Y":0.1},}},
-                "T15": {"X":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "Y":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}, "W":{"T":{"X":0.1, "Y":0.9}, "N":{"X":0.1, "Y":0.9}, "D":{"X":0.1, "Y":0.9},}},
-            },
-        }
+        # Relation between the AI advice and the human decision used by the trust update
+        self.advice_relation_vals = ["agree", "disagree", "withheld"]
+        # Trust moves after a step, see compile_trust_moves
+        self.trust_move_vals = ["stay", "up", "down", "hard_down"]
+
+        self.compile_tables()
+        if verify_tables:
+            mismatches = self.verify_trust_transitions()
+            if len(mismatches) != 0:
+                raise ValueError("Trust transition table disagrees with per_type_trust_update : " + str(mismatches[:10]))
 
-    def per_type_trust_update(self, type, ques, prev_trust, rec, ans, out):
+    def set_spec(self, spec):
+        """
+        Vocabularies and tables of the generator from a spec in the table_spec() format.
+        Tables are nested dicts keyed by vocabulary values, nested lists / arrays in vocabulary
+        order, or a mix of both (e.g. a dict over types holding arrays). Arrays are broadcast to
+        the table shape, so a (K, 1, A, S, D) acceptance table is shared by every case.
+        Optional entries :
+            case_schedule : "cycle" (default, step t shows case t mod C), or a dict
+                {"kind": "cycle", "order": [case, ...], "random_start": bool}, every episode
+                cycling through order from step 0 or a random position,
+                {"kind": "random", "probs": table over cases, uniform by default}, an i.i.d.
+                case per step and episode
+            case_feature_offsets : offset of the continuous features of every case
+            good_outcome : rewarded outcome, "G" by default
+            withheld_advice : advice value meaning no advice, "W" by default
+            termination : {"stop_probs": table over (types, trust), "min_length": 1}, episodes
+                of at least min_length steps end after a step with probability
+                stop_probs[type, trust at that step], all episodes run for the full
+                interaction_length without it
+        """
+        if isinstance(spec, str):
+            spec = read_spec_file(spec)
+        self.spec = spec
+
+        self.num_case_features = spec["num_case_features"]
+        self.type_vals = list(spec["type_vals"])
+        self.trust_vals = list(spec["trust_vals"])
+        self.ai_advice_vals = list(spec["ai_advice_vals"])
+        self.human_answer_values = list(spec["human_answer_values"])
+        self.case_data_vals = list(spec["case_data_vals"])
+        self.outcome_vals = list(spec["outcome_vals"])
+
+        self.type_vals_mapping = {out: idx for idx, out in enumerate(self.type_vals)}
+        self.trust_vals_mapping = {out: idx for idx, out in enumerate(self.trust_vals)}
+        self.human_ans_vals_mapping = {out: idx for idx, out in enumerate(self.human_answer_values)}
+        self.ai_advice_vals_mapping = {out: idx for idx, out in enumerate(self.ai_advice_vals)}
+        self.case_data_vals_mapping = {out: idx for idx, out in enumerate(self.case_data_vals)}
+        self.outcome_vals_mapping = {out: idx for idx, out in enumerate(self.outcome_vals)}
+
+        self.type_probs = spec["type_probs"]
+        self.init_trust_prior = spec["init_trust_prior"]
+        self.ai_advice_probs = spec["ai_advice_probs"]
+        self.outcome_probs = spec["outcome_probs"]
+        self.acceptance_probs = spec["acceptance_probs"]
+        self.trust_update_rates = spec["trust_update_rates"]
+        self.outcome_blind_cases = spec["outcome_blind_cases"]
+
+        self.case_schedule = spec.get("case_schedule", "cycle")
+        if isinstance(self.case_schedule, str):
+            self.case_schedule = {"kind": self.case_schedule}
+        if self.case_schedule["kind"] not in ("cycle", "random"):
+            raise ValueError("Unknown case schedule : " + str(self.case_schedule["kind"]))
+        self.case_feature_offsets = spec.get("case_feature_offsets")
+        self.good_outcome = spec.get("good_outcome", "G")
+        self.withheld_advice = spec.get("withheld_advice", "W")
+        self.termination = spec.get("termination")
+
+    def per_type_trust_update(self, type, ques, prev_trust, rec, ans, out, choice=np.random.choice):
             if type == "1":
                 if ques in ["T7", "T8", "T9", "T10", "T11", "T12", "T13", "T14", "T15"]:
                     if rec == ans:
@@ -159,16 +358,16 @@ class MarkovDataGenerator(object):
                             if prev_trust == "T":
                                 return "T"
                             elif prev_trust == "N":
-                                return np.random.choice(["T", "N"], size=1, p=[0.4, 0.6])[0]
+                                return choice(["T", "N"], size=1, p=[0.4, 0.6])[0]
                             else:
-                                return np.random.choice(["N", "D"], size=1, p=[0.4, 0.6])[0]
+                                return choice(["N", "D"], size=1, p=[0.4, 0.6])[0]
                         else:
                             if prev_trust == "D":
                                 return "D"
                             elif prev_trust == "N":
-                                return np.random.choice(["D", "N"], size=1, p=[0.4, 0.6])[0]
+                                return choice(["D", "N"], size=1, p=[0.4, 0.6])[0]
                             else:
-                                return np.random.choice(["N", "T"], size=1, p=[0.4, 0.6])[0]
+                                return choice(["N", "T"], size=1, p=[0.4, 0.6])[0]
                     elif rec != ans and rec != "W":
                         if out == "G":
                             if prev_trust == "T":
@@ -181,9 +380,9 @@ class MarkovDataGenerator(object):
                             if prev_trust == "T":
                                 return "T"
                             elif prev_trust == "N":
-                                return np.random.choice(["T", "N"], size=1, p=[0.4, 0.6])[0]
+                                return choice(["T", "N"], size=1, p=[0.4, 0.6])[0]
                             else:
-                                return np.random.choice(["N", "D"], size=1, p=[0.4, 0.6])[0]
+                                return choice(["N", "D"], size=1, p=[0.4, 0.6])[0]
                     elif rec == "W":
                         return prev_trust   
                 else:
@@ -192,16 +391,16 @@ class MarkovDataGenerator(object):
                             if prev_trust == "T":
                                 return "T"
                             elif prev_trust == "N":
-                                return np.random.choice(["T", "N"], size=1, p=[0.6, 0.4])[0]
+                                return choice(["T", "N"], size=1, p=[0.6, 0.4])[0]
                             else:
-                                return np.random.choice(["N", "D"], size=1, p=[0.6, 0.4])[0]
+                                return choice(["N", "D"], size=1, p=[0.6, 0.4])[0]
                         else:
                             if prev_trust == "D":
                                 return "D"
                             elif prev_trust == "N":
-                                return np.random.choice(["D", "N"], size=1, p=[0.6, 0.4])[0]
+                                return choice(["D", "N"], size=1, p=[0.6, 0.4])[0]
                             else:
-                                return np.random.choice(["N", "T"], size=1, p=[0.6, 0.4])[0]
+                                return choice(["N", "T"], size=1, p=[0.6, 0.4])[0]
                     elif rec != ans and rec != "W":
                         if out == "G":
                             if prev_trust == "T":
@@ -214,9 +413,9 @@ class MarkovDataGenerator(object):
                             if prev_trust == "T":
                                 return "T"
                             elif prev_trust == "N":
-                                return np.random.choice(["T", "N"], size=1, p=[0.6, 0.4])[0]
+                                return choice(["T", "N"], size=1, p=[0.6, 0.4])[0]
                             else:
-                                return np.random.choice(["N", "D"], size=1, p=[0.6, 0.4])[0]
+                                return choice(["N", "D"], size=1, p=[0.6, 0.4])[0]
                     elif rec == "W":
                         return prev_trust  
             elif type == "2":
@@ -226,16 +425,16 @@ class MarkovDataGenerator(object):
                             if prev_trust == "T":
                                 return "T"
                             elif prev_trust == "N":
-                                return np.random.choice(["T", "N"], size=1, p=[0.3, 0.7])[0]
+                                return choice(["T", "N"], size=1, p=[0.3, 0.7])[0]
                             else:
-                                return np.random.choice(["N", "D"], size=1, p=[0.3, 0.7])[0]
+                                return choice(["N", "D"], size=1, p=[0.3, 0.7])[0]
                         else:
                             if prev_trust == "D":
                                 return "D"
                             elif prev_trust == "N":
-                                return np.random.choice(["D", "N"], size=1, p=[0.3, 0.7])[0]
+                                return choice(["D", "N"], size=1, p=[0.3, 0.7])[0]
                             else:
-                                return np.random.choice(["N", "T"], size=1, p=[0.3, 0.7])[0]
+                                return choice(["N", "T"], size=1, p=[0.3, 0.7])[0]
                     elif rec != ans and rec != "W":
                         if out == "G":
                             if prev_trust == "T":
@@ -248,9 +447,9 @@ class MarkovDataGenerator(object):
                             if prev_trust == "T":
                                 return "T"
                             elif prev_trust == "N":
-                                return np.random.choice(["T", "N"], size=1, p=[0.3, 0.7])[0]
+                                return choice(["T", "N"], size=1, p=[0.3, 0.7])[0]
                             else:
-                                return np.random.choice(["N", "D"], size=1, p=[0.3, 0.7])[0]
+                                return choice(["N", "D"], size=1, p=[0.3, 0.7])[0]
                     elif rec == "W":
                         return prev_trust   
                 else:
@@ -259,16 +458,16 @@ class MarkovDataGenerator(object):
                             if prev_trust == "T":
                                 return "T"
                             elif prev_trust == "N":
-                                return np.random.choice(["T", "N"], size=1, p=[0.7, 0.3])[0]
+                                return choice(["T", "N"], size=1, p=[0.7, 0.3])[0]
                             else:
-                                return np.random.choice(["N", "D"], size=1, p=[0.7, 0.3])[0]
+                                return choice(["N", "D"], size=1, p=[0.7, 0.3])[0]
                         else:
                             if prev_trust == "D":
                                 return "D"
                             elif prev_trust == "N":
-                                return np.random.choice(["D", "N"], size=1, p=[0.7, 0.3])[0]
+                                return choice(["D", "N"], size=1, p=[0.7, 0.3])[0]
                             else:
-                                return np.random.choice(["N", "T"], size=1, p=[0.7, 0.3])[0]
+                                return choice(["N", "T"], size=1, p=[0.7, 0.3])[0]
                     elif rec != ans and rec != "W":
                         if out == "G":
                             if prev_trust == "T":
@@ -281,9 +480,9 @@ class MarkovDataGenerator(object):
                             if prev_trust == "T":
                                 return "T"
                             elif prev_trust == "N":
-                                return np.random.choice(["T", "N"], size=1, p=[0.7, 0.3])[0]
+                                return choice(["T", "N"], size=1, p=[0.7, 0.3])[0]
                             else:
-                                return np.random.choice(["N", "D"], size=1, p=[0.7, 0.3])[0]
+                                return choice(["N", "D"], size=1, p=[0.7, 0.3])[0]
                     elif rec == "W":
                         return prev_trust  
 
@@ -293,16 +492,16 @@ class MarkovDataGenerator(object):
                         if prev_trust == "T":
                             return "T"
                         elif prev_trust == "N":
-                            return np.random.choice(["T", "N"], size=1, p=[0.3, 0.7])[0]
+                            return choice(["T", "N"], size=1, p=[0.3, 0.7])[0]
                         else:
-                            return np.random.choice(["N", "D"], size=1, p=[0.3, 0.7])[0]
+                            return choice(["N", "D"], size=1, p=[0.3, 0.7])[0]
                     elif rec != ans and rec != "W":
                         if prev_trust == "D":
                             return "D"
                         elif prev_trust == "N":
-                            return np.random.choice(["D", "N"], size=1, p=[0.3, 0.7])[0]
+                            return choice(["D", "N"], size=1, p=[0.3, 0.7])[0]
                         else:
-                            return np.random.choice(["N", "T"], size=1, p=[0.3, 0.7])[0]
+                            return choice(["N", "T"], size=1, p=[0.3, 0.7])[0]
                     else:
                         return prev_trust   
                 else:
@@ -311,16 +510,16 @@ class MarkovDataGenerator(object):
                             if prev_trust == "T":
                                 return "T"
                             elif prev_trust == "N":
-                                return np.random.choice(["T", "N"], size=1, p=[0.7, 0.3])[0]
+                                return choice(["T", "N"], size=1, p=[0.7, 0.3])[0]
                             else:
-                                return np.random.choice(["N", "D"], size=1, p=[0.7, 0.3])[0]
+                                return choice(["N", "D"], size=1, p=[0.7, 0.3])[0]
                         else:
                             if prev_trust == "D":
                                 return "D"
                             elif prev_trust == "N":
-                                return np.random.choice(["D", "N"], size=1, p=[0.7, 0.3])[0]
+                                return choice(["D", "N"], size=1, p=[0.7, 0.3])[0]
                             else:
-                                return np.random.choice(["N", "T"], size=1, p=[0.7, 0.3])[0]
+                                return choice(["N", "T"], size=1, p=[0.7, 0.3])[0]
                     elif rec != ans and rec != "W":
                         if out == "G":
                             if prev_trust == "T":
@@ -333,70 +532,343 @@ class MarkovDataGenerator(object):
                             if prev_trust == "T":
                                 return "T"
                             elif prev_trust == "N":
-                                return np.random.choice(["T", "N"], size=1, p=[0.7, 0.3])[0]
+                                return choice(["T", "N"], size=1, p=[0.7, 0.3])[0]
                             else:
-                                return np.random.choice(["N", "D"], size=1, p=[0.7, 0.3])[0]
+                                return choice(["N", "D"], size=1, p=[0.7, 0.3])[0]
                     elif rec == "W":
                         return prev_trust  
 
             else:
                 raise NotImplementedError
 
-    def dict_to_mat(self, dictionary):
-        levels = 1
-        tested_dicts = dictionary
-        while isinstance(tested_dicts[list(tested_dicts.keys())[0]], dict):
-            tested_dicts = tested_dicts[list(tested_dicts.keys())[0]]
-            levels += 1
-
-        dimensions = []
-        keys = []
-        tested_dicts = dictionary
-        for _ in range(levels):
-            dimensions.append(len(list(tested_dicts.keys())))
-            keys.append(list(tested_dicts.keys()))
-            tested_dicts = tested_dicts[list(tested_dicts.keys())[0]]
-
-        prob_matrix = np.zeros(tuple(dimensions))
-        all_tested_keys = list(itertools.product(*keys))
-
-        for tested_key in all_tested_keys:
-            key_element_list = list(tested_key)
-            set_matrix = prob_matrix
-            traversed_dict = dictionary
-            for idx, key in enumerate(key_element_list):
-                index = None
-                if key in self.type_vals_mapping.keys():
-                    index = self.type_vals_mapping[key]
-                elif key in self.trust_vals_mapping.keys():
-                    index = self.trust_vals_mapping[key]
-                elif key in self.acceptance_vals_mapping.keys():
-                    index = self.acceptance_vals_mapping[key]
-                elif key in self.ai_advice_vals_mapping.keys():
-                    index = self.ai_advice_vals_mapping[key]
-                elif key in self.case_data_vals_mapping.keys():
-                    index = self.case_data_vals_mapping[key]
-                else:
-                    index = self.outcome_vals_mapping[key]
-
-                traversed_dict = traversed_dict[key]
-                if idx == len(key_element_list)-1:
-                    set_matrix[index] = traversed_dict
-                else:
-                    set_matrix = set_matrix[index]
+    def table_to_mat(self, table, axes):
+        # Dense array of a spec table over the episode_vocabs axes, e.g. ("types", "case")
+        shape = tuple(len(self.episode_vocabs[axis]) for axis in axes)
+        if not isinstance(table, dict):
+            return np.array(np.broadcast_to(np.asarray(table, dtype=np.float64), shape))
 
+        mapping = self.vocab_mappings[axes[0]]
+        prob_matrix = np.zeros(shape)
+        for key, value in table.items():
+            prob_matrix[mapping[key]] = self.table_to_mat(value, axes[1:])
         return prob_matrix
 
-    def generate_data(self, num_data, interaction_length):
-        states = self.sample_init_states(num_data)
-        sampled_data_per_step = [states]
+    def check_distributions(self, name, prob_matrix):
+        sums = prob_matrix.sum(axis=-1)
+        if (prob_matrix < 0).any() or not np.allclose(sums, 1.0):
+            raise ValueError("Rows of {} must be probability distributions, row sums range from {} to {}".format(
+                name, sums.min(), sums.max()
+            ))
+
+    def compile_tables(self):
+        # Dense versions of the spec tables, indexed with the *_mapping ids.
+        # Shapes : type (K,), init trust (K, S), advice (C, A),
+        # acceptance (K, C, A, S, D) and outcome (C, D, O).
+        self.episode_vocabs = {
+            "types": self.type_vals, "trust": self.trust_vals, "case": self.case_data_vals,
+            "advice": self.ai_advice_vals, "decision": self.human_answer_values, "outcome_val": self.outcome_vals,
+        }
+        self.vocab_mappings = {
+            name: {val: idx for idx, val in enumerate(vals)} for name, vals in self.episode_vocabs.items()
+        }
+
+        self.type_probs_mat = self.table_to_mat(self.type_probs, ("types",))
+        self.init_trust_mat = self.table_to_mat(self.init_trust_prior, ("types", "trust"))
+        self.ai_advice_mat = self.table_to_mat(self.ai_advice_probs, ("case", "advice"))
+        self.acceptance_mat = self.table_to_mat(self.acceptance_probs, ("types", "case", "advice", "trust", "decision"))
+        self.outcome_mat = self.table_to_mat(self.outcome_probs, ("case", "decision", "outcome_val"))
+        for name, prob_matrix in [
+            ("type_probs", self.type_probs_mat), ("init_trust_prior", self.init_trust_mat),
+            ("ai_advice_probs", self.ai_advice_mat), ("acceptance_probs", self.acceptance_mat),
+            ("outcome_probs", self.outcome_mat),
+        ]:
+            self.check_distributions(name, prob_matrix)
+
+        self.type_table = CategoricalTable(self.type_probs_mat)
+        self.init_trust_table = CategoricalTable(self.init_trust_mat)
+        self.ai_advice_table = CategoricalTable(self.ai_advice_mat)
+        self.acceptance_table = CategoricalTable(self.acceptance_mat)
+        self.outcome_table = CategoricalTable(self.outcome_mat)
+
+        # Relation id of every (advice, decision) pair and the trust update tables
+        self.relation_mat = np.array([
+            [self.advice_relation(adv_val, dec_val) for dec_val in self.human_answer_values]
+            for adv_val in self.ai_advice_vals
+        ])
+        self.compile_trust_moves()
+        self.dense_trust_transitions = None
+
+        # Cases shown at each step, independent of the case names
+        if self.case_schedule["kind"] == "cycle":
+            order = self.case_schedule.get("order", self.case_data_vals)
+            self.case_order = np.array([self.case_data_vals_mapping[case_id] for case_id in order], dtype=np.int64)
+        else:
+            num_cases = len(self.case_data_vals)
+            self.case_probs_mat = self.table_to_mat(self.case_schedule.get("probs", np.full(num_cases, 1/num_cases)), ("case",))
+            self.check_distributions("case_schedule probs", self.case_probs_mat)
+            self.case_table = CategoricalTable(self.case_probs_mat)
+
+        # Offset of the continuous case features (see translate_to_continuous)
+        if self.case_feature_offsets is None:
+            self.case_cont_offsets = np.array(
+                [0.0 if case_id == "T1" else 1.0 if case_id == "T2" else 2.0 for case_id in self.case_data_vals]
+            )
+        else:
+            self.case_cont_offsets = self.table_to_mat(self.case_feature_offsets, ("case",))
+
+        # (K, S) probability of ending the episode after a step, None for fixed length episodes
+        self.stop_probs_mat = None
+        self.min_length = 1
+        if self.termination is not None:
+            self.stop_probs_mat = self.table_to_mat(self.termination["stop_probs"], ("types", "trust"))
+            self.min_length = self.termination.get("min_length", 1)
+            if (self.stop_probs_mat < 0).any() or (self.stop_probs_mat > 1).any():
+                raise ValueError("termination stop_probs must lie in [0, 1]")
+            if self.min_length < 1:
+                raise ValueError("termination min_length must be at least 1")
+
+    def table_spec(self):
+        # Plain, JSON serialisable description of every table the generator samples from,
+        # the generator can be rebuilt from it with MarkovDataGenerator(spec)
+        return to_json_value(self.spec)
+
+    def save_spec(self, path):
+        with open(path, "w") as spec_file:
+            json.dump(self.table_spec(), spec_file, indent=1)
+
+    def advice_relation(self, rec, ans):
+        if rec == self.withheld_advice:
+            return self.advice_relation_vals.index("withheld")
+        elif rec == ans:
+            return self.advice_relation_vals.index("agree")
+        return self.advice_relation_vals.index("disagree")
+
+    def compile_trust_moves(self):
+        # Table driven version of per_type_trust_update.
+        # Trust levels are ordered from most ("T") to least ("D") trusting. A move up or down
+        # happens with the per type / per case rate, a "hard" move down always happens.
+        # trust_move_mat holds the move of every (relation, outcome, outcome blind) combination.
+        self.trust_rates_mat = self.table_to_mat(self.trust_update_rates, ("types", "case"))
+        # outcome_blind_cases lists the cases of every type, or is a (K, C) boolean table
+        if isinstance(self.outcome_blind_cases, dict):
+            outcome_blind = np.zeros((len(self.type_vals), len(self.case_data_vals)), dtype=bool)
+            for type_id, case_ids in self.outcome_blind_cases.items():
+                outcome_blind[self.type_vals_mapping[type_id], [self.case_data_vals_mapping[case_id] for case_id in case_ids]] = True
+        else:
+            outcome_blind = self.table_to_mat(self.outcome_blind_cases, ("types", "case")).astype(bool)
+        self.outcome_blind_mat = outcome_blind.astype(np.int64)
+
+        stay, up, down, hard_down = (self.trust_move_vals.index(move) for move in ["stay", "up", "down", "hard_down"])
+        agree = self.advice_relation_vals.index("agree")
+        disagree = self.advice_relation_vals.index("disagree")
+        # Last axis : outcome not blind / blind
+        moves = np.full((len(self.advice_relation_vals), len(self.outcome_vals), 2), stay, dtype=np.int64)
+        for out_val, out_idx in self.outcome_vals_mapping.items():
+            if out_val == self.good_outcome:
+                moves[agree, out_idx] = [up, up]
+                moves[disagree, out_idx] = [hard_down, down]
+            else:
+                moves[agree, out_idx] = [down, up]
+                moves[disagree, out_idx] = [up, down]
+        self.trust_move_mat = moves
+
+    @property
+    def trust_transition_mat(self):
+        # Dense (K, C, S, R, O, S') trust tensor for exact inference, built on first use
+        if self.dense_trust_transitions is None:
+            self.dense_trust_transitions = self.build_trust_transitions()
+        return self.dense_trust_transitions
+
+    def build_trust_transitions(self):
+        num_trust = len(self.trust_vals)
+        rates = self.trust_rates_mat[:, :, None, None]
+        trust_ids = np.arange(num_trust)
+        stay = np.eye(num_trust)
+        up_one = np.eye(num_trust)[np.maximum(trust_ids-1, 0)]
+        down_one = np.eye(num_trust)[np.minimum(trust_ids+1, num_trust-1)]
+
+        # (moves, K, C, S, S') transition matrices, in trust_move_vals order
+        move_mats = np.stack(np.broadcast_arrays(
+            stay, (1-rates)*stay + rates*up_one, (1-rates)*stay + rates*down_one, down_one
+        ))
+        # (K, C, R, O) move of every row
+        moves = self.trust_move_mat[:, :, self.outcome_blind_mat].transpose(2, 3, 0, 1)
+        type_ids = np.arange(len(self.type_vals))[:, None, None, None, None]
+        case_ids = np.arange(len(self.case_data_vals))[None, :, None, None, None]
+        return move_mats[moves[:, :, None], type_ids, case_ids, trust_ids[None, None, :, None, None]]
+
+    def sample_trust_update(self, types, case, trust, relation, outcome, rng=None):
+        # Draws the next trust levels, O(1) per row. Same draws as inverse-CDF sampling of the
+        # trust_transition_mat rows.
+        rng = np.random if rng is None else rng
+        move = self.trust_move_mat[relation, outcome, self.outcome_blind_mat[types, case]]
+        rates = self.trust_rates_mat[types, case]
+        uniform_samples = rng.random(trust.shape)
+        lower = np.maximum(trust-1, 0)
+        higher = np.minimum(trust+1, len(self.trust_vals)-1)
+        return np.choose(move, [
+            trust,
+            np.where(uniform_samples < rates, lower, trust),
+            np.where(uniform_samples < 1-rates, trust, higher),
+            higher,
+        ])
+
+    def verify_trust_transitions(self, atol=1e-9):
+        # Compares trust_transition_mat against the branch logic of per_type_trust_update over
+        # every input combination. Returns the mismatching combinations.
+        def distribution_choice(values, size=1, p=None):
+            return [dict(zip(values, p))]
+
+        mismatches = []
+        for type_id, case_id, prev_trust, rec, ans, out in itertools.product(
+            self.type_vals, self.case_data_vals, self.trust_vals,
+            self.ai_advice_vals, self.human_answer_values, self.outcome_vals
+        ):
+            expected = self.per_type_trust_update(type_id, case_id, prev_trust, rec, ans, out, choice=distribution_choice)
+            if not isinstance(expected, dict):
+                expected = {expected: 1.0}
+            expected_probs = np.zeros(len(self.trust_vals))
+            for trust_val, prob in expected.items():
+                expected_probs[self.trust_vals_mapping[trust_val]] += prob
+
+            table_probs = self.trust_transition_mat[
+                self.type_vals_mapping[type_id], self.case_data_vals_mapping[case_id],
+                self.trust_vals_mapping[prev_trust], self.advice_relation(rec, ans), self.outcome_vals_mapping[out]
+            ]
+            if not np.allclose(expected_probs, table_probs, atol=atol):
+                mismatches.append((type_id, case_id, prev_trust, rec, ans, out))
+
+        return mismatches
+
+    def generate_data(self, num_data, interaction_length, seed=None, num_workers=1):
+        """
+        Samples num_data episodes of interaction_length steps.
+        With num_workers > 1 the seed blocks are shared out to a process pool and written
+        into one contiguous EpisodeStore. A missing seed is then drawn from fresh entropy.
+        The same seed gives the same data for any number of workers.
+        """
+        if seed is None and num_workers <= 1:
+            return self.sample_episodes(num_data, interaction_length)
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+
+        sampled_data = EpisodeStore.empty(
+            self.episode_vocabs, num_data, interaction_length, self.num_case_features, self.variable_length
+        )
+        num_blocks = self.num_seed_blocks(num_data)
+        if num_workers <= 1:
+            for block_id in range(num_blocks):
+                block = self.generate_block(block_id, num_data, interaction_length, seed)
+                sampled_data.write_rows(block_id*self.seed_block_size, block)
+            return sampled_data
+
+        with ProcessPoolExecutor(
+            num_workers, initializer=_init_generation_worker, initargs=(self,)
+        ) as executor:
+            # Keep a bounded number of blocks in flight so finished blocks don't pile up in memory
+            pending = set()
+            for block_id in range(num_blocks):
+                if len(pending) >= 2*num_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    self.write_worker_blocks(sampled_data, done)
+                pending.add(executor.submit(_generate_block_in_worker, block_id, num_data, interaction_length, seed))
+            self.write_worker_blocks(sampled_data, pending)
+
+        return sampled_data
+
+    def write_worker_blocks(self, sampled_data, futures):
+        for future in futures:
+            block_id, block = future.result()
+            sampled_data.write_rows(block_id*self.seed_block_size, block)
+
+    @property
+    def variable_length(self):
+        return self.stop_probs_mat is not None
+
+    def sample_episodes(self, num_data, interaction_length, rng=None):
+        sampled_data = EpisodeStore.empty(
+            self.episode_vocabs, num_data, interaction_length, self.num_case_features, self.variable_length
+        )
+        states = self.sample_init_indices(num_data, rng)
+        sampled_data.set_step(0, states)
+        # Episodes still running, only these are sampled at the next steps
+        alive = None
         for id in range(interaction_length-1):
-            new_states = self.sample_next_states(states, q_id=id+2)
-            sampled_data_per_step.append(new_states)
-            states = new_states
+            if self.variable_length and id+1 >= self.min_length:
+                with self.metrics.timer("sample_stop"):
+                    stopped = self.sample_stops(states, rng)
+                    if alive is None:
+                        alive = np.arange(num_data)
+                    sampled_data.lengths[alive[stopped]] = id+1
+                    alive = alive[~stopped]
+                    states = {
+                        name: None if values is None else values[~stopped] for name, values in states.items()
+                    }
+                if len(alive) == 0:
+                    break
+            states = self.sample_next_indices(states, q_id=id+2, rng=rng)
+            sampled_data.set_step(id+1, states, rows=alive)
+
+        sampled_data.pad()
+        self.metrics.count("episodes", num_data)
+        return sampled_data
+
+    def sample_stops(self, states, rng=None):
+        # Whether each episode ends after the step of states
+        rng = np.random if rng is None else rng
+        return rng.random(states["types"].shape[0]) < self.stop_probs_mat[states["types"], states["trust"]]
+
+    def __getstate__(self):
+        # Metrics sinks hold open files, generation workers get a generator without them
+        state = self.__dict__.copy()
+        state["metrics"] = NULL_METRICS
+        return state
+
+    def num_seed_blocks(self, num_data):
+        return (num_data + self.seed_block_size - 1) // self.seed_block_size
+
+    def generate_block(self, block_id, num_data, interaction_length, seed):
+        # Episodes [block_id*seed_block_size, (block_id+1)*seed_block_size) of a seeded dataset
+        block_rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(block_id,)))
+        block_size = min(self.seed_block_size, num_data - block_id*self.seed_block_size)
+        return self.sample_episodes(block_size, interaction_length, block_rng)
+
+    def iter_blocks(self, num_data, interaction_length, seed=None, block_size=None):
+        if seed is None:
+            for start in range(0, num_data, block_size):
+                yield self.sample_episodes(min(block_size, num_data-start), interaction_length)
+        else:
+            for block_id in range(self.num_seed_blocks(num_data)):
+                yield self.generate_block(block_id, num_data, interaction_length, seed)
+
+    def iter_data(self, num_data, interaction_length, chunk_size, seed=None, vectorize=True):
+        """
+        Generates num_data episodes as a stream of chunks of chunk_size episodes (the last chunk may
+        be smaller). Only about one chunk and one generation block are held in memory at a time.
+        Chunks are the to_vector_form tuples, or EpisodeStores with latents when vectorize is False.
+        With a seed, the concatenated chunks are the same as generate_data(..., seed=seed)
+        for any chunk_size.
+        """
+        buffer = None
+        offset = 0
+        for block in self.iter_blocks(num_data, interaction_length, seed, block_size=chunk_size):
+            if buffer is None or offset == len(buffer):
+                buffer = block
+            else:
+                buffer = EpisodeStore.concatenate([buffer[offset:], block])
+            offset = 0
+            while len(buffer) - offset >= chunk_size:
+                yield self.format_chunk(buffer[offset:offset+chunk_size], vectorize)
+                offset += chunk_size
+
+        if buffer is not None and offset < len(buffer):
+            yield self.format_chunk(buffer[offset:], vectorize)
+
+    def format_chunk(self, chunk, vectorize):
+        if vectorize:
+            return self.to_vector_form(self.remove_latent_vars(chunk))
+        return chunk
 
-        return sampled_data_per_step
-    
     def translate_to_continuous(self, case_data):
         continuous_inp_array = []
         for _data in case_data:
@@ -409,85 +881,204 @@ class MarkovDataGenerator(object):
 
         return continuous_inp_array
 
-    def sample_init_states(self, num_data):
+    def case_ids_for_step(self, q_id, num_data, rng=None, case_start=None):
+        # Cases shown at step q_id (from 1) by the case schedule, case_start holds the
+        # episodes' positions in a cycle with random_start
+        if self.case_schedule["kind"] == "random":
+            return self.case_table.sample(rng=rng, size=num_data)
+        if case_start is None:
+            return np.full(num_data, self.case_order[(q_id-1) % len(self.case_order)], dtype=np.int64)
+        return self.case_order[(case_start + q_id-1) % len(self.case_order)]
 
-        init_state = {}
+    def sample_case_start(self, num_data, rng=None):
+        if self.case_schedule["kind"] != "cycle" or not self.case_schedule.get("random_start", False):
+            return None
+        rng = np.random if rng is None else rng
+        return (rng.random(num_data) * len(self.case_order)).astype(np.int64)
+
+    def sample_observed_indices(self, types, trust, case, rng=None):
+        # Draws advice, decision, outcome and continuous features for the whole population.
+        rng = np.random if rng is None else rng
+        with self.metrics.timer("sample_advice"):
+            advice = self.ai_advice_table.sample((case,), rng)
+        with self.metrics.timer("sample_decision"):
+            decision = self.acceptance_table.sample((types, case, advice, trust), rng)
+        with self.metrics.timer("sample_outcome"):
+            outcome = self.outcome_table.sample((case, decision), rng)
+        with self.metrics.timer("sample_cont_input"):
+            cont_input = self.case_cont_offsets[case][:, None] + rng.uniform(0, 1, (case.shape[0], self.num_case_features))
 
-        all_type_probs = [self.type_probs[type_id] for type_id in self.type_vals]
-        init_types = [np.random.choice(self.type_vals, p=all_type_probs)[0] for _ in range(num_data)]
-        init_state["types"] = init_types
-
-        init_trust_val = [
-            np.random.choice(self.trust_vals, p=[self.init_trust_prior[type_id][trust_val] 
-            for trust_val in self.trust_vals])[0] for type_id in init_types
-        ]
-        init_state["trust"] = init_trust_val
-
-        init_cases = [self.case_data_vals[0] for _ in range(num_data)]
-        init_state["case"] = init_cases
-
-        init_state_advice = [
-            np.random.choice(self.ai_advice_vals, size=1, p=[self.ai_advice_probs[case_id][adv_val] 
-            for adv_val in self.ai_advice_vals])[0] for case_id in init_cases
-        ]
-        init_state["advice"] = init_state_advice
-
-        init_state_decision = [
-            np.random.choice(self.human_answer_values, size=1, p=[self.acceptance_probs[type_id][case_id][adv_id][trust_id][acc_val] 
-            for acc_val in self.human_answer_values])[0]
-            for trust_id, adv_id, case_id, type_id in zip(init_trust_val, init_state_advice, init_cases, init_types)
-        ]
-        init_state["decision"] = init_state_decision
-
-        init_state_outcome = [
-            np.random.choice(self.outcome_vals, size=1, p=[self.outcome_probs[case_id][dec_id][adv_val] 
-            for adv_val in self.outcome_vals])[0] for case_id, dec_id in zip(init_cases, init_state_decision)
-        ]
-        init_state["outcome_val"] = init_state_outcome
-        init_state["cont_input"] = self.translate_to_continuous(init_state["case"])
+        return advice, decision, outcome, cont_input
+
+    def sample_init_indices(self, num_data, rng=None):
+        # Integer coded counterpart of sample_init_states
+        rng = np.random if rng is None else rng
+        init_state = {}
+        with self.metrics.timer("sample_types"):
+            init_state["types"] = self.type_table.sample(rng=rng, size=num_data)
+        with self.metrics.timer("sample_trust"):
+            init_state["trust"] = self.init_trust_table.sample((init_state["types"],), rng)
+        with self.metrics.timer("sample_case"):
+            init_state["case_start"] = self.sample_case_start(num_data, rng)
+            init_state["case"] = self.case_ids_for_step(1, num_data, rng, init_state["case_start"])
+        (
+            init_state["advice"], init_state["decision"], init_state["outcome_val"], init_state["cont_input"]
+        ) = self.sample_observed_indices(init_state["types"], init_state["trust"], init_state["case"], rng)
 
         return init_state
 
-    def sample_next_states(self, prev_states, q_id=1):
+    def sample_next_indices(self, prev_states, q_id=1, rng=None):
+        # Integer coded counterpart of sample_next_states
+        rng = np.random if rng is None else rng
         new_state = {}
         new_state["types"] = prev_states["types"]
-        new_state["case"] = ["T"+str(q_id) for _ in range(len(prev_states["types"]))]
-        prev_trust = prev_states["trust"]
-        prev_advice = prev_states["advice"]
-        prev_outcome = prev_states["outcome_val"]
-        prev_decision = prev_states["decision"] 
-        #prev_case_data = prev_states["case"]
-
-        next_trust = [
-            self.per_type_trust_update(type_id, case_id, prev_tv, rec, prev_dec, out)
-            for type_id, case_id, prev_tv, rec, prev_dec, out in zip(new_state["types"], prev_states["case"], prev_trust, prev_advice, prev_decision, prev_outcome)
-        ]
-        new_state["trust"] = next_trust
-
-        new_state_advice = [
-            np.random.choice(self.ai_advice_vals, size=1, p=[self.ai_advice_probs[case_id][adv_val] 
-            for adv_val in self.ai_advice_vals])[0] for case_id in new_state["case"]
-        ]
-        new_state["advice"] = new_state_advice
-
-        new_state_decision = [
-            np.random.choice(self.human_answer_values, size=1, p=[self.acceptance_probs[type_id][case_id][adv_id][trust_id][acc_val] 
-            for acc_val in self.human_answer_values])[0]
-            for trust_id, adv_id, case_id, type_id in zip(next_trust, new_state_advice, new_state["case"], new_state["types"])
-        ]
-        
-        new_state["decision"] = new_state_decision
-
-        new_state_outcome = [
-            np.random.choice(self.outcome_vals, size=1, p=[self.outcome_probs[case_id][dec_id][adv_val] 
-            for adv_val in self.outcome_vals])[0] for case_id, dec_id in zip(new_state["case"], new_state_decision)
-        ]
-        new_state["outcome_val"] = new_state_outcome
-        new_state["cont_input"] = self.translate_to_continuous(new_state["case"])
+        new_state["case_start"] = prev_states.get("case_start")
+        with self.metrics.timer("sample_case"):
+            new_state["case"] = self.case_ids_for_step(q_id, new_state["types"].shape[0], rng, new_state["case_start"])
+        with self.metrics.timer("trust_update"):
+            relation = self.relation_mat[prev_states["advice"], prev_states["decision"]]
+            new_state["trust"] = self.sample_trust_update(
+                prev_states["types"], prev_states["case"], prev_states["trust"], relation, prev_states["outcome_val"], rng
+            )
+        (
+            new_state["advice"], new_state["decision"], new_state["outcome_val"], new_state["cont_input"]
+        ) = self.sample_observed_indices(new_state["types"], new_state["trust"], new_state["case"], rng)
+
         return new_state
 
+    def indices_to_states(self, index_states):
+        states = {}
+        states["types"] = [self.type_vals[idx] for idx in index_states["types"]]
+        states["trust"] = [self.trust_vals[idx] for idx in index_states["trust"]]
+        states["case"] = [self.case_data_vals[idx] for idx in index_states["case"]]
+        states["advice"] = [self.ai_advice_vals[idx] for idx in index_states["advice"]]
+        states["decision"] = [self.human_answer_values[idx] for idx in index_states["decision"]]
+        states["outcome_val"] = [self.outcome_vals[idx] for idx in index_states["outcome_val"]]
+        states["cont_input"] = list(index_states["cont_input"])
+        if index_states.get("case_start") is not None:
+            states["case_start"] = list(index_states["case_start"])
+
+        return states
+
+    def states_to_indices(self, states):
+        index_states = {}
+        index_states["types"] = np.array([self.type_vals_mapping[val] for val in states["types"]], dtype=np.int64)
+        index_states["trust"] = np.array([self.trust_vals_mapping[val] for val in states["trust"]], dtype=np.int64)
+        index_states["case"] = np.array([self.case_data_vals_mapping[val] for val in states["case"]], dtype=np.int64)
+        index_states["advice"] = np.array([self.ai_advice_vals_mapping[val] for val in states["advice"]], dtype=np.int64)
+        index_states["decision"] = np.array([self.human_ans_vals_mapping[val] for val in states["decision"]], dtype=np.int64)
+        index_states["outcome_val"] = np.array([self.outcome_vals_mapping[val] for val in states["outcome_val"]], dtype=np.int64)
+        index_states["cont_input"] = np.array(states["cont_input"])
+        if "case_start" in states:
+            index_states["case_start"] = np.array(states["case_start"], dtype=np.int64)
+
+        return index_states
+
+    def sample_init_states(self, num_data):
+        return self.indices_to_states(self.sample_init_indices(num_data))
+
+    def sample_next_states(self, prev_states, q_id=1):
+        return self.indices_to_states(self.sample_next_indices(self.states_to_indices(prev_states), q_id=q_id))
+
+
+    def exact_marginals(self, interaction_length):
+        """
+        Propagates the exact joint distribution of the population through time, no sampling.
+        Returns a dict of arrays with a leading step axis :
+            joint : (T, K, S, A, D, O) p(type, trust, advice, decision, outcome) at each step
+            type_trust : (T, K, S), trust_given_type : (T, K, S)
+            advice : (T, A), decision : (T, D), outcome : (T, O)
+            advice_decision_outcome : (T, A, D, O)
+            case : (T, C) distribution of the case shown at each step
+            alive : (T,) probability that an episode is still running at each step
+        With termination the distributions are over the episodes still running at the step.
+        The population is split into rows that share their cases : one row for a fixed cycle,
+        one per start position for a cycle with random_start, one per case for random cases.
+        """
+        num_cases = len(self.case_data_vals)
+        random_cases = self.case_schedule["kind"] == "random"
+        type_trust = (self.type_probs_mat[:, None] * self.init_trust_mat)[None]
+        case_start = self.sample_case_start(0)
+        if case_start is not None:
+            case_start = np.arange(len(self.case_order))
+            type_trust = np.repeat(type_trust, len(case_start), axis=0) / len(case_start)
+
+        # (K, C, S, A, D, O, S') next trust given everything observed at a step
+        transitions = self.trust_transition_mat[:, :, :, self.relation_mat]
+        joints = []
+        cases = []
+        alive = []
+        for step in range(interaction_length):
+            if random_cases:
+                # Cases are drawn afresh every step, independent of the trust so far
+                case_ids = np.arange(num_cases)
+                row_trust = self.case_probs_mat[:, None, None] * type_trust
+                cases.append(self.case_probs_mat)
+            else:
+                case_ids = self.case_ids_for_step(step+1, type_trust.shape[0], case_start=case_start)
+                row_trust = type_trust
+                cases.append(np.bincount(case_ids, weights=row_trust.sum(axis=(1, 2)), minlength=num_cases))
+
+            # (rows, K, S, A, D, O)
+            joint = (
+                row_trust[:, :, :, None, None, None] *
+                self.ai_advice_mat[case_ids][:, None, None, :, None, None] *
+                self.acceptance_mat[:, case_ids].transpose(1, 0, 3, 2, 4)[:, :, :, :, :, None] *
+                self.outcome_mat[case_ids][:, None, None, None, :, :]
+            )
+            joints.append(joint.sum(axis=0))
+            alive.append(joints[-1].sum())
+
+            if self.variable_length and step+1 >= self.min_length:
+                # Only the episodes that continue move on to the next step
+                joint = joint * (1 - self.stop_probs_mat)[None, :, :, None, None, None]
+            step_transitions = transitions if random_cases else transitions[:, case_ids]
+            type_trust = np.einsum("cksado,kcsador->ckr", joint, step_transitions)
+            if random_cases:
+                type_trust = type_trust.sum(axis=0, keepdims=True)
+
+        alive = np.array(alive)
+        joint = np.stack(joints) / alive[:, None, None, None, None, None]
+        type_trust = joint.sum(axis=(3, 4, 5))
+        return {
+            "joint": joint,
+            "type_trust": type_trust,
+            "trust_given_type": type_trust / type_trust.sum(axis=-1, keepdims=True),
+            "advice": joint.sum(axis=(1, 2, 4, 5)),
+            "decision": joint.sum(axis=(1, 2, 3, 5)),
+            "outcome": joint.sum(axis=(1, 2, 3, 4)),
+            "advice_decision_outcome": joint.sum(axis=(1, 2)),
+            "case": np.stack(cases) / (1 if random_cases else alive[:, None]),
+            "alive": alive,
+        }
+
+    def empirical_marginals(self, data):
+        # Sample frequencies of the exact_marginals entries computed from an EpisodeStore,
+        # over the episodes still running at each step
+        def frequencies(column, size):
+            column = np.asarray(column, dtype=np.int64)
+            counts = np.stack([np.bincount(step_column[step_column >= 0], minlength=size) for step_column in column.T])
+            return counts / np.maximum(counts.sum(axis=1, keepdims=True), 1)
+
+        marginals = {
+            "advice": frequencies(data.data["advice"], len(self.ai_advice_vals)),
+            "decision": frequencies(data.data["decision"], len(self.human_answer_values)),
+            "outcome": frequencies(data.data["outcome_val"], len(self.outcome_vals)),
+            "case": frequencies(data.data["case"], len(self.case_data_vals)),
+            "alive": data.step_mask().mean(axis=0),
+        }
+        if data.has_latents:
+            num_trust = len(self.trust_vals)
+            type_trust = np.asarray(data.data["types"], dtype=np.int64)*num_trust + data.data["trust"]
+            marginals["type_trust"] = frequencies(type_trust, len(self.type_vals)*num_trust).reshape(
+                -1, len(self.type_vals), num_trust
+            )
+        return marginals
 
     def remove_latent_vars(self, generated_data):
+        if isinstance(generated_data, EpisodeStore):
+            return generated_data.remove_latent_vars()
+
         for data_dic in generated_data:
             del data_dic["trust"]
             del data_dic["types"]
@@ -495,33 +1086,34 @@ class MarkovDataGenerator(object):
 
         return generated_data
 
-    def to_vector_form(self, data):
-        question_one_hot_ids = np.eye(len(self.case_data_vals))
-        advice_one_hot_ids = np.eye(len(self.ai_advice_vals))
-        decision_one_hot_ids = np.eye(len(self.human_answer_values))
-        outcome_one_hot_ids = np.eye(len(self.outcome_vals))
-
-        question_list = []
-        advice_list = []
-        decision_list = []
-        out_list = []
-        for d_t in data:
-            q_ids = [self.case_data_vals_mapping[dat_id] for dat_id in d_t["case"]]
-            question_list.append(np.expand_dims(question_one_hot_ids[q_ids], axis=1))
-            adv_ids = [self.ai_advice_vals_mapping[dat_id] for dat_id in d_t["advice"]]
-            advice_list.append(np.expand_dims(advice_one_hot_ids[adv_ids], axis=1))
-            dec_ids = [self.human_ans_vals_mapping[dat_id] for dat_id in d_t["decision"]]
-            decision_list.append(np.expand_dims(decision_one_hot_ids[dec_ids], axis=1))
-            out_ids = [self.outcome_vals_mapping[dat_id] for dat_id in d_t["outcome_val"]]
-            out_list.append(np.expand_dims(outcome_one_hot_ids[out_ids], axis=1))
-
-        final_q_id = np.concatenate(question_list, axis=1)
-        final_adv_id = np.concatenate(advice_list, axis=1)
-        final_dec_ids = np.concatenate(decision_list, axis=1)
-        final_out_ids = np.concatenate(out_list, axis=1)[:, :, 0]
-        final_dones = np.zeros_like(final_dec_ids)
-        final_dones[:, -1, :] = 1
-
-        return final_q_id, final_adv_id, final_dec_ids, final_dones[:, :, 0], final_out_ids
-
-        #print(final_q_id, final_adv_id, final_dec_ids, final_out_ids)
\ No newline at end of file
+    def to_vector_form(self, data, encoding="onehot", dtype=np.float64):
+        """
+        Model inputs for a batch of episodes : cases, advice, decisions, dones and rewards.
+        encoding="onehot" returns (N, T, vocab size) one-hot arrays in dtype (float64 by default,
+        uint8 or float32 for compact copies). encoding="index" returns the (N, T) integer ids as
+        stored (int8 for the default vocabularies). dones and rewards are (N, T) arrays in dtype.
+        The agents take float one-hot or index observations, replay.build_shifted_observations
+        turns uint8 one-hots into float32 ones.
+        """
+        with self.metrics.timer("vectorize"):
+            if not isinstance(data, EpisodeStore):
+                data = EpisodeStore.from_records(data, self.episode_vocabs)
+
+            if encoding == "onehot":
+                final_q_id = data.one_hot("case", dtype=dtype)
+                final_adv_id = data.one_hot("advice", dtype=dtype)
+                final_dec_ids = data.one_hot("decision", dtype=dtype)
+            elif encoding == "index":
+                final_q_id = np.asarray(data.data["case"])
+                final_adv_id = np.asarray(data.data["advice"])
+                final_dec_ids = np.asarray(data.data["decision"])
+            else:
+                raise ValueError("Unknown encoding : " + str(encoding))
+
+            # Padded steps after an episode's end are zero rows (onehot) or -1 (index),
+            # with zero dones and rewards
+            final_out_ids = (data.data["outcome_val"] == self.outcome_vals_mapping[self.good_outcome]).astype(dtype)
+            final_dones = np.zeros(final_out_ids.shape, dtype=dtype)
+            final_dones[np.arange(data.num_episodes), data.episode_lengths()-1] = 1
+
+        return final_q_id, final_adv_id, final_dec_ids, final_dones, final_out_ids
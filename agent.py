@@ -1,12 +1,161 @@
-from network import DDQN, Encoder, Decoder
+from network import DDQN, Encoder, Decoder, expand_index_inputs
+from metrics import NULL_METRICS
 import copy
+import warnings
 import torch
+import torch.nn as nn
 import torch.optim as optim
 import torch.distributions as dist
 import torch.nn.functional as F
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence
 
-class OfflineAHTAgent(object):
-    def __init__(self, state_size, action_size, human_action_size, layer_size, lstm_dim, encoding_dim, device="cpu"):
+
+def is_index_tensor(tensor):
+    # Signed integer inputs hold category ids, float or unsigned inputs are one-hots
+    return not torch.is_floating_point(tensor) and tensor.is_signed()
+
+
+def obs_to_tensor(input_obs, state_size, human_action_size, device, dtype):
+    # Observations are either float one-hot features or signed integer (case id, previous
+    # decision id) pairs. Both pad missing previous decisions and next observations with -1,
+    # which unsigned (e.g. uint8 one-hot) observations can't hold, so those are rejected.
+    obs_tensor = torch.as_tensor(input_obs, device=device)
+    if not torch.is_floating_point(obs_tensor) and not obs_tensor.is_signed():
+        raise ValueError(
+            "Unsigned observations can't hold the -1 padding, use float one-hot or signed index "
+            "observations (got " + str(obs_tensor.dtype) + ")"
+        )
+    if is_index_tensor(obs_tensor):
+        return expand_index_inputs(obs_tensor, [state_size, human_action_size], dtype)
+    return obs_tensor.to(dtype)
+
+
+def actions_to_tensor(actions, action_size, device, dtype):
+    # Actions are either one-hot vectors or integer ids
+    actions_tensor = torch.as_tensor(actions, device=device)
+    if is_index_tensor(actions_tensor):
+        return F.one_hot(actions_tensor.long(), action_size).to(dtype)
+    return actions_tensor.to(dtype)
+
+
+def convert_state_dict(state_dict, dtype):
+    # Casts the floating point tensors of a (possibly nested) checkpoint to dtype
+    if isinstance(state_dict, dict):
+        return {key: convert_state_dict(value, dtype) for key, value in state_dict.items()}
+    if isinstance(state_dict, list):
+        return [convert_state_dict(value, dtype) for value in state_dict]
+    if torch.is_tensor(state_dict) and torch.is_floating_point(state_dict):
+        return state_dict.to(dtype)
+    return state_dict
+
+
+def sync_target_network(target_network, network, tau=1.0):
+    # In-place target update, target <- (1-tau) * target + tau * network. tau=1 copies.
+    with torch.no_grad():
+        for target_param, param in zip(target_network.parameters(), network.parameters()):
+            if tau == 1.0:
+                target_param.copy_(param)
+            else:
+                target_param.lerp_(param, tau)
+        for target_buffer, buffer in zip(target_network.buffers(), network.buffers()):
+            target_buffer.copy_(buffer)
+
+
+def compile_loss_fn(loss_fn):
+    # torch.compile'd loss computation, falls back to eager mode when compilation isn't
+    # available or fails on the first call
+    if not hasattr(torch, "compile"):
+        warnings.warn("torch.compile is not available, training in eager mode")
+        return loss_fn
+    compiled_fn = torch.compile(loss_fn)
+    state = {"fn": None}
+
+    def run(*args):
+        if state["fn"] is not None:
+            return state["fn"](*args)
+        try:
+            outputs = compiled_fn(*args)
+            state["fn"] = compiled_fn
+        except Exception as error:
+            warnings.warn("torch.compile failed, training in eager mode : " + str(error))
+            state["fn"] = loss_fn
+            outputs = loss_fn(*args)
+        return outputs
+
+    return run
+
+
+def check_next_obs(input_tensor, nobs_tensor, lengths=None):
+    # The losses only read the next observation after every episode's last step, the target
+    # encodings of the other steps are the observations' own encodings shifted by one step.
+    # Batches must hold nobs[:, t] == obs[:, t+1] for every real step but the last.
+    nobs_steps, next_obs_steps = nobs_tensor[..., :-1, :], input_tensor[..., 1:, :]
+    if lengths is not None:
+        mask = torch.arange(nobs_steps.size()[-2], device=lengths.device) < lengths[:, None]-1
+        nobs_steps, next_obs_steps = nobs_steps[mask], next_obs_steps[mask]
+    if not torch.equal(nobs_steps, next_obs_steps):
+        raise ValueError(
+            "input_nobs must be input_obs shifted by one step (see replay.build_shifted_observations), "
+            "only the final next observations are encoded separately"
+        )
+
+
+def packed_step_ids(lengths, seq_length):
+    """
+    Packs the flat ids (episode*seq_length + step) of the real steps of variable length
+    episodes, lengths (batch_size,) holds every episode's number of real steps.
+    Returns the PackedSequence of step ids and, for every packed step, the packed position of
+    the episode's next step. The last step of episode b points at position total_steps + b,
+    where the encodings of the episodes' final next observations are appended.
+    """
+    batch_size = lengths.size()[0]
+    device = lengths.device
+    grid = torch.arange(batch_size*seq_length, device=device).view(batch_size, seq_length)
+    packed_ids = pack_padded_sequence(grid, lengths.cpu(), batch_first=True, enforce_sorted=False)
+
+    step_ids = packed_ids.data
+    num_steps = step_ids.size()[0]
+    positions = torch.zeros(batch_size*seq_length+1, dtype=torch.long, device=device)
+    positions[step_ids] = torch.arange(num_steps, device=device)
+    episodes = torch.div(step_ids, seq_length, rounding_mode="floor")
+    is_last = step_ids - episodes*seq_length + 1 >= lengths[episodes]
+    next_ids = torch.where(is_last, num_steps + episodes, positions[step_ids+1])
+    return packed_ids, next_ids
+
+
+def last_steps(tensor, lengths):
+    # (batch_size, ...) entries of a (batch_size, seq_length, ...) tensor at every episode's last real step
+    return tensor[torch.arange(tensor.size()[0], device=tensor.device), lengths-1]
+
+
+class AgentLoss(nn.Module):
+    """
+    The networks of an agent as one module whose forward() is the agent's compute_losses.
+    Wrappers that act on a module (DistributedDataParallel, torch.func.functional_call)
+    then see every network used by a training step.
+    """
+    def __init__(self, agent):
+        super(AgentLoss, self).__init__()
+        self.encoder = agent.encoder
+        self.decoder = agent.decoder
+        self.value_network = agent.value_network
+        self.target_value_network = agent.target_value_network
+        self.compute_losses = agent.compute_losses
+
+    def forward(self, *tensors):
+        return self.compute_losses(*tensors)
+
+
+class OfflineAHTAgentBase(object):
+    """
+    Networks, optimizer, checkpointing and the training step shared by the agents.
+    Subclasses set the value network's output size, act_step and the loss terms
+    (losses_from_outputs).
+    """
+    # Whether losses_from_outputs takes the decoder logits of the next observations
+    uses_next_logits = False
+
+    def __init__(self, state_size, action_size, human_action_size, layer_size, lstm_dim, encoding_dim, device="cpu", per_step_reset=False, dtype=torch.float32, autocast=False, compile=False, target_update_interval=100, target_tau=1.0, metrics=None):
         self.state_size = state_size
         self.action_size = action_size
         self.human_action_size = human_action_size
@@ -16,160 +165,268 @@ class OfflineAHTAgent(object):
         self.device = device
         self.gamma = 0.99
         self.total_updates = 0
-
-        self.encoder = Encoder(state_size+human_action_size, lstm_dim, encoding_dim).double().to(self.device)
-        self.decoder = Decoder(encoding_dim, layer_size, human_action_size).double().to(self.device)
-
-        self.value_network = DDQN(state_size+human_action_size+encoding_dim, action_size, layer_size).double().to(self.device)
-        self.target_value_network = copy.deepcopy(self.value_network).double().to(self.device)
+        # Training encodes whole sequences with the LSTM state carried across steps,
+        # per_step_reset encodes every step from a zero state like the original training loop
+        self.per_step_reset = per_step_reset
+        # Parameters and inputs are kept in dtype, autocast additionally runs the networks
+        # under bfloat16 autocasting
+        self.dtype = dtype
+        self.use_autocast = autocast
+        # Every target_update_interval updates the target network moves target_tau of the
+        # way to the value network in place, tau=1 copies it like a hard update
+        self.target_update_interval = target_update_interval
+        self.target_tau = target_tau
+        # Phase timings, losses and update counts go to metrics (see metrics.Metrics)
+        self.metrics = NULL_METRICS if metrics is None else metrics
+
+        self.encoder = Encoder(state_size+human_action_size, lstm_dim, encoding_dim).to(self.device, self.dtype)
+        self.decoder = Decoder(encoding_dim, layer_size, human_action_size).to(self.device, self.dtype)
+
+        self.value_network = DDQN(state_size+human_action_size+encoding_dim, self.num_action_values(), layer_size).to(self.device, self.dtype)
+        self.target_value_network = copy.deepcopy(self.value_network).to(self.device, self.dtype)
+        self.target_value_network.requires_grad_(False)
 
         self.optimizer = optim.Adam([*self.encoder.parameters(), *self.decoder.parameters(), *self.value_network.parameters()], lr=1e-4)
-        self.lstm_hiddens_train = None
         self.lstm_hiddens_eval = None
 
+        # The loss computation can be compiled with torch.compile, see compile_loss_fn
+        self.loss_fn = compile_loss_fn(self.compute_losses) if compile else self.compute_losses
+
+    def num_action_values(self):
+        raise NotImplementedError
+
+    def autocast_context(self):
+        return torch.autocast(torch.device(self.device).type, dtype=torch.bfloat16, enabled=self.use_autocast)
+
+    def save(self, path):
+        torch.save({
+            "encoder": self.encoder.state_dict(),
+            "decoder": self.decoder.state_dict(),
+            "value_network": self.value_network.state_dict(),
+            "target_value_network": self.target_value_network.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "total_updates": self.total_updates,
+        }, path)
+
+    def load(self, path):
+        # Checkpoints saved in any precision are converted to this agent's dtype
+        checkpoint = convert_state_dict(torch.load(path, map_location=self.device), self.dtype)
+        self.encoder.load_state_dict(checkpoint["encoder"])
+        self.decoder.load_state_dict(checkpoint["decoder"])
+        self.value_network.load_state_dict(checkpoint["value_network"])
+        self.target_value_network.load_state_dict(checkpoint["target_value_network"])
+        self.optimizer.load_state_dict(checkpoint["optimizer"])
+        self.total_updates = checkpoint["total_updates"]
+
     def act(self, input_obs):
         
-        input_tensor = torch.tensor(input_obs).double().to(self.device)
+        input_tensor = obs_to_tensor(input_obs, self.state_size, self.human_action_size, self.device, self.dtype)
         if self.lstm_hiddens_eval is None:
-            self.lstm_hiddens_eval = (torch.zeros(1, input_tensor.size()[0], self.lstm_dim).double().to(self.device), torch.zeros(1, input_tensor.size()[0], self.lstm_dim).double().to(self.device))
-        rep, self.lstm_hiddens_eval = self.encoder(input_tensor, self.lstm_hiddens_eval)
-        action_vals = self.value_network(torch.cat([input_tensor]))
-
-        return torch.argmax(action_vals, dim=-1)
-
-    def train(self, input_obs, human_actions, ai_actions, input_dones, input_rews, input_nobs):
-        input_tensor = torch.tensor(input_obs).double().to(self.device)
-        human_actions_tensor = torch.tensor(human_actions).double().to(self.device)
-        ai_actions_tensor = torch.tensor(ai_actions).double().to(self.device)
-        dones_tensor = torch.tensor(input_dones).double().to(self.device)
-        rews_tensor = torch.tensor(input_rews).double().to(self.device)
-        nobs_tensor = torch.tensor(input_nobs).double().to(self.device)
-
-        batch_size = input_tensor.size()[0]
-        seq_length = input_tensor.size()[1]
-
-        self.lstm_hiddens_train = (torch.zeros(1, input_tensor.size()[0], self.lstm_dim).double().to(self.device), torch.zeros(1, input_tensor.size()[0], self.lstm_dim).double().to(self.device))
-        predicted_action_logits = []
-        predicted_action_vals = []
-        target_action_vals = []
-        for t in range(seq_length):
-            obs_t = input_tensor[:, t, :]
-            nobs_t = nobs_tensor[:, t, :]
-            rep, self.lstm_hiddens_eval = self.encoder(obs_t, self.lstm_hiddens_train)
-            decoded_action_logits = self.decoder(rep)
-            predicted_action_logits.append(decoded_action_logits.unsqueeze(1))
-            action_vals = self.value_network(torch.cat([obs_t, rep.detach()], dim=-1))
-            predicted_action_vals.append(action_vals.unsqueeze(1))
-
-            updated_rep, _ = self.encoder(nobs_t, self.lstm_hiddens_train)
-            target_action_val = self.target_value_network(torch.cat([nobs_t, updated_rep], dim=-1))
-            target_action_vals.append(target_action_val.unsqueeze(1))
-
-        all_predicted_logits = torch.cat(predicted_action_logits, dim=1)
-        action_dist = dist.OneHotCategorical(logits=all_predicted_logits)
+            self.lstm_hiddens_eval = (
+                torch.zeros(1, input_tensor.size()[0], self.lstm_dim, dtype=self.dtype, device=self.device),
+                torch.zeros(1, input_tensor.size()[0], self.lstm_dim, dtype=self.dtype, device=self.device)
+            )
+        actions, self.lstm_hiddens_eval = self.act_step(input_tensor, self.lstm_hiddens_eval)
+        return actions
+
+    def act_step(self, input_tensor, lstm_hiddens):
+        # Greedy actions for one step of a batch of observations given their LSTM states.
+        # Returns the actions and the updated states, the agent itself keeps no state.
+        raise NotImplementedError
+
+    def encode_next_obs(self, reps, final_hiddens, nobs_tensor):
+        # Encodings of the next observations used by the target network. nobs_t is obs_{t+1},
+        # so all but the last step reuse the encodings already computed for the observations,
+        # only the last next observation goes through the encoder.
+        with torch.no_grad():
+            if self.per_step_reset:
+                last_rep, _ = self.encoder.forward_sequence(nobs_tensor[:, -1:], reset_each_step=True)
+            else:
+                last_rep, _ = self.encoder.forward_sequence(nobs_tensor[:, -1:], final_hiddens)
+        return torch.cat([reps[:, 1:].detach(), last_rep.to(reps.dtype)], dim=1)
+
+    def encode_last_next_obs(self, reps, final_hiddens, last_nobs):
+        # Packed counterpart of encode_next_obs, reps (total_steps, encoding_dim) followed by
+        # the encodings of the episodes' (batch_size, input_dim) final next observations
+        with torch.no_grad():
+            if self.per_step_reset:
+                last_rep, _ = self.encoder.forward_sequence(last_nobs.unsqueeze(1), reset_each_step=True)
+            else:
+                last_rep, _ = self.encoder.forward_sequence(last_nobs.unsqueeze(1), final_hiddens)
+        return torch.cat([reps.detach(), last_rep[:, 0].to(reps.dtype)])
+
+    def compute_losses(self, input_tensor, human_actions_tensor, ai_actions_tensor, dones_tensor, rews_tensor, nobs_tensor, lengths=None):
+        # lengths : (batch_size,) real steps of variable length episodes, see compute_packed_losses.
+        # nobs_tensor must be input_tensor shifted by one step, only the next observation after
+        # every episode's last step is read (see check_next_obs, which train() runs).
+        if lengths is not None:
+            return self.compute_packed_losses(
+                input_tensor, human_actions_tensor, ai_actions_tensor, dones_tensor, rews_tensor, nobs_tensor, lengths
+            )
+
+        n_state_logits = None
+        with self.autocast_context():
+            reps, final_hiddens = self.encoder.forward_sequence(input_tensor, reset_each_step=self.per_step_reset)
+            all_predicted_logits = self.decoder(reps)
+            all_action_vals = self.value_network(torch.cat([input_tensor, reps.detach()], dim=-1))
+
+            updated_reps = self.encode_next_obs(reps, final_hiddens, nobs_tensor)
+            all_target_action_vals = self.target_value_network(torch.cat([nobs_tensor, updated_reps], dim=-1))
+            if self.uses_next_logits:
+                # Decoder outputs for the next observations, shifted like the encodings
+                with torch.no_grad():
+                    last_logits = self.decoder(updated_reps[:, -1:])
+                n_state_logits = torch.cat([all_predicted_logits[:, 1:].detach(), last_logits], dim=1)
+
+        return self.losses_from_outputs(
+            all_predicted_logits, all_action_vals, all_target_action_vals, n_state_logits,
+            human_actions_tensor, ai_actions_tensor, dones_tensor, rews_tensor
+        )
+
+    def compute_packed_losses(self, input_tensor, human_actions_tensor, ai_actions_tensor, dones_tensor, rews_tensor, nobs_tensor, lengths):
+        # Losses over the real steps of padded variable length episodes. The LSTM runs on a
+        # packed sequence and every other network on the (total_steps, ...) real steps, so
+        # padded steps cost nothing and the means are over real steps.
+        packed_ids, next_ids = packed_step_ids(lengths, input_tensor.size()[1])
+        step_ids = packed_ids.data
+
+        def real_steps(tensor):
+            return tensor.flatten(0, 1)[step_ids]
+
+        step_inputs = real_steps(input_tensor)
+        num_steps = step_inputs.size()[0]
+        n_state_logits = None
+        with self.autocast_context():
+            reps, final_hiddens = self.encoder.forward_packed(
+                PackedSequence(step_inputs, *packed_ids[1:]), reset_each_step=self.per_step_reset
+            )
+            all_predicted_logits = self.decoder(reps)
+            all_action_vals = self.value_network(torch.cat([step_inputs, reps.detach()], dim=-1))
+
+            next_reps = self.encode_last_next_obs(reps, final_hiddens, last_steps(nobs_tensor, lengths))
+            all_target_action_vals = self.target_value_network(torch.cat([real_steps(nobs_tensor), next_reps[next_ids]], dim=-1))
+            if self.uses_next_logits:
+                with torch.no_grad():
+                    last_logits = self.decoder(next_reps[num_steps:])
+                n_state_logits = torch.cat([all_predicted_logits.detach(), last_logits])[next_ids]
+
+        return self.losses_from_outputs(
+            all_predicted_logits, all_action_vals, all_target_action_vals, n_state_logits,
+            real_steps(human_actions_tensor), real_steps(ai_actions_tensor), real_steps(dones_tensor),
+            real_steps(rews_tensor)
+        )
+
+    def losses_from_outputs(self, all_predicted_logits, all_action_vals, all_target_action_vals, n_state_logits, human_actions_tensor, ai_actions_tensor, dones_tensor, rews_tensor):
+        # Loss terms from the network outputs of every step, any leading (batch / step) shape.
+        # n_state_logits are the decoder logits of the next observations, None unless
+        # uses_next_logits is set.
+        raise NotImplementedError
+
+    def train(self, input_obs, human_actions, ai_actions, input_dones, input_rews, input_nobs, lengths=None):
+        # lengths : real steps of every episode of a padded batch of variable length episodes.
+        # input_nobs are the input_obs shifted by one step followed by the observation after
+        # the last step, as built by replay.build_shifted_observations, else a ValueError is raised.
+        with self.metrics.timer("batch_assembly"):
+            input_tensor = obs_to_tensor(input_obs, self.state_size, self.human_action_size, self.device, self.dtype)
+            human_actions_tensor = actions_to_tensor(human_actions, self.human_action_size, self.device, self.dtype)
+            ai_actions_tensor = actions_to_tensor(ai_actions, self.action_size, self.device, self.dtype)
+            dones_tensor = torch.as_tensor(input_dones, device=self.device).to(self.dtype)
+            rews_tensor = torch.as_tensor(input_rews, device=self.device).to(self.dtype)
+            nobs_tensor = obs_to_tensor(input_nobs, self.state_size, self.human_action_size, self.device, self.dtype)
+            tensors = (input_tensor, human_actions_tensor, ai_actions_tensor, dones_tensor, rews_tensor, nobs_tensor)
+            if lengths is not None:
+                tensors += (torch.as_tensor(lengths, device=self.device).long(),)
+            check_next_obs(input_tensor, nobs_tensor, *tensors[6:])
+
+        with self.metrics.timer("forward"):
+            enc_dec_loss, usual_q_loss, cql_log_probs_loss = self.loss_fn(*tensors)
+            total_loss = enc_dec_loss+usual_q_loss+cql_log_probs_loss
+        self.metrics.record("enc_dec_loss", enc_dec_loss)
+        self.metrics.record("q_loss", usual_q_loss)
+        self.metrics.record("cql_loss", cql_log_probs_loss)
+
+        self.optimizer.zero_grad()
+        with self.metrics.timer("backward"):
+            total_loss.backward()
+        with self.metrics.timer("optimizer"):
+            self.optimizer.step()
+        
+        self.total_updates += 1
+        self.metrics.count("updates")
+        if self.total_updates % self.target_update_interval == 0:
+            with self.metrics.timer("target_sync"):
+                sync_target_network(self.target_value_network, self.value_network, self.target_tau)
+        self.metrics.step()
+
+
+class OfflineAHTAgent(OfflineAHTAgentBase):
+    def num_action_values(self):
+        return self.action_size
+
+    def act_step(self, input_tensor, lstm_hiddens):
+        with self.autocast_context():
+            rep, updated_hiddens = self.encoder(input_tensor, lstm_hiddens)
+            action_vals = self.value_network(torch.cat([input_tensor, rep.detach()], dim=-1))
+
+        return torch.argmax(action_vals, dim=-1), updated_hiddens
+
+    def losses_from_outputs(self, all_predicted_logits, all_action_vals, all_target_action_vals, n_state_logits, human_actions_tensor, ai_actions_tensor, dones_tensor, rews_tensor):
+        all_predicted_logits = all_predicted_logits.to(self.dtype)
+        all_action_vals = all_action_vals.to(self.dtype)
+        all_target_action_vals = all_target_action_vals.to(self.dtype)
+
+        # Argument validation is data dependent control flow, which torch.func.vmap can't trace
+        action_dist = dist.OneHotCategorical(logits=all_predicted_logits, validate_args=False)
         action_log_probs = action_dist.log_prob(human_actions_tensor)
 
         enc_dec_loss = -action_log_probs.mean()
 
         selected_action = ai_actions_tensor.argmax(dim=-1).unsqueeze(dim=-1)
-        all_predicted_vals = torch.cat(predicted_action_vals, dim=1).gather(-1, selected_action)
-        all_target_vals, _ = torch.cat(target_action_vals, dim=1).max(dim=-1)
+        all_predicted_vals = all_action_vals.gather(-1, selected_action)
+        all_target_vals, _ = all_target_action_vals.max(dim=-1)
 
         target_vals = rews_tensor.unsqueeze(-1) + self.gamma * (1-dones_tensor.unsqueeze(-1)) * all_target_vals.unsqueeze(-1)
         usual_q_loss = ((all_predicted_vals - target_vals.detach())**2).mean()
 
-        cql_prob_dist =  dist.OneHotCategorical(logits=torch.cat(predicted_action_vals, dim=1))
+        cql_prob_dist =  dist.OneHotCategorical(logits=all_action_vals, validate_args=False)
         cql_log_probs_loss = -cql_prob_dist.log_prob(ai_actions_tensor).mean()
 
-        total_loss = enc_dec_loss+usual_q_loss+cql_log_probs_loss
-        print("Losses : ",enc_dec_loss, usual_q_loss, cql_log_probs_loss)
-
-        
-        self.optimizer.zero_grad()
-        total_loss.backward()
-        self.optimizer.step()
-        
-        self.total_updates += 1
-        if self.total_updates % 100 == 0:
-            self.target_value_network = copy.deepcopy(self.value_network).double().to(self.device)
-            
-
-class OfflineAHTAgentV2(object):
-    def __init__(self, state_size, action_size, human_action_size, layer_size, lstm_dim, encoding_dim, device="cpu"):
-        self.state_size = state_size
-        self.action_size = action_size
-        self.human_action_size = human_action_size
-        self.layer_size = layer_size
-        self.lstm_dim = lstm_dim
-        self.encoding_dim = encoding_dim
-        self.device = device
-        self.gamma = 0.99
-        self.total_updates = 0
+        return enc_dec_loss, usual_q_loss, cql_log_probs_loss
 
-        self.encoder = Encoder(state_size+human_action_size, lstm_dim, encoding_dim).double().to(self.device)
-        self.decoder = Decoder(encoding_dim, layer_size, human_action_size).double().to(self.device)
 
-        self.value_network = DDQN(state_size+human_action_size+encoding_dim, action_size*human_action_size, layer_size).double().to(self.device)
-        self.target_value_network = copy.deepcopy(self.value_network).double().to(self.device)
+class OfflineAHTAgentV2(OfflineAHTAgentBase):
+    # Q-values over joint (AI advice, human decision) actions, aggregated with the decoder's
+    # human decision probabilities
+    uses_next_logits = True
 
-        self.optimizer = optim.Adam([*self.encoder.parameters(), *self.decoder.parameters(), *self.value_network.parameters()], lr=1e-4)
-        self.lstm_hiddens_train = None
-        self.lstm_hiddens_eval = None
+    def num_action_values(self):
+        return self.action_size*self.human_action_size
 
-    def act(self, input_obs):
-        
-        input_tensor = torch.tensor(input_obs).double().to(self.device)
-        if self.lstm_hiddens_eval is None:
-            self.lstm_hiddens_eval = (torch.zeros(1, input_tensor.size()[0], self.lstm_dim).double().to(self.device), torch.zeros(1, input_tensor.size()[0], self.lstm_dim).double().to(self.device))
-        rep, self.lstm_hiddens_eval = self.encoder(input_tensor, self.lstm_hiddens_eval)
-        action_vals = self.value_network(torch.cat([input_tensor, rep.detach()], dim=-1))
+    def act_step(self, input_tensor, lstm_hiddens):
+        with self.autocast_context():
+            rep, updated_hiddens = self.encoder(input_tensor, lstm_hiddens)
+            action_vals = self.value_network(torch.cat([input_tensor, rep.detach()], dim=-1))
+            human_action_logits = self.decoder(rep.detach())
 
-        reshaped_action_vals = action_vals.view(-1, self.action_size, self.human_action_size)
-        human_action_logits = self.decoder(rep.detach()).unsqueeze(-1).repeat(1, self.action_size, 1)
-        human_action_probs = F.softmax(human_action_logits, dim=-1)
+        reshaped_action_vals = action_vals.to(self.dtype).view(-1, self.action_size, self.human_action_size)
+        human_action_probs = F.softmax(human_action_logits.to(self.dtype), dim=-1).unsqueeze(1)
 
         # aggregated q-vals
         aggregated_q_val = (reshaped_action_vals*human_action_probs).sum(dim=-1)
-        return torch.argmax(aggregated_q_val, dim=-1)
-
-    def train(self, input_obs, human_actions, ai_actions, input_dones, input_rews, input_nobs):
-        input_tensor = torch.tensor(input_obs).double().to(self.device)
-        human_actions_tensor = torch.tensor(human_actions).double().to(self.device)
-        ai_actions_tensor = torch.tensor(ai_actions).double().to(self.device)
-        dones_tensor = torch.tensor(input_dones).double().to(self.device)
-        rews_tensor = torch.tensor(input_rews).double().to(self.device)
-        nobs_tensor = torch.tensor(input_nobs).double().to(self.device)
-
-        batch_size = input_tensor.size()[0]
-        seq_length = input_tensor.size()[1]
-
-        self.lstm_hiddens_train = (torch.zeros(1, input_tensor.size()[0], self.lstm_dim).double().to(self.device), torch.zeros(1, input_tensor.size()[0], self.lstm_dim).double().to(self.device))
-        predicted_action_logits = []
-        predicted_action_vals = []
-        target_action_vals = []
-        act_probs = []
-
-        for t in range(seq_length):
-            obs_t = input_tensor[:, t, :]
-            nobs_t = nobs_tensor[:, t, :]
-            rep, self.lstm_hiddens_eval = self.encoder(obs_t, self.lstm_hiddens_train)
-            decoded_action_logits = self.decoder(rep)
-
-            predicted_action_logits.append(decoded_action_logits.unsqueeze(1))
-            action_vals = self.value_network(torch.cat([obs_t, rep.detach()], dim=-1))
-            predicted_action_vals.append(action_vals.unsqueeze(1))
-
-            updated_rep, _ = self.encoder(nobs_t, self.lstm_hiddens_train)
-            joint_target_action_val = self.target_value_network(torch.cat([nobs_t, updated_rep], dim=-1))
-            n_state_logits = self.decoder(updated_rep.detach()).unsqueeze(1).repeat(1, self.action_size, 1)
-            human_action_probs = F.softmax(n_state_logits, dim=-1)
-
-            target_action_val = (joint_target_action_val.view(-1, self.action_size, self.human_action_size) * human_action_probs).sum(dim=-1)
-            target_action_vals.append(target_action_val.unsqueeze(1))
+        return torch.argmax(aggregated_q_val, dim=-1), updated_hiddens
+
+    def losses_from_outputs(self, all_predicted_logits, all_action_vals, joint_target_action_vals, n_state_logits, human_actions_tensor, ai_actions_tensor, dones_tensor, rews_tensor):
+        all_predicted_logits = all_predicted_logits.to(self.dtype)
+        all_action_vals = all_action_vals.to(self.dtype)
+        joint_target_action_vals = joint_target_action_vals.to(self.dtype)
+        human_action_probs = F.softmax(n_state_logits.to(self.dtype), dim=-1).unsqueeze(-2)
+        joint_shape = all_action_vals.size()[:-1] + (self.action_size, self.human_action_size)
+
+        all_target_action_vals = (joint_target_action_vals.view(joint_shape) * human_action_probs).sum(dim=-1)
 
         # Compute encoder-decoder loss
-        all_predicted_logits = torch.cat(predicted_action_logits, dim=1)
-        action_dist = dist.OneHotCategorical(logits=all_predicted_logits)
+        # Argument validation is data dependent control flow, which torch.func.vmap can't trace
+        action_dist = dist.OneHotCategorical(logits=all_predicted_logits, validate_args=False)
         action_log_probs = action_dist.log_prob(human_actions_tensor)
         enc_dec_loss = -action_log_probs.mean()
 
@@ -178,31 +435,18 @@ class OfflineAHTAgentV2(object):
         human_selected_action = human_actions_tensor.argmax(dim=-1).unsqueeze(dim=-1)
         selected_action = ai_selected_action*self.human_action_size + human_selected_action
 
-        all_predicted_vals = torch.cat(predicted_action_vals, dim=1).gather(-1, selected_action)
-        all_target_vals, _ = torch.cat(target_action_vals, dim=1).max(dim=-1)
+        all_predicted_vals = all_action_vals.gather(-1, selected_action)
+        all_target_vals, _ = all_target_action_vals.max(dim=-1)
 
         target_vals = rews_tensor.unsqueeze(-1) + self.gamma * (1-dones_tensor.unsqueeze(-1)) * all_target_vals.unsqueeze(-1)
         usual_q_loss = ((all_predicted_vals - target_vals.detach())**2).mean()
 
         # Add CQL regularizer
-        reshaped_q_vals = torch.cat(predicted_action_vals, dim=1).view(
-            -1, seq_length, self.action_size, self.human_action_size
-        )
-        repeated_predicted_probs = F.softmax(all_predicted_logits.unsqueeze(2).repeat(1, 1, self.action_size, 1)).detach()
-        all_q_vals = (reshaped_q_vals*repeated_predicted_probs).sum(dim=-1)
+        reshaped_q_vals = all_action_vals.view(joint_shape)
+        predicted_probs = F.softmax(all_predicted_logits, dim=-1).unsqueeze(-2).detach()
+        all_q_vals = (reshaped_q_vals*predicted_probs).sum(dim=-1)
         
-        cql_prob_dist =  dist.OneHotCategorical(logits=all_q_vals)
+        cql_prob_dist =  dist.OneHotCategorical(logits=all_q_vals, validate_args=False)
         cql_log_probs_loss = -cql_prob_dist.log_prob(ai_actions_tensor).mean()
 
-        total_loss = enc_dec_loss+usual_q_loss+cql_log_probs_loss
-        print("Losses : ",enc_dec_loss, usual_q_loss, cql_log_probs_loss)
-
-        self.optimizer.zero_grad()
-        total_loss.backward()
-        self.optimizer.step()
-        
-        self.total_updates += 1
-        if self.total_updates % 100 == 0:
-            self.target_value_network = copy.deepcopy(self.value_network).double().to(self.device)
-            
-
+        return enc_dec_loss, usual_q_loss, cql_log_probs_loss
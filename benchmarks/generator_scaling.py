@@ -0,0 +1,89 @@
+"""
+Generator scaling over vocabulary sizes and horizons.
+
+Builds synthetic specs with random tables for a growing number of cases (and optionally
+types and trust levels) and measures generate_data time per episode step. With the
+compiled tables the per step cost should stay flat as the vocabularies grow.
+
+    python benchmarks/generator_scaling.py --num-cases 15 100 1000 10000 --interaction-length 500
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from MarkovDataGenerator import MarkovDataGenerator
+
+
+def synthetic_spec(num_cases, num_types=3, num_trust=3, schedule="random", seed=0):
+    # Spec with Dirichlet random tables, every case gets its own advice, outcome and acceptance rows
+    rng = np.random.default_rng(seed)
+    num_advice, num_decisions, num_outcomes = 3, 2, 2
+    return {
+        "type_vals": [str(type_id+1) for type_id in range(num_types)],
+        "trust_vals": ["L" + str(level) for level in range(num_trust)],
+        "ai_advice_vals": ["X", "Y", "W"],
+        "human_answer_values": ["X", "Y"],
+        "case_data_vals": ["T" + str(case_id+1) for case_id in range(num_cases)],
+        "outcome_vals": ["G", "B"],
+        "num_case_features": 2,
+        "type_probs": rng.dirichlet(np.ones(num_types)),
+        "init_trust_prior": rng.dirichlet(np.ones(num_trust), size=num_types),
+        "ai_advice_probs": rng.dirichlet(np.ones(num_advice), size=num_cases),
+        "outcome_probs": rng.dirichlet(np.ones(num_outcomes), size=(num_cases, num_decisions)),
+        "acceptance_probs": rng.dirichlet(
+            np.ones(num_decisions), size=(num_types, num_cases, num_advice, num_trust)
+        ),
+        "trust_update_rates": rng.uniform(0.2, 0.8, size=(num_types, num_cases)),
+        "outcome_blind_cases": rng.random((num_types, num_cases)) < 0.2,
+        "case_schedule": schedule,
+        "case_feature_offsets": rng.integers(0, 3, size=num_cases),
+    }
+
+
+def seconds_per_step(generator, num_data, interaction_length, repeats):
+    timings = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        generator.generate_data(num_data, interaction_length, seed=repeat)
+        timings.append(time.perf_counter() - start)
+    return min(timings) / interaction_length
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-cases", type=int, nargs="+", default=[15, 100, 1000, 10000])
+    parser.add_argument("--num-types", type=int, default=3)
+    parser.add_argument("--num-trust", type=int, default=3)
+    parser.add_argument("--schedule", choices=["cycle", "random"], default="random")
+    parser.add_argument("--num-data", type=int, default=10000)
+    parser.add_argument("--interaction-length", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for num_cases in args.num_cases:
+        start = time.perf_counter()
+        generator = MarkovDataGenerator(synthetic_spec(num_cases, args.num_types, args.num_trust, args.schedule))
+        load_seconds = time.perf_counter() - start
+        step_seconds = seconds_per_step(generator, args.num_data, args.interaction_length, args.repeats)
+        results.append({
+            "num_cases": num_cases, "load_seconds": load_seconds, "step_seconds": step_seconds,
+            "ns_per_episode_step": step_seconds / args.num_data * 1e9,
+        })
+        print("C={:<6} load {:.3f}s, {:.2f} ms/step, {:.1f} ns per episode step".format(
+            num_cases, load_seconds, step_seconds * 1e3, step_seconds / args.num_data * 1e9
+        ))
+
+    if args.json is not None:
+        with open(args.json, "w") as json_file:
+            json.dump({"config": vars(args), "results": results}, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
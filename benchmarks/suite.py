@@ -0,0 +1,264 @@
+"""
+Performance benchmark suite.
+
+Measures generate_data scaling over episodes and interaction length, and over the case
+vocabulary with synthetic specs (see generator_scaling.py), to_vector_form
+throughput and peak memory, train() updates/sec of both agents over batch and network
+sizes, and act() latency over batch sizes. Results are written as JSON, and a run can be
+compared against a stored baseline, failing when a benchmark is worse than the baseline by
+more than the threshold.
+
+    python benchmarks/suite.py --preset quick --output results.json
+    python benchmarks/suite.py --preset quick --compare baseline.json --threshold 0.15
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from MarkovDataGenerator import MarkovDataGenerator
+from agent import OfflineAHTAgent, OfflineAHTAgentV2
+from replay import OfflineDataset
+from generator_scaling import synthetic_spec
+
+AGENTS = {"v1": OfflineAHTAgent, "v2": OfflineAHTAgentV2}
+
+PRESETS = {
+    "quick": {
+        "generate": {"num_data": [1000, 10000], "interaction_length": [15]},
+        "vectorize": {"num_data": [10000], "encodings": [("onehot", "float64"), ("index", "float32")]},
+        "train": {"batch_size": [128], "sizes": [(64, 64, 32)], "updates": 30},
+        "act": {"batch_size": [1, 64, 4096], "steps": 15},
+        "scaling": {"num_cases": [1000], "interaction_length": 100, "num_data": 1000},
+        "repeats": 3,
+    },
+    "full": {
+        "generate": {"num_data": [1000, 10000, 100000, 1000000], "interaction_length": [15, 50]},
+        "vectorize": {
+            "num_data": [10000, 100000],
+            "encodings": [("onehot", "float64"), ("onehot", "float32"), ("onehot", "uint8"), ("index", "float32")],
+        },
+        "train": {"batch_size": [32, 128, 512], "sizes": [(64, 64, 32), (256, 256, 64)], "updates": 50},
+        "act": {"batch_size": [1, 16, 256, 1024, 4096], "steps": 15},
+        "scaling": {"num_cases": [15, 1000, 10000], "interaction_length": 500, "num_data": 10000},
+        "repeats": 5,
+    },
+}
+
+
+def timed(fn, repeats, min_seconds=0.05):
+    # Best wall time of one call over repeats samples (least disturbed by other load),
+    # fast calls are looped within a sample until it takes at least min_seconds
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            break
+        number *= 10
+    timings = [elapsed / number]
+    for _ in range(repeats-1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter() - start) / number)
+    return min(timings)
+
+
+def result(value, unit, higher_is_better):
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def bench_generate(generator, config, repeats):
+    results = {}
+    for interaction_length in config["interaction_length"]:
+        for num_data in config["num_data"]:
+            # Large runs are only repeated once
+            seconds = timed(
+                lambda: generator.generate_data(num_data, interaction_length, seed=0),
+                repeats if num_data <= 100000 else 1
+            )
+            name = "generate_data/N={}/T={}".format(num_data, interaction_length)
+            results[name] = result(num_data / seconds, "episodes/s", True)
+    return results
+
+
+def bench_vectorize(generator, config, repeats):
+    results = {}
+    for num_data in config["num_data"]:
+        data = generator.remove_latent_vars(generator.generate_data(num_data, 15, seed=0))
+        for encoding, dtype in config["encodings"]:
+            name = "to_vector_form/N={}/{}-{}".format(num_data, encoding, dtype)
+            seconds = timed(lambda: generator.to_vector_form(data, encoding=encoding, dtype=np.dtype(dtype)), repeats)
+            tracemalloc.start()
+            arrays = generator.to_vector_form(data, encoding=encoding, dtype=np.dtype(dtype))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            del arrays
+            results[name + "/throughput"] = result(num_data / seconds, "episodes/s", True)
+            results[name + "/peak_memory"] = result(peak / 2**20, "MiB", False)
+    return results
+
+
+def make_agent(agent_name, generator, sizes):
+    torch.manual_seed(0)
+    layer_size, lstm_dim, encoding_dim = sizes
+    return AGENTS[agent_name](
+        len(generator.case_data_vals), len(generator.ai_advice_vals), len(generator.human_answer_values),
+        layer_size, lstm_dim, encoding_dim
+    )
+
+
+def bench_train(generator, config, repeats):
+    results = {}
+    dataset = OfflineDataset.from_data(generator, generator.generate_data(4096, 15, seed=0), seed=0)
+    for agent_name in sorted(AGENTS):
+        for sizes in config["sizes"]:
+            for batch_size in config["batch_size"]:
+                agent = make_agent(agent_name, generator, sizes)
+                batches = [dataset.sample(batch_size) for _ in range(config["updates"])]
+
+                def run():
+                    for batch in batches:
+                        agent.train(*batch)
+
+                # One untimed pass warms up allocator and kernels
+                run()
+                seconds = timed(run, repeats)
+                name = "train/{}/hidden={}/B={}".format(agent_name, "x".join(str(size) for size in sizes), batch_size)
+                results[name] = result(config["updates"] / seconds, "updates/s", True)
+    return results
+
+
+def bench_act(generator, config, repeats):
+    results = {}
+    rng = np.random.default_rng(0)
+    num_cases, num_decisions = len(generator.case_data_vals), len(generator.human_answer_values)
+    for agent_name in sorted(AGENTS):
+        agent = make_agent(agent_name, generator, (64, 64, 32))
+        for batch_size in config["batch_size"]:
+            obs = np.stack([
+                rng.integers(num_cases, size=(config["steps"], batch_size)),
+                rng.integers(-1, num_decisions, size=(config["steps"], batch_size)),
+            ], axis=-1).astype(np.int8)
+
+            def run():
+                # One episode of act() calls from a fresh recurrent state
+                agent.lstm_hiddens_eval = None
+                for step_obs in obs:
+                    agent.act(step_obs)
+
+            run()
+            seconds = timed(run, repeats)
+            name = "act/{}/B={}".format(agent_name, batch_size)
+            results[name] = result(seconds / config["steps"] * 1e3, "ms/step", False)
+    return results
+
+
+def bench_scaling(generator, config, repeats):
+    # Episode steps per second with random case schedules over growing case vocabularies
+    results = {}
+    num_data, interaction_length = config["num_data"], config["interaction_length"]
+    for num_cases in config["num_cases"]:
+        scaled_generator = MarkovDataGenerator(synthetic_spec(num_cases))
+        seconds = timed(lambda: scaled_generator.generate_data(num_data, interaction_length, seed=0), repeats)
+        name = "generate_data/C={}/N={}/T={}".format(num_cases, num_data, interaction_length)
+        results[name] = result(num_data * interaction_length / seconds, "episode steps/s", True)
+    return results
+
+
+BENCHMARKS = [
+    ("generate", bench_generate),
+    ("vectorize", bench_vectorize),
+    ("train", bench_train),
+    ("act", bench_act),
+    ("scaling", bench_scaling),
+]
+
+
+def compare(results, baseline, threshold):
+    """
+    Relative change of every benchmark present in both runs, positive when worse.
+    Returns the rows and the names of benchmarks worse than the baseline by more than threshold.
+    """
+    rows = []
+    regressions = []
+    for name, current in sorted(results.items()):
+        if name not in baseline:
+            continue
+        base_value = baseline[name]["value"]
+        change = (current["value"] - base_value) / base_value
+        if current["higher_is_better"]:
+            change = -change
+        rows.append((name, base_value, current["value"], current["unit"], change))
+        if change > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="quick")
+    parser.add_argument("--only", nargs="+", choices=[name for name, _ in BENCHMARKS], help="Run only these groups")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Baseline JSON file written by an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Allowed relative slowdown")
+    parser.add_argument("--threads", type=int, help="torch intra-op threads")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    config = PRESETS[args.preset]
+    generator = MarkovDataGenerator()
+
+    results = {}
+    for group, bench in BENCHMARKS:
+        if args.only is not None and group not in args.only:
+            continue
+        group_results = bench(generator, config[group], config["repeats"])
+        for name, value in group_results.items():
+            print("{:<60} {:>14.4g} {}".format(name, value["value"], value["unit"]))
+        results.update(group_results)
+
+    report = {
+        "meta": {
+            "preset": args.preset,
+            "time": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "torch": torch.__version__,
+            "threads": torch.get_num_threads(),
+        },
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        rows, regressions = compare(results, baseline["results"], args.threshold)
+        print()
+        # Positive changes are improvements, for either direction of metric
+        print("{:<60} {:>12} {:>12} {:>8}".format("benchmark", "baseline", "current", "better"))
+        for name, base_value, value, unit, change in rows:
+            flag = "  REGRESSION" if name in regressions else ""
+            print("{:<60} {:>12.4g} {:>12.4g} {:>+7.1%}{}".format(name, base_value, value, -change, flag))
+        if regressions:
+            print("{} benchmark(s) regressed by more than {:.0%}".format(len(regressions), args.threshold))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Training step throughput of the offline agents.
+
+Measures updates/sec of train() in eager and torch.compile mode, and the cost of a
+target network sync done with deepcopy (the old behaviour) versus in-place copies
+and Polyak averaging. With --stop-prob the episodes end early with that probability after
+every step, and packed training on the real steps is compared to training on the padded
+batches.
+
+    python benchmarks/train_step.py --agent v2 --batch-size 128 --updates 300
+    python benchmarks/train_step.py --stop-prob 0.1 --interaction-length 100 --no-compile
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from MarkovDataGenerator import MarkovDataGenerator, default_spec
+from agent import OfflineAHTAgent, OfflineAHTAgentV2, sync_target_network
+from replay import OfflineDataset
+
+AGENTS = {"v1": OfflineAHTAgent, "v2": OfflineAHTAgentV2}
+
+
+def make_agent(args, generator, compile=False):
+    torch.manual_seed(0)
+    return AGENTS[args.agent](
+        len(generator.case_data_vals), len(generator.ai_advice_vals), len(generator.human_answer_values),
+        args.layer_size, args.lstm_dim, args.encoding_dim, compile=compile
+    )
+
+
+def updates_per_sec(agent, batches, warmup):
+    for batch in batches[:warmup]:
+        agent.train(*batch)
+    start = time.perf_counter()
+    for batch in batches[warmup:]:
+        agent.train(*batch)
+    elapsed = time.perf_counter() - start
+    return (len(batches) - warmup) / elapsed
+
+
+def target_sync_time(agent, repeats):
+    # Seconds per sync for each way of updating the target network
+    timings = {}
+    start = time.perf_counter()
+    for _ in range(repeats):
+        agent.target_value_network = copy.deepcopy(agent.value_network).to(agent.device, agent.dtype)
+    timings["deepcopy"] = (time.perf_counter() - start) / repeats
+    for name, tau in [("copy", 1.0), ("polyak", 0.005)]:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            sync_target_network(agent.target_value_network, agent.value_network, tau)
+        timings[name] = (time.perf_counter() - start) / repeats
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--agent", choices=sorted(AGENTS), default="v2")
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--interaction-length", type=int, default=15)
+    parser.add_argument("--layer-size", type=int, default=64)
+    parser.add_argument("--lstm-dim", type=int, default=64)
+    parser.add_argument("--encoding-dim", type=int, default=32)
+    parser.add_argument("--updates", type=int, default=300)
+    parser.add_argument("--warmup", type=int, default=30)
+    parser.add_argument("--sync-repeats", type=int, default=200)
+    parser.add_argument("--no-compile", action="store_true", help="Skip the torch.compile measurement")
+    parser.add_argument("--stop-prob", type=float, default=0.0, help="Per step termination probability")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    spec = default_spec()
+    if args.stop_prob > 0:
+        spec["termination"] = {"stop_probs": args.stop_prob}
+    generator = MarkovDataGenerator(spec)
+    data = generator.generate_data(max(args.batch_size * 8, 1024), args.interaction_length, seed=0)
+    dataset = OfflineDataset.from_data(generator, data, seed=0)
+    batches = [dataset.sample(args.batch_size) for _ in range(args.warmup + args.updates)]
+
+    results = {"config": vars(args), "torch": torch.__version__, "threads": torch.get_num_threads()}
+    results["eager_updates_per_sec"] = updates_per_sec(make_agent(args, generator), batches, args.warmup)
+    if dataset.lengths is not None:
+        # Same batches without their lengths, every padded step goes through the networks
+        results["mean_length"] = float(dataset.lengths.float().mean())
+        results["padded_updates_per_sec"] = updates_per_sec(
+            make_agent(args, generator), [batch[:-1] for batch in batches], args.warmup
+        )
+    if not args.no_compile:
+        results["compiled_updates_per_sec"] = updates_per_sec(
+            make_agent(args, generator, compile=True), batches, args.warmup
+        )
+    results["target_sync_seconds"] = target_sync_time(make_agent(args, generator), args.sync_repeats)
+
+    print("eager : {:.1f} updates/sec".format(results["eager_updates_per_sec"]))
+    if "padded_updates_per_sec" in results:
+        print("padded : {:.1f} updates/sec (mean episode length {:.1f})".format(
+            results["padded_updates_per_sec"], results["mean_length"]
+        ))
+    if "compiled_updates_per_sec" in results:
+        print("compiled : {:.1f} updates/sec".format(results["compiled_updates_per_sec"]))
+    for name, seconds in results["target_sync_seconds"].items():
+        print("target sync ({}) : {:.1f} us".format(name, seconds * 1e6))
+
+    if args.json is not None:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+import numpy as np
+from storage import DatasetWriter, load_dataset
+
+# Bump when a change to the generator alters the data produced from the same tables and seed
+CACHE_VERSION = 1
+META_NAME = "meta.json"
+TMP_PREFIX = "tmp-"
+VECTOR_NAMES = ["obs", "ai_acts", "human_acts", "dones", "rews"]
+
+
+class DatasetCache(object):
+    """
+    Content addressed cache in front of MarkovDataGenerator.generate_data / to_vector_form.
+    Entries are keyed on a hash of the generator tables and the call arguments, and live in
+    one directory each under cache_dir. Least recently used entries are deleted once the
+    cache grows beyond max_bytes. Unseeded calls are never cached.
+    Entries are built in tmp-* directories. The ones left behind by crashed builds are removed
+    when the cache is opened and on eviction, once nothing in them changed for tmp_max_age
+    seconds (builds of other processes may still be writing to younger ones).
+    """
+    def __init__(self, cache_dir, max_bytes=4*1024**3, tmp_max_age=24*3600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.tmp_max_age = tmp_max_age
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0.0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.sweep_tmp_dirs()
+
+    def cache_key(self, generator, kind, num_data, interaction_length, seed):
+        payload = {
+            "version": CACHE_VERSION,
+            "kind": kind,
+            "tables": generator.table_spec(),
+            "seed_block_size": generator.seed_block_size,
+            "num_data": num_data,
+            "interaction_length": interaction_length,
+            "seed": seed,
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def get_data(self, generator, num_data, interaction_length, seed=None):
+        # Memory mapped episodes, see storage.load_dataset
+        if seed is None:
+            return generator.generate_data(num_data, interaction_length)
+
+        def generate(entry_dir):
+            data = generator.generate_data(num_data, interaction_length, seed=seed)
+            with DatasetWriter(entry_dir, generator.episode_vocabs) as writer:
+                writer.write(data)
+
+        start = time.perf_counter()
+        entry_dir, hit_meta = self.lookup(self.cache_key(generator, "episodes", num_data, interaction_length, seed), generate)
+        data = load_dataset(entry_dir)
+        self.record_hit(hit_meta, start)
+        return data
+
+    def get_vector_form(self, generator, num_data, interaction_length, seed=None, mmap_mode=None):
+        # Same arrays as generator.to_vector_form(generator.remove_latent_vars(generator.generate_data(...)))
+        if seed is None:
+            return generator.to_vector_form(generator.remove_latent_vars(generator.generate_data(num_data, interaction_length)))
+
+        def generate(entry_dir):
+            data = generator.generate_data(num_data, interaction_length, seed=seed)
+            arrays = generator.to_vector_form(generator.remove_latent_vars(data))
+            for name, array in zip(VECTOR_NAMES, arrays):
+                np.save(os.path.join(entry_dir, name + ".npy"), array)
+
+        start = time.perf_counter()
+        entry_dir, hit_meta = self.lookup(self.cache_key(generator, "vector", num_data, interaction_length, seed), generate)
+        arrays = tuple(np.load(os.path.join(entry_dir, name + ".npy"), mmap_mode=mmap_mode) for name in VECTOR_NAMES)
+        self.record_hit(hit_meta, start)
+        return arrays
+
+    def lookup(self, key, generate):
+        # Returns the entry directory and, on a hit, the entry meta data
+        entry_dir = os.path.join(self.cache_dir, key)
+        meta_path = os.path.join(entry_dir, META_NAME)
+        if os.path.exists(meta_path):
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            # The meta file modification time is the LRU clock
+            os.utime(meta_path)
+            return entry_dir, meta
+
+        # Build the entry next to its final location and rename it in, so concurrent
+        # readers never see a partial entry
+        tmp_dir = os.path.join(self.cache_dir, TMP_PREFIX + uuid.uuid4().hex)
+        os.makedirs(tmp_dir)
+        start = time.perf_counter()
+        try:
+            generate(tmp_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        meta = {"generation_time": time.perf_counter() - start, "bytes": directory_size(tmp_dir)}
+        with open(os.path.join(tmp_dir, META_NAME), "w") as meta_file:
+            json.dump(meta, meta_file)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict(keep=key)
+        return entry_dir, None
+
+    def record_hit(self, hit_meta, start):
+        if hit_meta is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.time_saved += max(hit_meta["generation_time"] - (time.perf_counter() - start), 0.0)
+
+    def tmp_dirs(self):
+        return [
+            os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.startswith(TMP_PREFIX)
+        ]
+
+    def sweep_tmp_dirs(self):
+        # Removes the build directories nothing was written to for tmp_max_age seconds
+        now = time.time()
+        for tmp_dir in self.tmp_dirs():
+            try:
+                age = now - last_modified(tmp_dir)
+            except OSError:
+                # Renamed into place or removed meanwhile
+                continue
+            if age > self.tmp_max_age:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def entries(self):
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            meta_path = os.path.join(self.cache_dir, key, META_NAME)
+            if not os.path.exists(meta_path):
+                continue
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            entries.append((os.path.getmtime(meta_path), key, meta["bytes"]))
+        return entries
+
+    def evict(self, keep=None):
+        self.sweep_tmp_dirs()
+        entries = sorted(self.entries())
+        total_bytes = sum(entry[2] for entry in entries)
+        for _, key, num_bytes in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            total_bytes -= num_bytes
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "time_saved": self.time_saved,
+            "bytes": sum(entry[2] for entry in self.entries()),
+            # Entries being built, or left by crashed builds not yet swept
+            "tmp_bytes": sum(directory_size(tmp_dir) for tmp_dir in self.tmp_dirs()),
+        }
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            total += os.path.getsize(os.path.join(root, file_name))
+    return total
+
+
+def last_modified(path):
+    # Latest modification time of a directory and everything in it
+    latest = os.path.getmtime(path)
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            latest = max(latest, os.path.getmtime(os.path.join(root, name)))
+    return latest
@@ -0,0 +1,97 @@
+import argparse
+import os
+import time
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from MarkovDataGenerator import MarkovDataGenerator
+from agent import AgentLoss, OfflineAHTAgentV2
+from cache import DatasetCache
+from metrics import Metrics, StdoutSink
+from replay import OfflineDataset
+
+
+def make_distributed(agent):
+    """
+    Routes agent.train() through DistributedDataParallel, the process group has to be
+    initialised. The networks are broadcast from rank 0 on wrapping, the target network is
+    then copied from the value network, so all ranks start equal. Gradients of the encoder,
+    decoder and value network are averaged, so every rank takes the same optimizer steps and
+    target updates and the target networks stay in sync.
+    The agent's own modules are left unwrapped, agent.save() writes ordinary checkpoints.
+    """
+    ddp_loss = DistributedDataParallel(AgentLoss(agent))
+    with torch.no_grad():
+        for target_param, param in zip(agent.target_value_network.parameters(), agent.value_network.parameters()):
+            target_param.copy_(param)
+    agent.loss_fn = ddp_loss
+    return ddp_loss
+
+
+def shard_rows(num_episodes, rank, world_size):
+    # Episodes of rank's dataset shard, every episode belongs to exactly one rank
+    return np.arange(rank, num_episodes, world_size)
+
+
+def train_worker(rank, world_size, args):
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", str(args.port))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    # Without this every rank would start one thread per core
+    torch.set_num_threads(args.threads_per_rank)
+    torch.manual_seed(args.seed)
+
+    metrics = Metrics([StdoutSink()], interval=args.log_interval) if rank == 0 else None
+    hmm = MarkovDataGenerator()
+    dataset = DatasetCache(args.cache_dir).get_data(hmm, args.num_data, args.interaction_length, seed=args.seed)
+    replay = OfflineDataset.from_data(
+        hmm, dataset[shard_rows(len(dataset), rank, world_size)], seed=args.seed + rank
+    )
+
+    ego_agent = OfflineAHTAgentV2(
+        len(hmm.case_data_vals), len(hmm.ai_advice_vals), len(hmm.human_answer_values),
+        args.layer_size, args.lstm_dim, args.encoding_dim, metrics=metrics
+    )
+    make_distributed(ego_agent)
+
+    start = time.perf_counter()
+    for update in range(args.training_iters):
+        ego_agent.train(*replay.sample(args.batch_size))
+        if rank == 0 and args.checkpoint_interval and (update+1) % args.checkpoint_interval == 0:
+            ego_agent.save(args.checkpoint)
+    elapsed = time.perf_counter() - start
+
+    if rank == 0:
+        if args.checkpoint_interval:
+            ego_agent.save(args.checkpoint)
+        metrics.close()
+        print("Ranks : {}, {:.1f} updates/s, {:.0f} episodes/s".format(
+            world_size, args.training_iters / elapsed, args.training_iters * args.batch_size * world_size / elapsed
+        ))
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Data parallel training of OfflineAHTAgentV2 with N local processes")
+    parser.add_argument("--world-size", type=int, default=2)
+    parser.add_argument("--threads-per-rank", type=int, default=1)
+    parser.add_argument("--port", type=int, default=29500)
+    parser.add_argument("--num-data", type=int, default=20000)
+    parser.add_argument("--interaction-length", type=int, default=15)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cache-dir", default=os.path.join("datasets", "cache"))
+    parser.add_argument("--batch-size", type=int, default=128, help="Episodes per rank and update")
+    parser.add_argument("--training-iters", type=int, default=50000)
+    parser.add_argument("--layer-size", type=int, default=64)
+    parser.add_argument("--lstm-dim", type=int, default=64)
+    parser.add_argument("--encoding-dim", type=int, default=32)
+    parser.add_argument("--log-interval", type=int, default=1000)
+    parser.add_argument("--checkpoint", default="agent.pt")
+    parser.add_argument("--checkpoint-interval", type=int, default=10000, help="0 disables checkpoints")
+    args = parser.parse_args()
+
+    # Generate the dataset once up front, the ranks then memory map the cached shards
+    DatasetCache(args.cache_dir).get_data(MarkovDataGenerator(), args.num_data, args.interaction_length, seed=args.seed)
+    mp.spawn(train_worker, args=(args.world_size, args), nprocs=args.world_size, join=True)
@@ -0,0 +1,173 @@
+import math
+import torch
+from torch.func import functional_call, stack_module_state, vmap
+from agent import AgentLoss, actions_to_tensor, check_next_obs, obs_to_tensor
+from metrics import NULL_METRICS
+
+
+def architecture_key(agent):
+    # Agents can share an ensemble when all their parameters have the same shapes
+    return (
+        type(agent).__name__, agent.state_size, agent.action_size, agent.human_action_size,
+        agent.layer_size, agent.lstm_dim, agent.encoding_dim, agent.per_step_reset,
+        str(agent.dtype), str(agent.device),
+    )
+
+
+def group_by_architecture(agents):
+    # Splits a sweep into lists of agents that can be trained as one AgentEnsemble
+    groups = {}
+    for agent in agents:
+        groups.setdefault(architecture_key(agent), []).append(agent)
+    return list(groups.values())
+
+
+class AgentEnsemble(object):
+    """
+    Trains K agents of the same class and architecture in lockstep. The members' parameters
+    are stacked along a leading member dimension and the agents' compute_losses runs for all
+    members in one torch.func.vmap'd forward and backward pass (with the unrolled LSTM, the
+    fused LSTM kernel has no vmap support).
+    Every member keeps its own Adam state and learning rate (lrs, by default the members'
+    optimizer learning rates), target network and metrics. The members' own modules and
+    optimizers are only updated by write_back().
+    """
+    def __init__(self, agents, lrs=None, betas=(0.9, 0.999), eps=1e-8, metrics=None):
+        if len(set(architecture_key(agent) for agent in agents)) > 1:
+            raise ValueError("Ensemble members need the same architecture, see group_by_architecture")
+        self.agents = agents
+        first = agents[0]
+        self.device = first.device
+        self.dtype = first.dtype
+        self.state_size = first.state_size
+        self.action_size = first.action_size
+        self.human_action_size = first.human_action_size
+        self.target_update_interval = first.target_update_interval
+        self.target_tau = first.target_tau
+        self.betas = betas
+        self.eps = eps
+        self.total_updates = 0
+        # Ensemble wide phase timings, member losses go to the members' metrics
+        self.metrics = NULL_METRICS if metrics is None else metrics
+
+        # Networks of a template agent run every member's parameters through functional_call
+        template = type(first)(
+            first.state_size, first.action_size, first.human_action_size, first.layer_size,
+            first.lstm_dim, first.encoding_dim, device=first.device, per_step_reset=first.per_step_reset,
+            dtype=first.dtype
+        )
+        template.encoder.unrolled = True
+        self.template = AgentLoss(template)
+
+        self.params, self.buffers = stack_module_state([AgentLoss(agent) for agent in agents])
+        self.trained_names = [name for name, param in self.params.items() if param.requires_grad]
+        self.target_names = [name for name in self.params if name.startswith("target_value_network.")]
+
+        if lrs is None:
+            lrs = [agent.optimizer.param_groups[0]["lr"] for agent in agents]
+        self.lrs = torch.tensor(lrs, dtype=self.dtype, device=self.device)
+        self.step_count = 0
+        self.exp_avgs = {name: torch.zeros_like(self.params[name]) for name in self.trained_names}
+        self.exp_avg_sqs = {name: torch.zeros_like(self.params[name]) for name in self.trained_names}
+
+    def __len__(self):
+        return len(self.agents)
+
+    def member_losses(self, params, buffers, *tensors):
+        return functional_call(self.template, (params, buffers), tensors)
+
+    def train(self, input_obs, human_actions, ai_actions, input_dones, input_rews, input_nobs, lengths=None, stacked=False):
+        """
+        One update of every member. The inputs are a batch in the format of the agents' train(),
+        shared by all members, or with stacked=True one batch per member stacked along a
+        leading member dimension. Batches of variable length episodes (with lengths) are not
+        supported, their packed sequences have data dependent shapes that vmap can't batch.
+        """
+        if lengths is not None:
+            raise ValueError("AgentEnsemble only trains on fixed length episodes")
+        with self.metrics.timer("batch_assembly"):
+            tensors = (
+                obs_to_tensor(input_obs, self.state_size, self.human_action_size, self.device, self.dtype),
+                actions_to_tensor(human_actions, self.human_action_size, self.device, self.dtype),
+                actions_to_tensor(ai_actions, self.action_size, self.device, self.dtype),
+                torch.as_tensor(input_dones, device=self.device).to(self.dtype),
+                torch.as_tensor(input_rews, device=self.device).to(self.dtype),
+                obs_to_tensor(input_nobs, self.state_size, self.human_action_size, self.device, self.dtype),
+            )
+            check_next_obs(tensors[0], tensors[-1])
+
+        with self.metrics.timer("forward"):
+            batch_dim = 0 if stacked else None
+            enc_dec_loss, usual_q_loss, cql_log_probs_loss = vmap(
+                self.member_losses, in_dims=(0, 0) + (batch_dim,) * len(tensors)
+            )(self.params, self.buffers, *tensors)
+            # Members don't share parameters, so the gradient of the sum is every member's own
+            total_loss = (enc_dec_loss + usual_q_loss + cql_log_probs_loss).sum()
+
+        with self.metrics.timer("backward"):
+            grads = torch.autograd.grad(total_loss, [self.params[name] for name in self.trained_names])
+        with self.metrics.timer("optimizer"):
+            self.adam_step(grads)
+
+        self.total_updates += 1
+        if self.total_updates % self.target_update_interval == 0:
+            with self.metrics.timer("target_sync"):
+                self.sync_targets()
+
+        for member, agent in enumerate(self.agents):
+            agent.metrics.record("enc_dec_loss", enc_dec_loss[member])
+            agent.metrics.record("q_loss", usual_q_loss[member])
+            agent.metrics.record("cql_loss", cql_log_probs_loss[member])
+            agent.metrics.count("updates")
+            agent.metrics.step()
+        self.metrics.count("updates", len(self.agents))
+        self.metrics.step()
+        return enc_dec_loss.detach(), usual_q_loss.detach(), cql_log_probs_loss.detach()
+
+    def adam_step(self, grads):
+        # torch.optim.Adam's update applied to all members at once, with per member learning rates
+        beta1, beta2 = self.betas
+        self.step_count += 1
+        bias_correction1 = 1 - beta1 ** self.step_count
+        bias_correction2_sqrt = math.sqrt(1 - beta2 ** self.step_count)
+        with torch.no_grad():
+            for name, grad in zip(self.trained_names, grads):
+                param = self.params[name]
+                exp_avg, exp_avg_sq = self.exp_avgs[name], self.exp_avg_sqs[name]
+                exp_avg.lerp_(grad, 1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                denom = (exp_avg_sq.sqrt() / bias_correction2_sqrt).add_(self.eps)
+                step_size = (self.lrs / bias_correction1).view((-1,) + (1,) * (param.dim() - 1))
+                param.sub_(step_size * exp_avg / denom)
+
+    def sync_targets(self):
+        # Same update as agent.sync_target_network, for all members at once
+        with torch.no_grad():
+            for target_name in self.target_names:
+                source = self.params[target_name[len("target_"):]]
+                if self.target_tau == 1.0:
+                    self.params[target_name].copy_(source)
+                else:
+                    self.params[target_name].lerp_(source, self.target_tau)
+
+    def write_back(self):
+        """
+        Copies every member's parameters and Adam state into its agent, which can then act(),
+        save() or continue training on its own.
+        """
+        with torch.no_grad():
+            for member, agent in enumerate(self.agents):
+                for name, param in AgentLoss(agent).named_parameters():
+                    param.copy_(self.params[name][member])
+                for name, buffer in AgentLoss(agent).named_buffers():
+                    buffer.copy_(self.buffers[name][member])
+
+                named_params = dict(AgentLoss(agent).named_parameters())
+                for name in self.trained_names:
+                    agent.optimizer.state[named_params[name]] = {
+                        "step": torch.tensor(float(self.step_count)),
+                        "exp_avg": self.exp_avgs[name][member].clone(),
+                        "exp_avg_sq": self.exp_avg_sqs[name][member].clone(),
+                    }
+                agent.optimizer.param_groups[0]["lr"] = float(self.lrs[member])
+                agent.total_updates = self.total_updates
@@ -0,0 +1,180 @@
+import argparse
+import time
+import numpy as np
+import torch
+from MarkovDataGenerator import MarkovDataGenerator
+from agent import OfflineAHTAgentV2, obs_to_tensor
+
+
+class AdvisingEnv(object):
+    """
+    Vectorized environment over the simulated humans of a MarkovDataGenerator. The AI advice
+    is the action, the humans' decisions, outcomes, trust updates, cases and episode ends
+    follow the generator's tables, for num_envs episodes at once.
+    Observations are the (num_envs, 2) (case id, previous decision id) pairs the agents'
+    act() takes, rewards are 1 for a good outcome. Episodes run for at most
+    interaction_length steps, or end early with the generator's termination.
+    """
+    def __init__(self, generator, interaction_length, seed=None):
+        self.generator = generator
+        self.interaction_length = interaction_length
+        self.rng = np.random.default_rng(seed)
+        self.num_envs = 0
+        self.steps = 0
+
+    def reset(self, num_envs):
+        generator = self.generator
+        self.num_envs = num_envs
+        self.steps = 0
+        self.types = generator.type_table.sample(rng=self.rng, size=num_envs)
+        self.trust = generator.init_trust_table.sample((self.types,), self.rng)
+        self.case_start = generator.sample_case_start(num_envs, self.rng)
+        self.case = generator.case_ids_for_step(1, num_envs, self.rng, self.case_start)
+        self.prev_decision = np.full(num_envs, -1, dtype=np.int64)
+        self.dones = np.zeros(num_envs, dtype=bool)
+        return self.observations()
+
+    def observations(self):
+        return np.stack([self.case, self.prev_decision], axis=-1)
+
+    def step(self, actions):
+        """
+        Gives every running episode the advice ids in actions (num_envs,). Returns the next
+        observations, rewards, dones and an info dict with the decision and outcome ids.
+        Episodes that have already ended are left as they are, with zero rewards and -1 ids.
+        """
+        generator = self.generator
+        if self.dones.all():
+            raise RuntimeError("Every episode has ended, call reset() first")
+        rows = np.nonzero(~self.dones)[0]
+        types, trust, case = self.types[rows], self.trust[rows], self.case[rows]
+        advice = np.asarray(actions, dtype=np.int64)[rows]
+
+        decision = generator.acceptance_table.sample((types, case, advice, trust), self.rng)
+        outcome = generator.outcome_table.sample((case, decision), self.rng)
+        self.steps += 1
+        ended = np.full(len(rows), self.steps >= self.interaction_length)
+        if generator.variable_length and self.steps >= generator.min_length:
+            ended |= generator.sample_stops({"types": types, "trust": trust}, self.rng)
+
+        relation = generator.relation_mat[advice, decision]
+        self.trust[rows] = generator.sample_trust_update(types, case, trust, relation, outcome, self.rng)
+        case_start = None if self.case_start is None else self.case_start[rows]
+        self.case[rows] = generator.case_ids_for_step(self.steps+1, len(rows), self.rng, case_start)
+        self.prev_decision[rows] = decision
+        self.dones[rows] = ended
+
+        rewards = np.zeros(self.num_envs)
+        rewards[rows] = outcome == generator.outcome_vals_mapping[generator.good_outcome]
+        info = {"decision": np.full(self.num_envs, -1, dtype=np.int64), "outcome": np.full(self.num_envs, -1, dtype=np.int64)}
+        info["decision"][rows] = decision
+        info["outcome"][rows] = outcome
+        return self.observations(), rewards, self.dones.copy(), info
+
+
+def agent_policy(agent):
+    # Greedy actions of an agent's batched act_step, every episode starts from a zero LSTM
+    # state and the agent's own act() state is left alone
+    def policy(obs, lstm_hiddens):
+        input_tensor = obs_to_tensor(obs, agent.state_size, agent.human_action_size, agent.device, agent.dtype)
+        if lstm_hiddens is None:
+            lstm_hiddens = (
+                torch.zeros(1, input_tensor.size()[0], agent.lstm_dim, dtype=agent.dtype, device=agent.device),
+                torch.zeros(1, input_tensor.size()[0], agent.lstm_dim, dtype=agent.dtype, device=agent.device)
+            )
+        with torch.no_grad():
+            actions, lstm_hiddens = agent.act_step(input_tensor, lstm_hiddens)
+        return actions.cpu().numpy(), lstm_hiddens
+    return policy
+
+
+def table_policy(generator, rng=None):
+    # The advice policy of the generated data, ai_advice_probs given the case
+    def policy(obs, state):
+        return generator.ai_advice_table.sample((obs[:, 0],), rng), state
+    return policy
+
+
+def rollout(env, policy, num_episodes, gamma=1.0):
+    """
+    Runs policy(obs, state) -> (actions, state) on num_episodes parallel episodes until all
+    of them have ended. state starts as None and is the policy's own (e.g. LSTM states).
+    Returns (num_episodes,) returns, discounted returns and episode lengths.
+    """
+    obs = env.reset(num_episodes)
+    state = None
+    returns = np.zeros(num_episodes)
+    discounted_returns = np.zeros(num_episodes)
+    lengths = np.zeros(num_episodes, dtype=np.int64)
+    discount = 1.0
+    while not env.dones.all():
+        lengths += ~env.dones
+        actions, state = policy(obs, state)
+        obs, rewards, dones, info = env.step(actions)
+        returns += rewards
+        discounted_returns += discount * rewards
+        discount *= gamma
+    return {"returns": returns, "discounted_returns": discounted_returns, "lengths": lengths}
+
+
+def evaluate_policy(generator, policy, num_episodes, interaction_length, seed=None, batch_size=65536, gamma=1.0):
+    """
+    Monte Carlo value of a policy against the generator's simulated humans, batch_size
+    episodes at a time. Returns the per episode rollout arrays and summary statistics.
+    """
+    env = AdvisingEnv(generator, interaction_length, seed)
+    start = time.perf_counter()
+    batches = [
+        rollout(env, policy, min(batch_size, num_episodes-batch_start), gamma)
+        for batch_start in range(0, num_episodes, batch_size)
+    ]
+    elapsed = time.perf_counter() - start
+
+    results = {name: np.concatenate([batch[name] for batch in batches]) for name in batches[0]}
+    results["mean_return"] = results["returns"].mean()
+    results["return_stderr"] = results["returns"].std() / np.sqrt(num_episodes)
+    results["mean_discounted_return"] = results["discounted_returns"].mean()
+    results["mean_length"] = results["lengths"].mean()
+    results["episodes_per_sec"] = num_episodes / elapsed
+    return results
+
+
+def evaluate_agent(agent, generator, num_episodes, interaction_length, seed=None, batch_size=65536):
+    return evaluate_policy(
+        generator, agent_policy(agent), num_episodes, interaction_length, seed, batch_size, gamma=agent.gamma
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Online evaluation of OfflineAHTAgentV2 against the simulated humans")
+    parser.add_argument("--checkpoint", help="Agent checkpoint, an untrained agent without it")
+    parser.add_argument("--num-episodes", type=int, default=100000)
+    parser.add_argument("--interaction-length", type=int, default=15)
+    parser.add_argument("--batch-size", type=int, default=65536)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--layer-size", type=int, default=64)
+    parser.add_argument("--lstm-dim", type=int, default=64)
+    parser.add_argument("--encoding-dim", type=int, default=32)
+    args = parser.parse_args()
+
+    hmm = MarkovDataGenerator()
+    ego_agent = OfflineAHTAgentV2(
+        len(hmm.case_data_vals), len(hmm.ai_advice_vals), len(hmm.human_answer_values),
+        args.layer_size, args.lstm_dim, args.encoding_dim
+    )
+    if args.checkpoint is not None:
+        ego_agent.load(args.checkpoint)
+
+    policies = [
+        ("data advice", table_policy(hmm, np.random.default_rng(args.seed))),
+        ("agent", agent_policy(ego_agent)),
+    ]
+    for name, policy in policies:
+        results = evaluate_policy(
+            hmm, policy, args.num_episodes, args.interaction_length, seed=args.seed, batch_size=args.batch_size,
+            gamma=ego_agent.gamma
+        )
+        print("{:<12} return {:.3f} +- {:.3f}, discounted {:.3f}, {:.0f} episodes/s".format(
+            name, results["mean_return"], results["return_stderr"], results["mean_discounted_return"],
+            results["episodes_per_sec"]
+        ))
@@ -0,0 +1,186 @@
+import numpy as np
+
+
+def index_dtype(vocab_size):
+    # Smallest signed integer type holding every id of a vocabulary (and -1 as padding)
+    for dtype in (np.int8, np.int16, np.int32):
+        if vocab_size <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+class EpisodeStore(object):
+    """
+    Struct of arrays container for generated episodes.
+    Every categorical column is an integer coded (num_episodes, interaction_length) array
+    whose ids index the matching vocabulary, cont_input is a
+    (num_episodes, interaction_length, num_case_features) float block.
+    Episodes of different lengths are padded to interaction_length, lengths holds the
+    number of real steps of every episode (None when all episodes are full length) and
+    padded steps are -1 in every categorical column.
+    """
+    columns = ["types", "trust", "case", "advice", "decision", "outcome_val"]
+    latent_columns = ["types", "trust"]
+
+    def __init__(self, vocabs, columns, cont_input=None, lengths=None):
+        self.vocabs = vocabs
+        self.data = columns
+        self.cont_input = cont_input
+        self.lengths = lengths
+
+    @classmethod
+    def empty(cls, vocabs, num_episodes, interaction_length, num_case_features, variable_length=False):
+        columns = {
+            name: np.zeros((num_episodes, interaction_length), dtype=index_dtype(len(vocabs[name])))
+            for name in cls.columns
+        }
+        cont_input = np.zeros((num_episodes, interaction_length, num_case_features), dtype=np.float32)
+        lengths = np.full(num_episodes, interaction_length, dtype=np.int32) if variable_length else None
+        return cls(vocabs, columns, cont_input, lengths)
+
+    @classmethod
+    def from_records(cls, records, vocabs):
+        # Builds a store from the list of per step dicts of strings used by sample_*_states
+        mappings = {name: {val: idx for idx, val in enumerate(vals)} for name, vals in vocabs.items()}
+        columns = {}
+        for name in cls.columns:
+            if name in records[0]:
+                columns[name] = np.array(
+                    [[mappings[name][val] for val in d_t[name]] for d_t in records],
+                    dtype=index_dtype(len(vocabs[name]))
+                ).T.copy()
+        cont_input = None
+        if "cont_input" in records[0]:
+            cont_input = np.stack([np.asarray(d_t["cont_input"], dtype=np.float32) for d_t in records], axis=1)
+        return cls(vocabs, columns, cont_input)
+
+    @classmethod
+    def concatenate(cls, stores):
+        columns = {name: np.concatenate([store.data[name] for store in stores]) for name in stores[0].data}
+        cont_input = None
+        if stores[0].cont_input is not None:
+            cont_input = np.concatenate([store.cont_input for store in stores])
+        lengths = None
+        if any(store.lengths is not None for store in stores):
+            lengths = np.concatenate([store.episode_lengths() for store in stores])
+        return cls(stores[0].vocabs, columns, cont_input, lengths)
+
+    @property
+    def num_episodes(self):
+        return self.data["case"].shape[0]
+
+    @property
+    def interaction_length(self):
+        return self.data["case"].shape[1]
+
+    @property
+    def has_latents(self):
+        return all(name in self.data for name in self.latent_columns)
+
+    @property
+    def nbytes(self):
+        total = sum(column.nbytes for column in self.data.values())
+        if self.cont_input is not None:
+            total += self.cont_input.nbytes
+        return total
+
+    def __len__(self):
+        return self.num_episodes
+
+    def __getitem__(self, episode_ids):
+        columns = {name: column[episode_ids] for name, column in self.data.items()}
+        cont_input = None if self.cont_input is None else self.cont_input[episode_ids]
+        lengths = None if self.lengths is None else self.lengths[episode_ids]
+        return EpisodeStore(self.vocabs, columns, cont_input, lengths)
+
+    def episode_lengths(self):
+        if self.lengths is None:
+            return np.full(self.num_episodes, self.interaction_length, dtype=np.int32)
+        return self.lengths
+
+    def step_mask(self):
+        # (num_episodes, interaction_length), True at the real steps
+        return np.arange(self.interaction_length) < self.episode_lengths()[:, None]
+
+    def set_step(self, step, index_states, rows=None):
+        # rows : the episodes index_states belongs to, all episodes by default
+        rows = slice(None) if rows is None else rows
+        for name, column in self.data.items():
+            column[rows, step] = index_states[name]
+        if self.cont_input is not None:
+            self.cont_input[rows, step] = index_states["cont_input"]
+
+    def pad(self):
+        # Marks the steps after every episode's end as padding
+        if self.lengths is None:
+            return
+        padding = ~self.step_mask()
+        for column in self.data.values():
+            column[padding] = -1
+        if self.cont_input is not None:
+            self.cont_input[padding] = 0
+
+    def write_rows(self, start, other):
+        for name, column in self.data.items():
+            column[start:start+len(other)] = other.data[name]
+        if self.cont_input is not None:
+            self.cont_input[start:start+len(other)] = other.cont_input
+        if self.lengths is not None:
+            self.lengths[start:start+len(other)] = other.episode_lengths()
+
+    def flat_columns(self):
+        """
+        The real steps of every column as flat (total_steps, ...) arrays in episode order, and
+        the (num_episodes+1,) offsets of every episode's first step (from_flat is the inverse).
+        """
+        mask = self.step_mask()
+        columns = {name: column[mask] for name, column in self.data.items()}
+        cont_input = None if self.cont_input is None else self.cont_input[mask]
+        offsets = np.concatenate([[0], np.cumsum(self.episode_lengths(), dtype=np.int64)])
+        return columns, cont_input, offsets
+
+    @classmethod
+    def from_flat(cls, vocabs, columns, cont_input, offsets, interaction_length, episode_ids=None):
+        # Padded store of the episodes episode_ids (all of them by default) of flat_columns
+        # arrays, only their steps are read
+        if episode_ids is None:
+            episode_ids = np.arange(len(offsets)-1)
+        episode_ids = np.asarray(episode_ids)
+        starts = np.asarray(offsets[episode_ids])
+        lengths = np.asarray(offsets[episode_ids+1]) - starts
+        mask = np.arange(interaction_length) < lengths[:, None]
+        step_ids = (starts[:, None] + np.arange(interaction_length))[mask]
+
+        def gather(flat, pad_value):
+            padded = np.full(mask.shape + flat.shape[1:], pad_value, dtype=flat.dtype)
+            padded[mask] = flat[step_ids]
+            return padded
+
+        padded_columns = {name: gather(column, -1) for name, column in columns.items()}
+        padded_cont_input = None if cont_input is None else gather(cont_input, 0)
+        return cls(vocabs, padded_columns, padded_cont_input, lengths.astype(np.int32))
+
+    def remove_latent_vars(self):
+        # Column projection, the remaining arrays are shared and not copied
+        columns = {name: column for name, column in self.data.items() if name not in self.latent_columns}
+        return EpisodeStore(self.vocabs, columns, self.cont_input, self.lengths)
+
+    def one_hot(self, name, dtype=np.float64):
+        # Padded steps get all zero rows
+        one_hot = np.eye(len(self.vocabs[name]), dtype=dtype)[self.data[name]]
+        if self.lengths is not None:
+            one_hot[~self.step_mask()] = 0
+        return one_hot
+
+    def to_records(self):
+        # Inverse of from_records, mostly for inspecting data by hand
+        records = []
+        for step in range(self.interaction_length):
+            d_t = {
+                name: [self.vocabs[name][idx] if idx >= 0 else None for idx in column[:, step]]
+                for name, column in self.data.items()
+            }
+            if self.cont_input is not None:
+                d_t["cont_input"] = list(self.cont_input[:, step])
+            records.append(d_t)
+        return records
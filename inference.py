@@ -0,0 +1,171 @@
+import numpy as np
+
+
+class ExactInference(object):
+    """
+    Exact inference in the HMM defined by a MarkovDataGenerator's tables.
+    The latent state of an episode is (type, trust), the observations per step are the case,
+    AI advice, human decision and outcome. Every method works on a whole batch of episodes
+    (an EpisodeStore, latent columns are ignored) at once.
+    Joint posteriors are (num_episodes, interaction_length, num_types, num_trust) arrays.
+    The likelihood is of the whole observed episode, the case sequence under the generator's
+    case schedule included. Cases don't depend on the latent state, so they only add
+    case_log_probs and leave the posteriors unchanged.
+    For variable length episodes the likelihood includes the generator's termination
+    probabilities, padded steps observe nothing and keep the belief of the last real step.
+    """
+    def __init__(self, generator):
+        self.generator = generator
+
+    def observed_columns(self, data):
+        # Padded steps (-1) are mapped to id 0, see step_mask
+        return tuple(
+            np.maximum(np.asarray(data.data[name], dtype=np.int64), 0) for name in ["case", "advice", "decision", "outcome_val"]
+        )
+
+    def episode_lengths(self, data):
+        # None when every episode runs for the full interaction length
+        return None if data.lengths is None else np.asarray(data.lengths, dtype=np.int64)
+
+    def step_mask(self, lengths, interaction_length):
+        return np.arange(interaction_length) < lengths[:, None]
+
+    def observed_log_probs(self, case, advice, decision, outcome, lengths=None):
+        # log p(advice | case) + log p(outcome | case, decision), the part of the likelihood
+        # that doesn't depend on the latent state
+        with np.errstate(divide="ignore"):
+            log_probs = (
+                np.log(self.generator.ai_advice_mat[case, advice]) +
+                np.log(self.generator.outcome_mat[case, decision, outcome])
+            )
+        if lengths is not None:
+            log_probs = np.where(self.step_mask(lengths, case.shape[1]), log_probs, 0.0)
+        return log_probs.sum(axis=-1)
+
+    def case_log_probs(self, case, lengths=None):
+        # log p(case sequence) : i.i.d. cases for the random schedule, 0 or -inf for a cycle from
+        # the first position, and for a cycle with random_start the probability of the
+        # (uniformly drawn) start positions the sequence agrees with
+        generator = self.generator
+        mask = np.ones(case.shape, dtype=bool) if lengths is None else self.step_mask(lengths, case.shape[1])
+        if generator.case_schedule["kind"] == "random":
+            with np.errstate(divide="ignore"):
+                return np.where(mask, np.log(generator.case_probs_mat[case]), 0.0).sum(axis=-1)
+
+        order = generator.case_order
+        steps = np.arange(case.shape[1])
+        random_start = generator.case_schedule.get("random_start", False)
+        probs = np.zeros(case.shape[0])
+        for start in range(len(order)) if random_start else [0]:
+            # Only episodes whose first case is at this position can follow the cycle from it
+            rows = np.nonzero(case[:, 0] == order[start])[0]
+            matches = ((case[rows] == order[(start + steps) % len(order)]) | ~mask[rows]).all(axis=-1)
+            probs[rows] += matches / len(order) if random_start else matches
+        with np.errstate(divide="ignore"):
+            return np.log(probs)
+
+    def emissions(self, case, advice, decision, lengths=None):
+        # p(decision_t | type, trust_t, case_t, advice_t) as (N, T, K, S), for variable length
+        # episodes times p(episode continues / stops after step t | type, trust_t)
+        emissions = self.generator.acceptance_mat[:, case, advice, :, decision]
+        if lengths is None:
+            return emissions
+
+        generator = self.generator
+        steps = np.arange(case.shape[1])
+        last_step = lengths[:, None] - 1
+        continuing = (steps < last_step) & (steps+1 >= generator.min_length)
+        stopping = (steps == last_step) & (lengths[:, None] < case.shape[1])
+        if generator.stop_probs_mat is not None:
+            emissions = np.where(continuing[:, :, None, None], emissions * (1 - generator.stop_probs_mat), emissions)
+            # Episodes can't stop before min_length
+            stop_probs = np.where((steps+1 >= generator.min_length)[None, :, None, None], generator.stop_probs_mat, 0.0)
+            emissions = np.where(stopping[:, :, None, None], emissions * stop_probs, emissions)
+        return np.where(self.step_mask(lengths, case.shape[1])[:, :, None, None], emissions, 1.0)
+
+    def transitions(self, case, advice, decision, outcome, step, lengths=None):
+        # p(trust_{t+1} | type, trust_t, observations at step t) as (N, K, S, S'),
+        # the identity for episodes that have ended by step t+1
+        relation = self.generator.relation_mat[advice[:, step], decision[:, step]]
+        transitions = self.generator.trust_transition_mat[:, case[:, step], :, relation, outcome[:, step], :]
+        if lengths is None:
+            return transitions
+        num_trust = transitions.shape[-1]
+        return np.where((step+1 >= lengths)[:, None, None, None], np.eye(num_trust), transitions)
+
+    def prior(self):
+        return self.generator.type_probs_mat[:, None] * self.generator.init_trust_mat
+
+    def forward(self, data):
+        """
+        Scaled forward recursion. Returns
+            log_likelihood : (N,) log p(observations) of every episode
+            filtered : p(type, trust_t | observations up to and including step t)
+            predicted : p(type, trust_t | observations before step t, case_t)
+        """
+        case, advice, decision, outcome = self.observed_columns(data)
+        lengths = self.episode_lengths(data)
+        num_data, interaction_length = case.shape
+        emissions = self.emissions(case, advice, decision, lengths)
+
+        predicted = np.zeros(emissions.shape)
+        filtered = np.zeros(emissions.shape)
+        log_scales = np.zeros((num_data, interaction_length))
+        predicted[:, 0] = self.prior()
+        for t in range(interaction_length):
+            if t > 0:
+                transitions = self.transitions(case, advice, decision, outcome, t-1, lengths)
+                predicted[:, t] = np.einsum("nks,nksr->nkr", filtered[:, t-1], transitions)
+            joint = predicted[:, t] * emissions[:, t]
+            scale = joint.sum(axis=(1, 2))
+            with np.errstate(divide="ignore"):
+                log_scales[:, t] = np.log(scale)
+            # Impossible episodes keep an all zero belief
+            filtered[:, t] = joint / np.where(scale > 0, scale, 1.0)[:, None, None]
+
+        log_likelihood = (
+            log_scales.sum(axis=-1) + self.observed_log_probs(case, advice, decision, outcome, lengths) +
+            self.case_log_probs(case, lengths)
+        )
+        return log_likelihood, filtered, predicted
+
+    def forward_backward(self, data):
+        """
+        Smoothed posteriors p(type, trust_t | whole episode) on top of the forward pass.
+        Returns a dict with log_likelihood, filtered, predicted and smoothed joints and
+        the type_posterior (N, T, K) and trust_posterior (N, T, S) marginals of smoothed.
+        """
+        case, advice, decision, outcome = self.observed_columns(data)
+        log_likelihood, filtered, predicted = self.forward(data)
+        lengths = self.episode_lengths(data)
+        interaction_length = case.shape[1]
+        emissions = self.emissions(case, advice, decision, lengths)
+
+        # Backward messages normalised per step to avoid underflow
+        backward = np.ones(filtered.shape)
+        for t in range(interaction_length-2, -1, -1):
+            transitions = self.transitions(case, advice, decision, outcome, t, lengths)
+            message = np.einsum("nksr,nkr->nks", transitions, emissions[:, t+1] * backward[:, t+1])
+            norm = message.max(axis=(1, 2))
+            backward[:, t] = message / np.where(norm > 0, norm, 1.0)[:, None, None]
+
+        smoothed = filtered * backward
+        norm = smoothed.sum(axis=(2, 3))
+        smoothed = smoothed / np.where(norm > 0, norm, 1.0)[:, :, None, None]
+
+        return {
+            "log_likelihood": log_likelihood,
+            "filtered": filtered,
+            "predicted": predicted,
+            "smoothed": smoothed,
+            "type_posterior": smoothed.sum(axis=-1),
+            "trust_posterior": smoothed.sum(axis=-2),
+        }
+
+    def log_likelihood(self, data, batch_size=None):
+        # Per episode log likelihood, optionally computed batch_size episodes at a time
+        if batch_size is None:
+            return self.forward(data)[0]
+        return np.concatenate([
+            self.forward(data[start:start+batch_size])[0] for start in range(0, len(data), batch_size)
+        ])
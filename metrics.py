@@ -0,0 +1,217 @@
+import csv
+import json
+import os
+import sys
+import time
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class NullMetrics(object):
+    """
+    Default metrics of the generator and agents, every call is a no-op so instrumented
+    code costs one method call per hook when metrics are off.
+    """
+    enabled = False
+
+    def timer(self, name):
+        return NULL_TIMER
+
+    def count(self, name, value=1):
+        pass
+
+    def record(self, name, value):
+        pass
+
+    def step(self):
+        pass
+
+    def emit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+class Timer(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if self.metrics.synchronize is not None:
+            self.metrics.synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.metrics.synchronize is not None:
+            self.metrics.synchronize()
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics(object):
+    """
+    Collects phase timings, counters and value aggregates and hands one flat record per
+    interval to its sinks.
+        timer(name) : context manager adding its wall time to the "<name>_time" total
+        count(name, value) : counter, emitted as "<name>" and "<name>_per_sec"
+        record(name, value) : value aggregated as "<name>_mean", "_min" and "_max". Tensors
+            are kept as they are and only converted on emit, so recording a loss doesn't
+            force a device sync every update.
+        step() : marks one update, a record is emitted every `interval` steps
+    Timings are host wall-clock times, pass synchronize (e.g. torch.cuda.synchronize)
+    to time asynchronous device work.
+    """
+    enabled = True
+
+    def __init__(self, sinks=None, interval=100, synchronize=None):
+        self.sinks = [StdoutSink()] if sinks is None else sinks
+        self.interval = interval
+        self.synchronize = synchronize
+        self.steps = 0
+        self.reset()
+
+    def reset(self):
+        self.interval_start = time.perf_counter()
+        self.interval_steps = 0
+        self.timings = {}
+        self.counters = {}
+        self.values = {}
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def add_time(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, name, value):
+        if hasattr(value, "detach"):
+            value = value.detach()
+        self.values.setdefault(name, []).append(value)
+
+    def step(self):
+        self.steps += 1
+        self.interval_steps += 1
+        if self.interval is not None and self.interval_steps >= self.interval:
+            self.emit()
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.interval_start
+        summary = {"time": time.time(), "steps": self.steps, "interval_seconds": elapsed}
+        if self.interval_steps > 0:
+            summary["steps_per_sec"] = self.interval_steps / elapsed
+        for name, seconds in sorted(self.timings.items()):
+            summary[name + "_time"] = seconds
+        for name, value in sorted(self.counters.items()):
+            summary[name] = value
+            summary[name + "_per_sec"] = value / elapsed
+        for name, values in sorted(self.values.items()):
+            values = [float(value) for value in values]
+            summary[name + "_mean"] = sum(values) / len(values)
+            summary[name + "_min"] = min(values)
+            summary[name + "_max"] = max(values)
+        return summary
+
+    def emit(self):
+        # Writes the record of everything since the last emit, nothing if nothing happened
+        if self.interval_steps == 0 and not (self.timings or self.counters or self.values):
+            return
+        summary = self.summary()
+        for sink in self.sinks:
+            sink.write(summary)
+        self.reset()
+
+    def close(self):
+        self.emit()
+        for sink in self.sinks:
+            sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class StdoutSink(object):
+    # The wall-clock "time" field is left to the file sinks
+    def __init__(self, stream=None):
+        self.stream = sys.stdout if stream is None else stream
+
+    def write(self, summary):
+        self.stream.write("Metrics : " + ", ".join(
+            "{}={:.6g}".format(name, value) if isinstance(value, float) else "{}={}".format(name, value)
+            for name, value in summary.items() if name != "time"
+        ) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+
+class JSONLSink(object):
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def write(self, summary):
+        self.file.write(json.dumps(summary) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CSVSink(object):
+    """
+    One row per record. The columns are the union of the keys of every record so far, in
+    order of first appearance, keys a record lacks are left empty. A record with a new key
+    rewrites the file under the extended header, which only happens while new phases,
+    counters or values show up (e.g. the first training record after the generation ones).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fieldnames = []
+        self.file = open(path, "w", newline="")
+        self.writer = None
+
+    def write(self, summary):
+        new_keys = [name for name in summary if name not in self.fieldnames]
+        if new_keys:
+            self.fieldnames += new_keys
+            self.rewrite_header()
+        self.writer.writerow(summary)
+        self.file.flush()
+
+    def rewrite_header(self):
+        self.file.close()
+        with open(self.path, newline="") as old_file:
+            rows = list(csv.DictReader(old_file))
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", newline="") as tmp_file:
+            writer = csv.DictWriter(tmp_file, fieldnames=self.fieldnames, restval="")
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, "a", newline="")
+        self.writer = csv.DictWriter(self.file, fieldnames=self.fieldnames, restval="")
+
+    def close(self):
+        self.file.close()
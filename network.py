@@ -1,5 +1,76 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+
+def expand_index_inputs(index_input, field_sizes, dtype):
+    """
+    Expands (..., num_fields) integer ids into concatenated one-hot vectors on the ids' device.
+    An id of -1 (padding) expands to a vector of -1s, same as the -1 filled one-hot inputs.
+    """
+    expanded = []
+    for field, field_size in enumerate(field_sizes):
+        ids = index_input[..., field].long()
+        one_hot = F.one_hot(ids.clamp(min=0), field_size).to(dtype)
+        expanded.append(torch.where((ids < 0).unsqueeze(-1), -torch.ones_like(one_hot), one_hot))
+    return torch.cat(expanded, dim=-1)
+
+
+def lstm_unrolled(lstm, x, lstm_hiddens=None):
+    """
+    Single layer, batch_first nn.LSTM forward written as a loop over steps of plain tensor ops.
+    Slower than the fused kernel, but works under torch.func transforms such as vmap,
+    which have no batching rule for the fused LSTM op.
+    """
+    batch_size = x.size()[0]
+    if lstm_hiddens is None:
+        hidden = x.new_zeros(batch_size, lstm.hidden_size)
+        cell = x.new_zeros(batch_size, lstm.hidden_size)
+    else:
+        hidden, cell = lstm_hiddens[0][0], lstm_hiddens[1][0]
+
+    # Input projections of all steps at once, gates are ordered (input, forget, cell, output)
+    # (unbind rather than indexing per step keeps the backward pass from allocating a
+    # full size gradient for every step)
+    input_gates = torch.matmul(x, lstm.weight_ih_l0.t()) + lstm.bias_ih_l0 + lstm.bias_hh_l0
+    outputs = []
+    for step_gates in input_gates.unbind(dim=1):
+        gates = step_gates + torch.matmul(hidden, lstm.weight_hh_l0.t())
+        input_gate, forget_gate, cell_gate, output_gate = gates.chunk(4, dim=-1)
+        cell = torch.sigmoid(forget_gate) * cell + torch.sigmoid(input_gate) * torch.tanh(cell_gate)
+        hidden = torch.sigmoid(output_gate) * torch.tanh(cell)
+        outputs.append(hidden)
+    return torch.stack(outputs, dim=1), (hidden.unsqueeze(0), cell.unsqueeze(0))
+
+def lstm_packed(lstm, packed_x):
+    """
+    Single layer nn.LSTM forward over a PackedSequence as a loop over steps of plain tensor
+    ops, each step only on the sequences still running. Returns the (total_steps, hidden_size)
+    outputs in packed order and the final states in the original batch order.
+    """
+    batch_sizes = packed_x.batch_sizes.tolist()
+    input_gates = torch.matmul(packed_x.data, lstm.weight_ih_l0.t()) + lstm.bias_ih_l0 + lstm.bias_hh_l0
+    hidden = input_gates.new_zeros(batch_sizes[0], lstm.hidden_size)
+    cell = input_gates.new_zeros(batch_sizes[0], lstm.hidden_size)
+    outputs = []
+    # States of the sequences that have ended, shortest sequences end first
+    final_states = []
+    for step_gates, batch_size in zip(input_gates.split(batch_sizes), batch_sizes):
+        if batch_size < hidden.size()[0]:
+            final_states.append((hidden[batch_size:], cell[batch_size:]))
+            hidden, cell = hidden[:batch_size], cell[:batch_size]
+        gates = step_gates + torch.matmul(hidden, lstm.weight_hh_l0.t())
+        input_gate, forget_gate, cell_gate, output_gate = gates.chunk(4, dim=-1)
+        cell = torch.sigmoid(forget_gate) * cell + torch.sigmoid(input_gate) * torch.tanh(cell_gate)
+        hidden = torch.sigmoid(output_gate) * torch.tanh(cell)
+        outputs.append(hidden)
+    final_states.append((hidden, cell))
+
+    final_hidden = torch.cat([state[0] for state in reversed(final_states)])
+    final_cell = torch.cat([state[1] for state in reversed(final_states)])
+    if packed_x.unsorted_indices is not None:
+        final_hidden, final_cell = final_hidden[packed_x.unsorted_indices], final_cell[packed_x.unsorted_indices]
+    return torch.cat(outputs), (final_hidden.unsqueeze(0), final_cell.unsqueeze(0))
 
 class DDQN(nn.Module):
     def __init__(self, state_size, action_size, layer_size):
@@ -26,14 +97,48 @@ class Encoder(nn.Module):
         self.lstm_hidden_dim = lstm_hidden_dim
         self.lstm = nn.LSTM(input_dim, lstm_hidden_dim, batch_first=True)
         self.fc = nn.Linear(lstm_hidden_dim, output_dim)
+        # Use lstm_unrolled instead of the fused LSTM kernel, needed under vmap
+        self.unrolled = False
+
+    def run_lstm(self, x, lstm_hiddens=None):
+        if self.unrolled:
+            return lstm_unrolled(self.lstm, x, lstm_hiddens)
+        return self.lstm(x, lstm_hiddens)
         
     def forward(self, x, lstm_hiddens):
         # x shape: (batch_size, seq_length, input_dim)
-        lstm_out, updated_hiddens = self.lstm(x.view(x.size()[0], 1, -1), lstm_hiddens) 
+        lstm_out, updated_hiddens = self.run_lstm(x.view(x.size()[0], 1, -1), lstm_hiddens) 
         # Take the last output from LSTM
         output = self.fc(lstm_out[:, 0, :])  # output shape: (batch_size, output_dim)
         return output, updated_hiddens
 
+    def forward_sequence(self, x, lstm_hiddens=None, reset_each_step=False):
+        # x shape: (batch_size, seq_length, input_dim), encodes every step in one LSTM call.
+        # With reset_each_step every step is encoded from a zero hidden state on its own.
+        batch_size, seq_length = x.size()[0], x.size()[1]
+        if reset_each_step:
+            lstm_out, updated_hiddens = self.run_lstm(x.reshape(batch_size*seq_length, 1, -1))
+            lstm_out = lstm_out.view(batch_size, seq_length, -1)
+        else:
+            lstm_out, updated_hiddens = self.run_lstm(x, lstm_hiddens)
+        output = self.fc(lstm_out)  # output shape: (batch_size, seq_length, output_dim)
+        return output, updated_hiddens
+
+    def forward_packed(self, packed_x, reset_each_step=False):
+        # packed_x : PackedSequence of inputs, encodes only the real steps of variable length
+        # sequences. Returns (total_steps, output_dim) encodings in packed_x.data order and the
+        # final hidden states in the original batch order (None with reset_each_step).
+        if reset_each_step:
+            lstm_out, _ = self.run_lstm(packed_x.data.unsqueeze(1))
+            return self.fc(lstm_out[:, 0]), None
+        # The fused CPU kernel's backward on packed input costs O(total_steps) per step,
+        # the step loop of lstm_packed only touches the sequences still running
+        if self.unrolled or packed_x.data.device.type == "cpu":
+            lstm_out, updated_hiddens = lstm_packed(self.lstm, packed_x)
+            return self.fc(lstm_out), updated_hiddens
+        lstm_out, updated_hiddens = self.lstm(packed_x)
+        return self.fc(lstm_out.data), updated_hiddens
+
 class Decoder(nn.Module):
     def __init__(self, input_dim=8, hidden_dim=16, output_dim=6):
         super(Decoder, self).__init__()
@@ -47,3 +152,4 @@ class Decoder(nn.Module):
         x = self.relu(x)
         output = self.fc2(x)
         return output
+
@@ -0,0 +1,380 @@
+import argparse
+import time
+import numpy as np
+from MarkovDataGenerator import MarkovDataGenerator
+
+
+def unique_rows(keys):
+    # Ids of the distinct rows of a 2d array, the inverse maps every row to its id
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    return first, inverse.reshape(-1)
+
+
+class AdvisingPOMDP(object):
+    """
+    The finite horizon POMDP defined by a MarkovDataGenerator's tables. The latent state is
+    (type, trust), the action is the AI advice, the observations after a step are the
+    human decision and the outcome, and the reward is 1 for a good outcome. Episodes run
+    for horizon steps, or end early with the generator's termination.
+    The case shown at a step is observed before the advice. It comes from an observed
+    context, the position in a case cycle or the case itself for random cases, that
+    follows a Markov chain (context_probs0, context_transitions).
+    Beliefs are (..., num_types, num_trust) distributions over the latent state at a step,
+    given the observations so far and that the episode is still running. Values are
+    expected (discounted) rewards from a step to the end of the episode.
+    All tables are dense, the solver is meant for the small vocabularies of hand written
+    study designs.
+    """
+    def __init__(self, generator, horizon, discount=1.0):
+        self.generator = generator
+        self.horizon = horizon
+        self.discount = discount
+        self.num_types = len(generator.type_vals)
+        self.num_trust = len(generator.trust_vals)
+        self.num_actions = len(generator.ai_advice_vals)
+        self.num_decisions = len(generator.human_answer_values)
+        self.num_outcomes = len(generator.outcome_vals)
+
+        if generator.case_schedule["kind"] == "cycle":
+            self.context_cases = generator.case_order
+            num_contexts = len(self.context_cases)
+            self.context_transitions = np.eye(num_contexts)[(np.arange(num_contexts)+1) % num_contexts]
+            if generator.case_schedule.get("random_start", False):
+                self.context_probs0 = np.full(num_contexts, 1/num_contexts)
+            else:
+                self.context_probs0 = np.eye(num_contexts)[0]
+        else:
+            self.context_cases = np.arange(len(generator.case_data_vals))
+            self.context_transitions = np.tile(generator.case_probs_mat, (len(self.context_cases), 1))
+            self.context_probs0 = generator.case_probs_mat
+        self.num_contexts = len(self.context_cases)
+        self.compile_tables()
+
+        # Set by solve_qmdp and solve
+        self.qmdp_q = None
+        self.alphas = None
+        self.alpha_actions = None
+        self.exact = None
+
+    def compile_tables(self):
+        # Tables over contexts x, actions a, decisions d, outcomes o and latent (k, s) :
+        #   observation_probs (X, A, K, S, D, O) p(d, o | x, a, k, s)
+        #   rewards (X, A, K, S) expected reward of a step
+        #   dynamics (X, A, D, O, K, S, S') p(d, o, s' | x, a, k, s)
+        generator = self.generator
+        cases = self.context_cases
+        acceptance = generator.acceptance_mat[:, cases].transpose(1, 2, 0, 3, 4)
+        outcome = generator.outcome_mat[cases]
+        self.observation_probs = acceptance[..., None] * outcome[:, None, None, None]
+        good = generator.outcome_vals_mapping[generator.good_outcome]
+        self.rewards = self.observation_probs[..., good].sum(axis=-1)
+
+        relation = generator.relation_mat
+        # (K, X, S, A, D, O, S') -> (X, A, D, O, K, S, S')
+        transitions = generator.trust_transition_mat[:, cases][:, :, :, relation].transpose(1, 3, 4, 5, 0, 2, 6)
+        self.dynamics = self.observation_probs.transpose(0, 1, 4, 5, 2, 3)[..., None] * transitions
+
+    def continuation(self, step):
+        # (K, S) discounted probability of going on to step+1 after step (from 0)
+        generator = self.generator
+        if step+1 >= self.horizon:
+            return np.zeros((self.num_types, self.num_trust))
+        if generator.variable_length and step+1 >= generator.min_length:
+            return self.discount * (1 - generator.stop_probs_mat)
+        return np.full((self.num_types, self.num_trust), float(self.discount))
+
+    def prior_belief(self):
+        return self.generator.type_probs_mat[:, None] * self.generator.init_trust_mat
+
+    def next_joints(self, step, contexts, beliefs, actions=None):
+        """
+        Unnormalised beliefs after every decision and outcome, including the probability
+        of the episode going on. Returns (N, D, O, K, S') for given actions (N,), or
+        (N, A, D, O, K, S') for every action. Their sums are the discounted probabilities
+        of the observations.
+        """
+        weighted = beliefs * self.continuation(step)
+        if actions is None:
+            return np.einsum("nks,nadoksr->nadokr", weighted, self.dynamics[contexts])
+        return np.einsum("nks,ndoksr->ndokr", weighted, self.dynamics[contexts, actions])
+
+    def belief_update(self, step, contexts, beliefs, actions, decisions, outcomes):
+        # Beliefs at step+1 after observing decisions and outcomes, and the observations' probabilities
+        joints = self.next_joints(step, contexts, beliefs, actions)[np.arange(len(contexts)), decisions, outcomes]
+        probs = joints.sum(axis=(1, 2))
+        return joints / np.where(probs > 0, probs, 1.0)[:, None, None], probs
+
+    def expected_rewards(self, contexts, beliefs):
+        # (N, A) expected reward of the current step for every action
+        return np.einsum("nks,naks->na", beliefs, self.rewards[contexts])
+
+    def solve_qmdp(self):
+        """
+        Q-values of the fully observed (type, trust) MDP, (horizon, X, K, S, A). Their
+        expectation under a belief is an upper bound of the POMDP Q-values (QMDP).
+        """
+        qmdp_q = np.zeros((self.horizon, self.num_contexts, self.num_types, self.num_trust, self.num_actions))
+        values = np.zeros((self.num_contexts, self.num_types, self.num_trust))
+        for step in range(self.horizon-1, -1, -1):
+            # Values of the next step averaged over the next context
+            next_values = np.einsum("xy,ykr->xkr", self.context_transitions, values)
+            future = np.einsum("xadoksr,xkr->xaks", self.dynamics, next_values) * self.continuation(step)[None, None]
+            qmdp_q[step] = (self.rewards + future).transpose(0, 2, 3, 1)
+            values = qmdp_q[step].max(axis=-1)
+        self.qmdp_q = qmdp_q
+        return qmdp_q
+
+    def upper_bound_q(self, step, contexts, beliefs):
+        if self.qmdp_q is None:
+            self.solve_qmdp()
+        return np.einsum("nks,nksa->na", beliefs, self.qmdp_q[step, contexts])
+
+    def blind_alphas(self):
+        # Values of always giving the same advice, (horizon, X, A, K, S), valid lower bound vectors
+        alphas = np.zeros((self.horizon, self.num_contexts, self.num_actions, self.num_types, self.num_trust))
+        values = np.zeros((self.num_contexts, self.num_actions, self.num_types, self.num_trust))
+        for step in range(self.horizon-1, -1, -1):
+            next_values = np.einsum("xy,yakr->xakr", self.context_transitions, values)
+            future = np.einsum("xadoksr,xakr->xaks", self.dynamics, next_values) * self.continuation(step)[None, None]
+            alphas[step] = self.rewards + future
+            values = alphas[step]
+        return alphas
+
+    def best_next_alphas(self, step, contexts, joints):
+        """
+        For (N, ..., K, S') next step joints, the alpha vectors of step+1 that are best for
+        them in every next context, weighted by the context transition probabilities and
+        summed, (N, ..., K, S'). Also returns the summed (N, ...) values.
+        """
+        weighted_alphas = np.zeros(joints.shape)
+        values = np.zeros(joints.shape[:-2])
+        if step+1 >= self.horizon:
+            return weighted_alphas, values
+        flat_joints = joints.reshape(len(contexts), -1, self.num_types*self.num_trust)
+        for next_context in np.nonzero(self.context_transitions[contexts].sum(axis=0))[0]:
+            rows = np.nonzero(self.context_transitions[contexts, next_context])[0]
+            alphas = self.alphas[step+1][next_context].reshape(-1, self.num_types*self.num_trust)
+            scores = flat_joints[rows] @ alphas.T
+            best = scores.argmax(axis=-1)
+            probs = self.context_transitions[contexts[rows], next_context]
+            weighted_alphas[rows] += (probs[:, None, None] * alphas[best]).reshape(weighted_alphas[rows].shape)
+            values[rows] += (probs[:, None] * np.take_along_axis(scores, best[..., None], -1)[..., 0]).reshape(values[rows].shape)
+        return weighted_alphas, values
+
+    def backup(self, step, contexts, beliefs):
+        """
+        Point based Bellman backup at (N,) contexts and (N, K, S) beliefs on the alpha vectors
+        of step+1. Returns (N, A) Q-values, the best actions and their (N, K, S) alpha vectors.
+        """
+        joints = self.next_joints(step, contexts, beliefs)
+        weighted_alphas, future_values = self.best_next_alphas(step, contexts, joints)
+        q_values = self.expected_rewards(contexts, beliefs) + future_values.sum(axis=(2, 3))
+        actions = q_values.argmax(axis=-1)
+
+        rows = np.arange(len(contexts))
+        dynamics = self.dynamics[contexts, actions] * self.continuation(step)[None, None, None, :, :, None]
+        alphas = self.rewards[contexts, actions] + np.einsum(
+            "ndoksr,ndokr->nks", dynamics, weighted_alphas[rows, actions]
+        )
+        return q_values, actions, alphas
+
+    def reachable_points(self, max_points=100000, decimals=10):
+        """
+        Every (context, belief) reachable at each step from the prior, merging beliefs that
+        agree to decimals. Returns a list of (contexts, beliefs) per step, or None when a
+        step has more than max_points of them.
+        """
+        contexts = np.nonzero(self.context_probs0)[0]
+        beliefs = np.repeat(self.prior_belief()[None], len(contexts), axis=0)
+        points = []
+        for step in range(self.horizon):
+            points.append((contexts, beliefs))
+            if step+1 == self.horizon:
+                break
+            joints = self.next_joints(step, contexts, beliefs)
+            num_branches = joints.shape[1]*joints.shape[2]*joints.shape[3]
+            joints = joints.reshape(-1, self.num_types, self.num_trust)
+            probs = joints.sum(axis=(1, 2))
+            parents = np.repeat(contexts, num_branches)[probs > 0]
+            next_beliefs = joints[probs > 0] / probs[probs > 0, None, None]
+            next_contexts = self.context_transitions[parents] > 0
+            parent_ids, context_ids = np.nonzero(next_contexts)
+            contexts, beliefs = self.merge_points(context_ids, next_beliefs[parent_ids], decimals)
+            if len(contexts) > max_points:
+                return None
+        return points
+
+    def merge_points(self, contexts, beliefs, decimals):
+        keys = np.concatenate([contexts[:, None], np.round(beliefs.reshape(len(contexts), -1), decimals)], axis=1)
+        first, _ = unique_rows(keys)
+        return contexts[first], beliefs[first]
+
+    def sampled_points(self, num_points, seed=None, epsilon=0.2, decimals=10):
+        # (context, belief) points of num_points simulated episodes per step, acting
+        # epsilon-greedily on the QMDP Q-values
+        rng = np.random.default_rng(seed)
+        generator = self.generator
+        types = generator.type_table.sample(rng=rng, size=num_points)
+        trust = generator.init_trust_table.sample((types,), rng)
+        contexts = rng.choice(self.num_contexts, size=num_points, p=self.context_probs0)
+        beliefs = np.repeat(self.prior_belief()[None], num_points, axis=0)
+        points = []
+        for step in range(self.horizon):
+            points.append(self.merge_points(contexts, beliefs, decimals))
+            if step+1 == self.horizon:
+                break
+            actions = self.upper_bound_q(step, contexts, beliefs).argmax(axis=-1)
+            explore = rng.random(num_points) < epsilon
+            actions[explore] = rng.integers(self.num_actions, size=explore.sum())
+
+            cases = self.context_cases[contexts]
+            decisions = generator.acceptance_table.sample((types, cases, actions, trust), rng)
+            outcomes = generator.outcome_table.sample((cases, decisions), rng)
+            beliefs, _ = self.belief_update(step, contexts, beliefs, actions, decisions, outcomes)
+            relation = generator.relation_mat[actions, decisions]
+            trust = generator.sample_trust_update(types, cases, trust, relation, outcomes, rng)
+            # Episodes that would have ended carry on, their points are still valid beliefs
+            contexts = (rng.random(num_points)[:, None] > self.context_transitions[contexts].cumsum(axis=1)).sum(axis=1)
+        return points
+
+    def solve(self, num_points=2000, max_reachable=20000, seed=0, decimals=10):
+        """
+        Point based value iteration over alpha vectors. When the reachable beliefs (merged to
+        decimals) number at most max_reachable per step they are the points and the values at
+        them are exact, otherwise num_points simulated episodes give the points and the
+        alpha vectors are a lower bound (see bounds). Returns whether the solution is exact.
+        """
+        if self.qmdp_q is None:
+            self.solve_qmdp()
+        points = self.reachable_points(max_reachable, decimals)
+        self.exact = points is not None
+        if points is None:
+            points = self.sampled_points(num_points, seed, decimals=decimals)
+
+        blind = self.blind_alphas()
+        self.alphas = [None] * self.horizon
+        self.alpha_actions = [None] * self.horizon
+        for step in range(self.horizon-1, -1, -1):
+            contexts, beliefs = points[step]
+            _, actions, alphas = self.backup(step, contexts, beliefs)
+            step_alphas, step_actions = [], []
+            for context in range(self.num_contexts):
+                # Always advising the same way keeps every context covered
+                context_alphas = np.concatenate([blind[step, context], alphas[contexts == context]])
+                context_actions = np.concatenate([np.arange(self.num_actions), actions[contexts == context]])
+                first, _ = unique_rows(np.round(context_alphas.reshape(len(context_alphas), -1), decimals))
+                step_alphas.append(context_alphas[first])
+                step_actions.append(context_actions[first])
+            self.alphas[step] = step_alphas
+            self.alpha_actions[step] = step_actions
+        return self.exact
+
+    def values(self, step, contexts, beliefs):
+        # Lower bound values (exact at the solved points of an exact solve) and the actions of the best alpha vectors
+        values = np.zeros(len(contexts))
+        actions = np.zeros(len(contexts), dtype=np.int64)
+        for context in np.unique(contexts):
+            rows = np.nonzero(contexts == context)[0]
+            alphas = self.alphas[step][context]
+            scores = beliefs[rows].reshape(len(rows), -1) @ alphas.reshape(len(alphas), -1).T
+            best = scores.argmax(axis=-1)
+            values[rows] = scores[np.arange(len(rows)), best]
+            actions[rows] = self.alpha_actions[step][context][best]
+        return values, actions
+
+    def q_values(self, step, contexts, beliefs):
+        # (N, A) Q-values, the reward of the step plus the solved values of step+1
+        return self.backup(step, contexts, beliefs)[0]
+
+    def bounds(self, step, contexts, beliefs):
+        # Lower (alpha vectors) and upper (QMDP) bounds of the optimal values
+        lower, _ = self.values(step, contexts, beliefs)
+        upper = self.upper_bound_q(step, contexts, beliefs).max(axis=-1)
+        return lower, upper
+
+    def policy(self, step, contexts, beliefs):
+        # Actions of the solved policy, greedy on q_values
+        return self.q_values(step, contexts, beliefs).argmax(axis=-1)
+
+    def evaluate_policy(self, policy, contexts=None, beliefs=None, start_step=0, max_nodes=1000000, decimals=10):
+        """
+        Exact value of policy(step, contexts, beliefs) -> actions from (N,) contexts and (N, K, S)
+        beliefs at start_step (by default the start of an episode, averaged over the first
+        context). Enumerates every observation history, merging histories that lead to the
+        same (context, belief), so it works for any policy that only depends on those.
+        contexts and beliefs are given together or not at all.
+        Raises ValueError when a step has more than max_nodes distinct nodes.
+        """
+        if (contexts is None) != (beliefs is None):
+            raise ValueError("evaluate_policy takes both contexts and beliefs, or neither")
+        if beliefs is None:
+            contexts = np.nonzero(self.context_probs0)[0]
+            beliefs = np.repeat(self.prior_belief()[None], len(contexts), axis=0)
+            weights = self.context_probs0[contexts]
+            starts = np.zeros(len(contexts), dtype=np.int64)
+            num_starts = 1
+        else:
+            contexts = np.asarray(contexts)
+            beliefs = np.asarray(beliefs)
+            if beliefs.shape != (len(contexts), self.num_types, self.num_trust):
+                raise ValueError("beliefs must be (len(contexts), num_types, num_trust), got " + str(beliefs.shape))
+            weights = np.ones(len(contexts))
+            starts = np.arange(len(contexts))
+            num_starts = len(contexts)
+
+        values = np.zeros(num_starts)
+        for step in range(start_step, self.horizon):
+            actions = policy(step, contexts, beliefs)
+            rewards = np.einsum("nks,nks->n", beliefs, self.rewards[contexts, actions])
+            values += np.bincount(starts, weights=weights*rewards, minlength=num_starts)
+            if step+1 == self.horizon:
+                break
+
+            joints = self.next_joints(step, contexts, beliefs, actions)
+            num_branches = joints.shape[1]*joints.shape[2]
+            joints = joints.reshape(-1, self.num_types, self.num_trust)
+            probs = joints.sum(axis=(1, 2))
+            parent_ids = np.repeat(np.arange(len(contexts)), num_branches)
+            keep = probs > 0
+            parent_ids, joints, probs = parent_ids[keep], joints[keep], probs[keep]
+            branch_ids, next_contexts = np.nonzero(self.context_transitions[contexts[parent_ids]] > 0)
+            parents = parent_ids[branch_ids]
+            branch_weights = (
+                weights[parents] * probs[branch_ids] * self.context_transitions[contexts[parents], next_contexts]
+            )
+            next_beliefs = joints[branch_ids] / probs[branch_ids, None, None]
+
+            # Histories reaching the same (start, context, belief) share their future
+            keys = np.concatenate([
+                starts[parents, None], next_contexts[:, None],
+                np.round(next_beliefs.reshape(len(parents), -1), decimals)
+            ], axis=1)
+            first, inverse = unique_rows(keys)
+            if len(first) > max_nodes:
+                raise ValueError("Policy evaluation needs more than {} nodes at step {}".format(max_nodes, step+1))
+            contexts, beliefs, starts = next_contexts[first], next_beliefs[first], starts[parents[first]]
+            weights = np.bincount(inverse, weights=branch_weights, minlength=len(first))
+        return values
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Optimal advising values of the generator's POMDP")
+    parser.add_argument("--interaction-length", type=int, default=15)
+    parser.add_argument("--discount", type=float, default=1.0)
+    parser.add_argument("--num-points", type=int, default=2000)
+    parser.add_argument("--max-reachable", type=int, default=20000)
+    args = parser.parse_args()
+
+    hmm = MarkovDataGenerator()
+    pomdp = AdvisingPOMDP(hmm, args.interaction_length, args.discount)
+    start = time.perf_counter()
+    exact = pomdp.solve(args.num_points, args.max_reachable)
+    print("Solved in {:.2f}s ({})".format(time.perf_counter() - start, "exact" if exact else "point based"))
+
+    contexts = np.nonzero(pomdp.context_probs0)[0]
+    beliefs = np.repeat(pomdp.prior_belief()[None], len(contexts), axis=0)
+    lower, upper = pomdp.bounds(0, contexts, beliefs)
+    print("Optimal value : {:.4f} (QMDP upper bound {:.4f})".format(pomdp.context_probs0[contexts] @ lower, pomdp.context_probs0[contexts] @ upper))
+    for action, name in enumerate(hmm.ai_advice_vals):
+        value = pomdp.evaluate_policy(lambda step, contexts, beliefs, action=action: np.full(len(contexts), action))[0]
+        print("Always advising {} : {:.4f}".format(name, value))
@@ -0,0 +1,294 @@
+import queue
+import threading
+import time
+import numpy as np
+import torch
+
+
+def build_shifted_observations(obs, human_acts):
+    """
+    Adds the previous human decision to every observation and builds the next observations.
+    Works on index inputs (obs (N, T) case ids, human_acts (N, T) decision ids, giving (N, T, 2)
+    id pairs) and on one-hot inputs (giving (N, T, num_cases+num_decisions) features).
+    Missing previous decisions and the observation after the last step are filled with -1,
+    so unsigned inputs give signed index pairs, or float32 features for compact one-hots.
+    """
+    if human_acts.ndim == 2:
+        dtype = np.promote_types(obs.dtype, np.int8)
+        prev_acts = np.full(human_acts.shape, -1, dtype=dtype)
+        prev_acts[:, 1:] = human_acts[:, :-1]
+        final_ob = np.stack([obs.astype(dtype, copy=False), prev_acts], axis=-1)
+    else:
+        dtype = np.float32 if np.issubdtype(obs.dtype, np.unsignedinteger) else obs.dtype
+        prev_acts = np.full(human_acts.shape, -1, dtype=dtype)
+        prev_acts[:, 1:, :] = human_acts[:, :-1, :]
+        final_ob = np.concatenate([obs.astype(dtype, copy=False), prev_acts], axis=-1)
+    final_nob = np.full_like(final_ob, -1)
+    final_nob[:, :-1] = final_ob[:, 1:]
+    return final_ob, final_nob
+
+
+class OfflineDataset(object):
+    """
+    Offline training data held as contiguous tensors on the training device.
+    The previous-decision augmented observations and next observations are built once,
+    minibatches are then gathered by index from an epoch-wise shuffled order, so a
+    training step costs O(batch_size) and needs no host side work.
+    Batches come out in the argument order of the agents' train().
+    Episodes end at their first done. When they have different lengths only the real steps
+    are kept, as flat (total_steps, ...) tensors with every episode's steps starting at
+    offsets[episode]. Batches are then padded to the longest episode of the batch and end
+    with the episodes' lengths, for the agents' packed losses.
+    """
+    def __init__(self, obs, ai_acts, human_acts, dones, rews, device="cpu", seed=None):
+        final_ob, final_nob = build_shifted_observations(obs, human_acts)
+        self.device = device
+        dones = np.asarray(dones)
+        lengths = np.where(dones.any(axis=1), dones.argmax(axis=1) + 1, dones.shape[1])
+        self.lengths = None
+        if (lengths != dones.shape[1]).any():
+            final_nob[np.arange(len(lengths)), lengths-1] = -1
+            final_ob, final_nob, human_acts, ai_acts, dones, rews = self.flatten_steps(
+                lengths, final_ob, final_nob, human_acts, ai_acts, dones, rews
+            )
+            self.lengths = torch.as_tensor(lengths).to(device)
+            self.offsets = torch.as_tensor(np.concatenate([[0], np.cumsum(lengths)])).to(device)
+        self.obs = torch.as_tensor(final_ob).contiguous().to(device)
+        self.nobs = torch.as_tensor(final_nob).contiguous().to(device)
+        self.human_acts = torch.as_tensor(human_acts).contiguous().to(device)
+        self.ai_acts = torch.as_tensor(ai_acts).contiguous().to(device)
+        self.dones = torch.as_tensor(dones).contiguous().to(device)
+        self.rews = torch.as_tensor(rews).contiguous().to(device)
+
+        self.generator = torch.Generator()
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+        self.order = None
+        self.position = 0
+        self.epochs = 0
+
+    @classmethod
+    def from_data(cls, generator, data, encoding="index", dtype=np.float32, device="cpu", seed=None):
+        # Builds the dataset from generated or loaded episodes
+        obs, ai_acts, human_acts, dones, rews = generator.to_vector_form(
+            generator.remove_latent_vars(data), encoding=encoding, dtype=dtype
+        )
+        return cls(obs, ai_acts, human_acts, dones, rews, device=device, seed=seed)
+
+    @staticmethod
+    def flatten_steps(lengths, final_ob, final_nob, human_acts, ai_acts, dones, rews):
+        # Real steps of every array followed by one padding row, which padded batch entries
+        # gather from : -1 observations, zero actions (id 0 or zero one-hot), dones and rewards
+        mask = np.arange(dones.shape[1]) < lengths[:, None]
+        flat = []
+        for array, pad_value in [
+            (final_ob, -1), (final_nob, -1), (human_acts, 0), (ai_acts, 0), (dones, 0), (rews, 0)
+        ]:
+            array = np.asarray(array)
+            steps = array[mask]
+            flat.append(np.concatenate([steps, np.full((1,) + steps.shape[1:], pad_value, dtype=steps.dtype)]))
+        return flat
+
+    def __len__(self):
+        if self.lengths is not None:
+            return self.lengths.size()[0]
+        return self.obs.size()[0]
+
+    @property
+    def nbytes(self):
+        return sum(
+            tensor.numel()*tensor.element_size()
+            for tensor in [self.obs, self.nobs, self.human_acts, self.ai_acts, self.dones, self.rews]
+        )
+
+    def reshuffle(self):
+        self.order = torch.randperm(len(self), generator=self.generator).to(self.device)
+        self.position = 0
+        self.epochs += 1
+
+    def sample_ids(self, batch_size):
+        # Every episode is used once per epoch, the remainder of an epoch is dropped
+        if self.order is None or self.position + batch_size > len(self):
+            self.reshuffle()
+        episode_ids = self.order[self.position:self.position+batch_size]
+        self.position += batch_size
+        return episode_ids
+
+    def get(self, episode_ids):
+        if self.lengths is not None:
+            return self.get_padded(episode_ids)
+        return (
+            self.obs[episode_ids], self.human_acts[episode_ids], self.ai_acts[episode_ids],
+            self.dones[episode_ids], self.rews[episode_ids], self.nobs[episode_ids]
+        )
+
+    def get_padded(self, episode_ids):
+        lengths = self.lengths[episode_ids]
+        steps = torch.arange(int(lengths.max()), device=self.lengths.device)
+        step_ids = torch.where(
+            steps < lengths[:, None], self.offsets[episode_ids][:, None] + steps, self.dones.size()[0] - 1
+        )
+        return (
+            self.obs[step_ids], self.human_acts[step_ids], self.ai_acts[step_ids],
+            self.dones[step_ids], self.rews[step_ids], self.nobs[step_ids], lengths
+        )
+
+    def sample(self, batch_size):
+        return self.get(self.sample_ids(batch_size))
+
+
+class PrefetchLoader(object):
+    """
+    Iterates over minibatches of an OfflineDataset while a background thread gathers the
+    next queue_depth batches. Batches are written into a ring of preallocated buffers
+    (pinned when copying to a CUDA device), a buffer is reused once the batch after it has
+    been handed out. Batches of variable length episodes change shape, their slots hold
+    the gathered batches instead. A thread is enough since the tensor gathers run outside the GIL.
+    stall_time is the time the training loop spent waiting for input, producer_wait the
+    time the thread spent waiting for a free buffer.
+    Use as a context manager or call close() to stop the thread.
+    """
+    def __init__(self, dataset, batch_size, num_batches=None, queue_depth=2, device=None, pin_memory=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.queue_depth = queue_depth
+        self.device = dataset.device if device is None else device
+        if pin_memory is None:
+            pin_memory = (
+                torch.cuda.is_available() and torch.device(self.device).type == "cuda" and
+                torch.device(dataset.device).type == "cpu"
+            )
+        self.pin_memory = pin_memory
+
+        # One buffer per queued batch plus the one the training loop is using
+        self.slots = [self.allocate_slot() for _ in range(queue_depth+1)]
+        self.copy_events = [None] * len(self.slots)
+        self.free_slots = queue.Queue()
+        for slot_id in range(len(self.slots)):
+            self.free_slots.put(slot_id)
+        self.ready = queue.Queue(maxsize=queue_depth)
+        self.in_use = None
+
+        self.batches = 0
+        self.stall_time = 0.0
+        self.producer_wait = 0.0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def allocate_slot(self):
+        if self.dataset.lengths is not None:
+            return None
+        slot = []
+        for source in self.sources():
+            buffer = torch.empty(
+                (self.batch_size,) + tuple(source.size()[1:]), dtype=source.dtype, device=source.device
+            )
+            slot.append(buffer.pin_memory() if self.pin_memory else buffer)
+        return slot
+
+    def fill(self):
+        produced = 0
+        try:
+            while not self.stop_event.is_set():
+                if self.num_batches is not None and produced >= self.num_batches:
+                    break
+                start = time.perf_counter()
+                slot_id = self.get_with_stop(self.free_slots)
+                self.producer_wait += time.perf_counter() - start
+                if slot_id is None:
+                    break
+                if self.copy_events[slot_id] is not None:
+                    # The device copy out of a pinned buffer may still be running
+                    self.copy_events[slot_id].synchronize()
+                    self.copy_events[slot_id] = None
+
+                episode_ids = self.dataset.sample_ids(self.batch_size)
+                if self.dataset.lengths is not None:
+                    batch = self.dataset.get(episode_ids)
+                    self.slots[slot_id] = [tensor.pin_memory() if self.pin_memory else tensor for tensor in batch]
+                else:
+                    for source, buffer in zip(self.sources(), self.slots[slot_id]):
+                        torch.index_select(source, 0, episode_ids, out=buffer)
+                if not self.put_with_stop(self.ready, slot_id):
+                    break
+                produced += 1
+            self.put_with_stop(self.ready, None)
+        except Exception as error:
+            self.put_with_stop(self.ready, error)
+
+    def sources(self):
+        # Same order as OfflineDataset.get
+        dataset = self.dataset
+        return [dataset.obs, dataset.human_acts, dataset.ai_acts, dataset.dones, dataset.rews, dataset.nobs]
+
+    def get_with_stop(self, source_queue):
+        while not self.stop_event.is_set():
+            try:
+                return source_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def put_with_stop(self, target_queue, item):
+        while not self.stop_event.is_set():
+            try:
+                target_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.stop_event.is_set():
+            raise StopIteration
+        self.release()
+        start = time.perf_counter()
+        slot_id = self.ready.get()
+        self.stall_time += time.perf_counter() - start
+        if isinstance(slot_id, Exception):
+            self.close()
+            raise slot_id
+        if slot_id is None:
+            self.close()
+            raise StopIteration
+
+        self.in_use = slot_id
+        self.batches += 1
+        batch = self.slots[slot_id]
+        if torch.device(self.device) != batch[0].device:
+            batch = [buffer.to(self.device, non_blocking=self.pin_memory) for buffer in batch]
+            if self.pin_memory:
+                self.copy_events[slot_id] = torch.cuda.Event()
+                self.copy_events[slot_id].record()
+        return tuple(batch)
+
+    def release(self):
+        # The previously returned batch is done with once the next one is asked for
+        if self.in_use is not None:
+            self.free_slots.put(self.in_use)
+            self.in_use = None
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "stall_time": self.stall_time,
+            "producer_wait": self.producer_wait,
+        }
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,32 +1,39 @@
 from MarkovDataGenerator import MarkovDataGenerator
+import os
 import numpy as np
 from scipy.special import softmax, logsumexp
 import matplotlib.pyplot as plt
 from agent import OfflineAHTAgent, OfflineAHTAgentV2
+from cache import DatasetCache
+from replay import OfflineDataset, PrefetchLoader
+from metrics import Metrics, StdoutSink
 
 if __name__ == "__main__":
-    hmm = MarkovDataGenerator()
-    sampled_sequences = hmm.generate_data(20000,15)
-    data = hmm.remove_latent_vars(sampled_sequences)
-    obs, AI_acts, human_acts, dones, rews = hmm.to_vector_form(data)
-    
+    # Timings, losses and throughput every 1000 updates
+    metrics = Metrics([StdoutSink()], interval=1000)
+    hmm = MarkovDataGenerator(metrics=metrics)
+
+    # Generated once per set of generator tables, later runs memory map the cached shards
+    dataset_cache = DatasetCache(os.path.join("datasets", "cache"))
+    dataset = dataset_cache.get_data(hmm, 20000, 15, seed=0)
+    print("Dataset cache : ", dataset_cache.stats())
+
     ego_agent = OfflineAHTAgentV2(
-        obs.shape[-1], AI_acts.shape[-1], human_acts.shape[-1], 64, 64, 32
+        len(hmm.case_data_vals), len(hmm.ai_advice_vals), len(hmm.human_answer_values), 64, 64, 32,
+        metrics=metrics
     )
 
+    # Observations, shifted observations and actions are built once, the loader gathers
+    # the next minibatches in the background while the agent trains
+    replay = OfflineDataset.from_data(hmm, dataset[:], seed=0)
+    metrics.emit()
+
     training_iters = 50000
     batch_size = 128
-    for _ in range(training_iters):
-        sampled_data_ids = np.random.choice(obs.shape[0], 128, replace=False)
-        ob, act, human_act, done, rew = obs[sampled_data_ids], AI_acts[sampled_data_ids], human_acts[sampled_data_ids], dones[sampled_data_ids], rews[sampled_data_ids]
-        prev_acts = -np.ones_like(human_act)
-        prev_acts[:, 1:, :] = human_act[:, :-1, :]
-        final_ob = np.concatenate([ob, prev_acts], axis=-1)
-        final_nob = -np.ones_like(final_ob)
-        final_nob[:, :-1, :] = final_ob[:, 1:, :]
-
-        ego_agent.train(final_ob, human_act, act, done, rew, final_nob)
+    with PrefetchLoader(replay, batch_size, training_iters, queue_depth=4, device=ego_agent.device) as loader:
+        for batch in loader:
+            ego_agent.train(*batch)
+        print("Input pipeline : ", loader.stats())
+    metrics.close()
 
     print("OK!!!")
-
-
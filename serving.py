@@ -0,0 +1,339 @@
+import argparse
+import asyncio
+import time
+from collections import OrderedDict
+import numpy as np
+import torch
+from agent import OfflineAHTAgentV2, obs_to_tensor
+from MarkovDataGenerator import MarkovDataGenerator
+
+
+class SessionPool(object):
+    """
+    Recurrent state of many advising sessions, kept in preallocated (1, max_sessions, lstm_dim)
+    hidden and cell tensors with one slot per session. New sessions start from a zero state.
+    Sessions idle for more than idle_timeout seconds are evicted. A live session is never
+    evicted to make room, acquiring a slot for a new session fails when every slot is taken.
+    """
+    def __init__(self, max_sessions, lstm_dim, device="cpu", dtype=torch.float32, idle_timeout=None):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.hiddens = torch.zeros(1, max_sessions, lstm_dim, device=device, dtype=dtype)
+        self.cells = torch.zeros(1, max_sessions, lstm_dim, device=device, dtype=dtype)
+        self.slots = {}
+        # Ordered from least to most recently seen
+        self.last_seen = OrderedDict()
+        self.free_slots = list(range(max_sessions-1, -1, -1))
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, session_id):
+        return session_id in self.slots
+
+    @property
+    def num_free(self):
+        return len(self.free_slots)
+
+    def acquire(self, session_id, now):
+        # Slot of session_id, assigning a fresh one to new sessions
+        slot = self.slots.get(session_id)
+        if slot is None:
+            if not self.free_slots:
+                raise RuntimeError("All {} session slots are in use".format(self.max_sessions))
+            slot = self.free_slots.pop()
+            self.hiddens[:, slot] = 0
+            self.cells[:, slot] = 0
+            self.slots[session_id] = slot
+        self.last_seen[session_id] = now
+        self.last_seen.move_to_end(session_id)
+        return slot
+
+    def release(self, session_id):
+        slot = self.slots.pop(session_id, None)
+        if slot is not None:
+            del self.last_seen[session_id]
+            self.free_slots.append(slot)
+
+    def evict_idle(self, now):
+        if self.idle_timeout is None:
+            return []
+        idle = []
+        for session_id, seen in self.last_seen.items():
+            if now - seen <= self.idle_timeout:
+                break
+            idle.append(session_id)
+        for session_id in idle:
+            self.release(session_id)
+        self.evictions += len(idle)
+        return idle
+
+    def gather(self, slots):
+        return self.hiddens.index_select(1, slots), self.cells.index_select(1, slots)
+
+    def scatter(self, slots, lstm_hiddens):
+        self.hiddens.index_copy_(1, slots, lstm_hiddens[0].to(self.hiddens.dtype))
+        self.cells.index_copy_(1, slots, lstm_hiddens[1].to(self.cells.dtype))
+
+
+class AdvisingServer(object):
+    """
+    Serves act() for many concurrent advising sessions with one agent.
+    Requests are queued and gathered into micro-batches of at most max_batch_size, a batch
+    is run as soon as it is full or max_latency seconds after its first request arrived.
+    Each batch is a single encoder/decoder/Q forward under inference_mode on the sessions'
+    states from a SessionPool. A session has at most one step in a batch, a second
+    request of the same session waits for the next batch. A new session's requests wait
+    until a session slot is free (a session ends or is evicted after idle_timeout), live
+    sessions keep their state.
+
+        async with AdvisingServer(agent) as server:
+            action = await server.act(session_id, (case_id, previous_decision_id))
+    """
+    def __init__(self, agent, max_sessions=4096, max_batch_size=256, max_latency=0.002, idle_timeout=600.0):
+        self.agent = agent
+        self.pool = SessionPool(max_sessions, agent.lstm_dim, agent.device, agent.dtype, idle_timeout)
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        # How often idle sessions are looked for
+        self.eviction_interval = 1.0 if idle_timeout is None else min(idle_timeout / 10, 1.0)
+        self.queue = None
+        self.deferred = []
+        self.slot_freed = None
+        self.waiting_sessions = set()
+        self.worker = None
+        self.last_eviction = time.monotonic()
+        self.batches = 0
+        self.requests = 0
+        self.slot_waits = 0
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.slot_freed = asyncio.Event()
+        self.worker = asyncio.get_running_loop().create_task(self.serve())
+
+    async def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        # Requests still waiting are failed rather than left hanging
+        pending = self.deferred
+        self.deferred = []
+        while self.queue is not None and not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        for _, _, future in pending:
+            if not future.done():
+                future.set_exception(RuntimeError("Server closed"))
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def act(self, session_id, obs):
+        # obs is one step's observation, a (case id, previous decision id) pair or one-hot features
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((session_id, obs, future))
+        return await future
+
+    def end_session(self, session_id):
+        self.pool.release(session_id)
+        if self.slot_freed is not None:
+            self.slot_freed.set()
+
+    async def next_batch(self):
+        batch = self.deferred
+        self.deferred = []
+        if not batch:
+            batch.append(await self.queue.get())
+        deadline = time.perf_counter() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def admit(self, batch):
+        # Requests that can run now : at most max_batch_size, one per session, and new
+        # sessions only while there are free slots. The others are deferred in order.
+        sessions = set()
+        unique_batch = []
+        free_slots = self.pool.num_free
+        for request in batch:
+            session_id = request[0]
+            is_new = session_id not in self.pool
+            if is_new and free_slots == 0 and session_id not in sessions:
+                # Counted once per session that has to wait for a slot
+                if session_id not in self.waiting_sessions:
+                    self.waiting_sessions.add(session_id)
+                    self.slot_waits += 1
+                self.deferred.append(request)
+            elif session_id in sessions or len(unique_batch) == self.max_batch_size:
+                self.deferred.append(request)
+            else:
+                sessions.add(session_id)
+                unique_batch.append(request)
+                self.waiting_sessions.discard(session_id)
+                free_slots -= is_new
+        return unique_batch
+
+    async def wait_for_slot(self):
+        # Every waiting request belongs to a new session, wait until a session ends, a new
+        # request arrives or it's time to look for idle sessions
+        self.slot_freed.clear()
+        request = asyncio.ensure_future(self.queue.get())
+        slot_freed = asyncio.ensure_future(self.slot_freed.wait())
+        done, pending = await asyncio.wait(
+            [request, slot_freed], timeout=self.eviction_interval, return_when=asyncio.FIRST_COMPLETED
+        )
+        for task in pending:
+            task.cancel()
+        if request in done:
+            self.deferred.append(request.result())
+
+    async def serve(self):
+        while True:
+            batch = await self.next_batch()
+            unique_batch = self.admit(batch)
+            if unique_batch:
+                try:
+                    actions = self.run_batch(unique_batch)
+                except Exception as error:
+                    for _, _, future in unique_batch:
+                        if not future.done():
+                            future.set_exception(error)
+                else:
+                    for (_, _, future), action in zip(unique_batch, actions):
+                        if not future.done():
+                            future.set_result(action)
+
+            now = time.monotonic()
+            if now - self.last_eviction > self.eviction_interval:
+                if self.pool.evict_idle(now):
+                    self.slot_freed.set()
+                self.last_eviction = now
+            if unique_batch:
+                # Let the sessions that were just answered queue their next steps
+                await asyncio.sleep(0)
+            else:
+                await self.wait_for_slot()
+
+    def run_batch(self, batch):
+        now = time.monotonic()
+        slots = [self.pool.acquire(request[0], now) for request in batch]
+        slots = torch.as_tensor(slots, device=self.agent.device)
+
+        with torch.inference_mode():
+            obs_tensor = obs_to_tensor(
+                np.stack([request[1] for request in batch]), self.agent.state_size,
+                self.agent.human_action_size, self.agent.device, self.agent.dtype
+            )
+            actions, updated_hiddens = self.agent.act_step(obs_tensor, self.pool.gather(slots))
+            self.pool.scatter(slots, updated_hiddens)
+
+        self.batches += 1
+        self.requests += len(batch)
+        return actions.tolist()
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": self.requests / max(self.batches, 1),
+            "active_sessions": len(self.pool),
+            "evictions": self.pool.evictions,
+            "slot_waits": self.slot_waits,
+        }
+
+
+async def load_test(server, num_sessions, steps_per_session, think_time=0.0, seed=0):
+    """
+    Runs num_sessions simulated sessions of steps_per_session steps against server, every
+    session waits for its action and then think_time seconds (exponentially distributed)
+    before the next step. Observations are random case and decision ids.
+    Returns latency percentiles (seconds) and throughput (requests per second).
+    """
+    rng = np.random.default_rng(seed)
+    num_cases = server.agent.state_size
+    num_decisions = server.agent.human_action_size
+    latencies = []
+
+    async def session(session_id):
+        previous_decision = -1
+        for _ in range(steps_per_session):
+            obs = np.array([rng.integers(num_cases), previous_decision])
+            start = time.perf_counter()
+            await server.act(session_id, obs)
+            latencies.append(time.perf_counter() - start)
+            previous_decision = rng.integers(num_decisions)
+            if think_time > 0:
+                await asyncio.sleep(rng.exponential(think_time))
+        server.end_session(session_id)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[session(session_id) for session_id in range(num_sessions)])
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies)
+    return {
+        "requests": len(latencies),
+        "seconds": elapsed,
+        "throughput": len(latencies) / elapsed,
+        "p50_latency": float(np.percentile(latencies, 50)),
+        "p99_latency": float(np.percentile(latencies, 99)),
+    }
+
+
+async def run_load_test(agent, args):
+    async with AdvisingServer(
+        agent, max_sessions=args.max_sessions, max_batch_size=args.max_batch_size,
+        max_latency=args.max_latency, idle_timeout=args.idle_timeout
+    ) as server:
+        results = await load_test(server, args.sessions, args.steps, args.think_time, args.seed)
+        results.update(server.stats())
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local load test of the batched advising server")
+    parser.add_argument("--checkpoint", help="Agent checkpoint saved with agent.save(), random weights otherwise")
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--steps", type=int, default=15)
+    parser.add_argument("--think-time", type=float, default=0.0)
+    parser.add_argument("--max-sessions", type=int, default=4096)
+    parser.add_argument("--max-batch-size", type=int, default=256)
+    parser.add_argument("--max-latency", type=float, default=0.002)
+    parser.add_argument("--idle-timeout", type=float, default=600.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    hmm = MarkovDataGenerator()
+    ego_agent = OfflineAHTAgentV2(
+        len(hmm.case_data_vals), len(hmm.ai_advice_vals), len(hmm.human_answer_values), 64, 64, 32
+    )
+    if args.checkpoint is not None:
+        ego_agent.load(args.checkpoint)
+
+    results = asyncio.run(run_load_test(ego_agent, args))
+    print("Requests : {requests} in {seconds:.2f}s, {throughput:.0f} requests/s".format(**results))
+    print("Latency : p50 {:.2f}ms, p99 {:.2f}ms".format(results["p50_latency"]*1e3, results["p99_latency"]*1e3))
+    print(
+        "Batches : {batches}, mean size {mean_batch_size:.1f}, evictions {evictions}, "
+        "slot waits {slot_waits}".format(**results)
+    )
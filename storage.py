@@ -0,0 +1,209 @@
+import json
+import os
+import numpy as np
+from episodes import EpisodeStore
+
+MANIFEST_NAME = "manifest.json"
+FORMAT_VERSION = 1
+
+
+class DatasetWriter(object):
+    """
+    Writes EpisodeStores as a sharded on-disk dataset. Every write() call becomes one shard
+    directory holding one .npy file per column, the manifest is written on close().
+    Columns are (num_episodes, interaction_length, ...) arrays. Datasets of variable length
+    episodes are stored without padding, as (total_steps, ...) arrays of the real steps with
+    the offsets of every episode's first step (see EpisodeStore.flat_columns).
+
+    Layout :
+        path/manifest.json
+        path/shard_00000/case.npy, advice.npy, ..., cont_input.npy
+        (and offsets.npy for datasets of variable length episodes)
+    """
+    def __init__(self, path, vocabs, generator_params=None):
+        self.path = path
+        self.vocabs = vocabs
+        self.generator_params = generator_params
+        self.shards = []
+        self.columns = None
+        self.layout = None
+        self.num_episodes = 0
+        self.interaction_length = None
+        os.makedirs(self.path, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def write(self, store):
+        layout = "padded" if store.lengths is None else "flat"
+        columns = self.all_columns(store)
+        if self.interaction_length is None:
+            self.interaction_length = store.interaction_length
+            self.layout = layout
+            # Shape of a row : an episode of the padded layout, a step of the flat one
+            self.columns = {
+                name: {"dtype": column.dtype.str, "shape": list(column.shape[1:])}
+                for name, column in columns.items() if name != "offsets"
+            }
+        elif store.interaction_length != self.interaction_length:
+            raise ValueError("All shards must have the same interaction length")
+        elif layout != self.layout:
+            raise ValueError("Shards of fixed and variable length episodes can't be mixed")
+
+        shard_dir = "shard_{:05d}".format(len(self.shards))
+        os.makedirs(os.path.join(self.path, shard_dir), exist_ok=True)
+        files = {}
+        for name, column in columns.items():
+            files[name] = os.path.join(shard_dir, name + ".npy")
+            np.save(os.path.join(self.path, files[name]), np.ascontiguousarray(column))
+
+        self.shards.append({"start": self.num_episodes, "num_episodes": len(store), "files": files})
+        self.num_episodes += len(store)
+
+    def all_columns(self, store):
+        if store.lengths is None:
+            columns = dict(store.data)
+            cont_input = store.cont_input
+        else:
+            columns, cont_input, offsets = store.flat_columns()
+            columns["offsets"] = offsets
+        if cont_input is not None:
+            columns["cont_input"] = cont_input
+        return columns
+
+    def close(self):
+        manifest = {
+            "format_version": FORMAT_VERSION,
+            "num_episodes": self.num_episodes,
+            "interaction_length": self.interaction_length,
+            "layout": self.layout,
+            "columns": self.columns,
+            "vocabs": self.vocabs,
+            "shards": self.shards,
+            "generator": self.generator_params,
+        }
+        # Write to a temporary file first so readers never see a half written manifest
+        tmp_path = os.path.join(self.path, MANIFEST_NAME + ".tmp")
+        with open(tmp_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST_NAME))
+
+
+class ShardedEpisodes(object):
+    """
+    Read side of DatasetWriter. Shards are memory mapped read-only, so opening a dataset
+    doesn't read it and processes loading the same dataset share its pages through the
+    OS page cache. Indexing gathers the requested episodes into an in-memory EpisodeStore,
+    episodes of flat shards are padded to interaction_length on the way.
+    """
+    def __init__(self, path, mmap_mode="r"):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_NAME)) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        if self.manifest["format_version"] != FORMAT_VERSION:
+            raise ValueError("Unsupported dataset format version : " + str(self.manifest["format_version"]))
+
+        self.vocabs = self.manifest["vocabs"]
+        self.num_episodes = self.manifest["num_episodes"]
+        self.interaction_length = self.manifest["interaction_length"]
+        self.generator_params = self.manifest["generator"]
+        self.shards = []
+        for shard in self.manifest["shards"]:
+            columns = {
+                name: np.load(os.path.join(path, file_name), mmap_mode=mmap_mode)
+                for name, file_name in shard["files"].items()
+            }
+            cont_input = columns.pop("cont_input", None)
+            if "offsets" in columns:
+                offsets = columns.pop("offsets")
+                self.shards.append(FlatShard(self.vocabs, columns, cont_input, offsets, self.interaction_length))
+            else:
+                self.shards.append(EpisodeStore(self.vocabs, columns, cont_input))
+        self.shard_starts = np.array([shard["start"] for shard in self.manifest["shards"]], dtype=np.int64)
+
+    def __len__(self):
+        return self.num_episodes
+
+    def __getitem__(self, episode_ids):
+        # Any index EpisodeStore takes (int, slice, negative ids, masks), as an array of ids
+        episode_ids = np.arange(self.num_episodes)[episode_ids]
+        if episode_ids.ndim == 0:
+            return self[episode_ids[None]][0]
+        if len(self.shards) == 1 or len(episode_ids) == 0:
+            return self.shards[0][episode_ids]
+
+        shard_ids = np.searchsorted(self.shard_starts, episode_ids, side="right") - 1
+        parts = []
+        for shard_id in np.unique(shard_ids):
+            rows = np.nonzero(shard_ids == shard_id)[0]
+            parts.append((rows, self.shards[shard_id][episode_ids[rows] - self.shard_starts[shard_id]]))
+
+        first_part = parts[0][1]
+        columns = {
+            name: np.empty((len(episode_ids),) + column.shape[1:], dtype=column.dtype)
+            for name, column in first_part.data.items()
+        }
+        cont_input = None
+        if first_part.cont_input is not None:
+            cont_input = np.empty((len(episode_ids),) + first_part.cont_input.shape[1:], dtype=first_part.cont_input.dtype)
+        lengths = None
+        if first_part.lengths is not None:
+            lengths = np.empty(len(episode_ids), dtype=first_part.lengths.dtype)
+        for rows, shard_part in parts:
+            for name, column in columns.items():
+                column[rows] = shard_part.data[name]
+            if cont_input is not None:
+                cont_input[rows] = shard_part.cont_input
+            if lengths is not None:
+                lengths[rows] = shard_part.lengths
+
+        return EpisodeStore(self.vocabs, columns, cont_input, lengths)
+
+    def iter_shards(self):
+        # Padded shards are the memory mapped arrays, flat ones are padded in memory
+        for shard in self.shards:
+            yield shard if isinstance(shard, EpisodeStore) else shard[:]
+
+
+class FlatShard(object):
+    """
+    Memory mapped shard of variable length episodes, flat (total_steps, ...) columns with
+    the offsets of every episode's first step. Indexing returns a padded EpisodeStore.
+    """
+    def __init__(self, vocabs, columns, cont_input, offsets, interaction_length):
+        self.vocabs = vocabs
+        self.columns = columns
+        self.cont_input = cont_input
+        self.offsets = offsets
+        self.interaction_length = interaction_length
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, episode_ids):
+        if isinstance(episode_ids, slice):
+            episode_ids = np.arange(len(self))[episode_ids]
+        return EpisodeStore.from_flat(
+            self.vocabs, self.columns, self.cont_input, self.offsets, self.interaction_length, episode_ids
+        )
+
+
+def write_dataset(generator, path, num_data, interaction_length, seed=None, shard_size=65536):
+    # Streams generated episodes into a sharded dataset, at most one shard is held in memory
+    generator_params = {
+        "num_data": num_data, "interaction_length": interaction_length, "seed": seed,
+        "tables": generator.table_spec(),
+    }
+    with DatasetWriter(path, generator.episode_vocabs, generator_params) as writer:
+        for chunk in generator.iter_data(num_data, interaction_length, shard_size, seed=seed, vectorize=False):
+            writer.write(chunk)
+
+    return ShardedEpisodes(path)
+
+
+def load_dataset(path, mmap_mode="r"):
+    return ShardedEpisodes(path, mmap_mode=mmap_mode)
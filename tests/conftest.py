@@ -0,0 +1,65 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+from MarkovDataGenerator import MarkovDataGenerator, default_spec
+
+
+def stopping_spec(stop_probs=0.2, min_length=2):
+    return dict(default_spec(), termination={"stop_probs": stop_probs, "min_length": min_length})
+
+
+def assert_same_episodes(store, expected):
+    assert set(store.data) == set(expected.data)
+    for name in expected.data:
+        assert np.array_equal(store.data[name], expected.data[name])
+    if expected.cont_input is None:
+        assert store.cont_input is None
+    else:
+        assert np.array_equal(store.cont_input, expected.cont_input)
+    if expected.lengths is None:
+        assert store.lengths is None
+    else:
+        assert np.array_equal(store.lengths, expected.lengths)
+
+
+@pytest.fixture(scope="session")
+def generator():
+    return MarkovDataGenerator()
+
+
+@pytest.fixture(scope="session")
+def stopping_generator():
+    return MarkovDataGenerator(stopping_spec())
+
+
+def small_spec(case_schedule="cycle", termination=None, seed=0):
+    # Random tables over 2 cases, types and trust levels, small enough to enumerate episodes
+    rng = np.random.default_rng(seed)
+    num_types, num_trust, num_cases, num_advice, num_decisions, num_outcomes = 2, 2, 2, 3, 2, 2
+    spec = {
+        "type_vals": ["1", "2"],
+        "trust_vals": ["L", "H"],
+        "ai_advice_vals": ["X", "Y", "W"],
+        "human_answer_values": ["X", "Y"],
+        "case_data_vals": ["T1", "T2"],
+        "outcome_vals": ["G", "B"],
+        "num_case_features": 2,
+        "type_probs": rng.dirichlet(np.ones(num_types)),
+        "init_trust_prior": rng.dirichlet(np.ones(num_trust), size=num_types),
+        "ai_advice_probs": rng.dirichlet(np.ones(num_advice), size=num_cases),
+        "outcome_probs": rng.dirichlet(np.ones(num_outcomes), size=(num_cases, num_decisions)),
+        "acceptance_probs": rng.dirichlet(np.ones(num_decisions), size=(num_types, num_cases, num_advice, num_trust)),
+        "trust_update_rates": rng.uniform(0.2, 0.8, size=(num_types, num_cases)),
+        "outcome_blind_cases": np.array([[True, False], [False, False]]),
+        "case_schedule": case_schedule,
+    }
+    if termination is not None:
+        spec["termination"] = termination
+    return spec
+
+
+SCHEDULES = ["cycle", {"kind": "cycle", "random_start": True}, {"kind": "random", "probs": [0.3, 0.7]}]
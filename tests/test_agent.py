@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+import torch
+from agent import OfflineAHTAgent, OfflineAHTAgentV2, obs_to_tensor
+from replay import OfflineDataset
+
+
+def make_agent(cls, generator, seed=0, **kwargs):
+    torch.manual_seed(seed)
+    return cls(
+        len(generator.case_data_vals), len(generator.ai_advice_vals), len(generator.human_answer_values),
+        16, 16, 8, **kwargs
+    )
+
+
+def train_steps(agent, dataset, ids):
+    for episode_ids in ids:
+        agent.train(*dataset.get(episode_ids))
+    return [param.detach().clone() for param in agent.optimizer.param_groups[0]["params"]]
+
+
+def test_rejects_unsigned_observations():
+    obs = np.zeros((2, 3, 5), dtype=np.uint8)
+    with pytest.raises(ValueError):
+        obs_to_tensor(obs, 3, 2, "cpu", torch.float32)
+
+
+@pytest.mark.parametrize("cls", [OfflineAHTAgent, OfflineAHTAgentV2])
+def test_index_and_onehot_inputs_train_identically(generator, cls):
+    data = generator.generate_data(32, 8, seed=0)
+    ids = [torch.arange(start, start+8) for start in range(0, 32, 8)]
+    results = []
+    for encoding, dtype in [("index", np.float32), ("onehot", np.float32), ("onehot", np.uint8)]:
+        dataset = OfflineDataset.from_data(generator, data, encoding=encoding, dtype=dtype)
+        results.append(train_steps(make_agent(cls, generator), dataset, ids))
+    for params in results[1:]:
+        assert all(torch.equal(a, b) for a, b in zip(results[0], params))
+
+
+@pytest.mark.parametrize("variable_length", [False, True])
+def test_train_rejects_unshifted_next_observations(generator, stopping_generator, variable_length):
+    g = stopping_generator if variable_length else generator
+    dataset = OfflineDataset.from_data(g, g.generate_data(16, 8, seed=0))
+    batch = list(dataset.get(torch.arange(16)))
+    agent = make_agent(OfflineAHTAgentV2, g)
+    agent.train(*batch)
+
+    batch[5] = batch[0].clone()
+    with pytest.raises(ValueError):
+        agent.train(*batch)
+
+
+@pytest.mark.parametrize("per_step_reset", [False, True])
+@pytest.mark.parametrize("cls", [OfflineAHTAgent, OfflineAHTAgentV2])
+def test_packed_losses_match_padded_episodes(stopping_generator, cls, per_step_reset):
+    dataset = OfflineDataset.from_data(
+        stopping_generator, stopping_generator.generate_data(12, 8, seed=0), encoding="onehot", dtype=np.float32
+    )
+    agent = make_agent(cls, stopping_generator, per_step_reset=per_step_reset)
+    obs, human_acts, ai_acts, dones, rews, nobs, lengths = dataset.get(torch.arange(12))
+    assert (lengths < 8).any()
+    with torch.no_grad():
+        packed = agent.compute_losses(obs, human_acts, ai_acts, dones, rews, nobs, lengths)
+
+        # Every episode on its own, truncated to its real steps, weighted by its number of steps
+        expected = torch.zeros(3)
+        for episode, length in enumerate(lengths.tolist()):
+            steps = slice(episode, episode+1), slice(0, length)
+            losses = agent.compute_losses(
+                obs[steps], human_acts[steps], ai_acts[steps], dones[steps], rews[steps], nobs[steps]
+            )
+            expected += torch.stack(losses) * length / lengths.sum()
+    torch.testing.assert_close(torch.stack(packed), expected, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("cls", [OfflineAHTAgent, OfflineAHTAgentV2])
+def test_packed_losses_of_full_length_episodes_match_fixed_losses(generator, cls):
+    dataset = OfflineDataset.from_data(generator, generator.generate_data(16, 8, seed=0), encoding="onehot", dtype=np.float32)
+    agent = make_agent(cls, generator)
+    batch = dataset.get(torch.arange(16))
+    with torch.no_grad():
+        fixed = agent.compute_losses(*batch)
+        packed = agent.compute_losses(*batch, torch.full((16,), 8))
+    torch.testing.assert_close(torch.stack(packed), torch.stack(fixed), rtol=1e-5, atol=1e-6)
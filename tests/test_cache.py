@@ -0,0 +1,53 @@
+import os
+import time
+import numpy as np
+import pytest
+from cache import DatasetCache
+
+
+def make_tmp_dir(cache_dir, name, age):
+    path = os.path.join(cache_dir, name)
+    os.makedirs(path)
+    with open(os.path.join(path, "part.npy"), "wb") as part_file:
+        part_file.write(b"0" * 100)
+    old = time.time() - age
+    for item in [os.path.join(path, "part.npy"), path]:
+        os.utime(item, (old, old))
+    return path
+
+
+def test_cached_data_matches_generated(generator, tmp_path):
+    cache = DatasetCache(str(tmp_path))
+    first = cache.get_data(generator, 50, 6, seed=3)[:]
+    second = cache.get_data(generator, 50, 6, seed=3)[:]
+    expected = generator.generate_data(50, 6, seed=3)
+    for name in expected.data:
+        assert np.array_equal(second.data[name], expected.data[name])
+        assert np.array_equal(first.data[name], expected.data[name])
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_stale_tmp_dirs_are_swept(generator, tmp_path):
+    stale = make_tmp_dir(str(tmp_path), "tmp-stale", age=7200)
+    building = make_tmp_dir(str(tmp_path), "tmp-building", age=10)
+    cache = DatasetCache(str(tmp_path), tmp_max_age=3600)
+    assert not os.path.exists(stale)
+    assert os.path.exists(building)
+    assert cache.stats()["tmp_bytes"] == 100
+
+    # Eviction sweeps too
+    stale = make_tmp_dir(str(tmp_path), "tmp-stale-2", age=7200)
+    cache.get_data(generator, 10, 3, seed=0)
+    assert not os.path.exists(stale)
+    assert os.path.exists(building)
+
+
+def test_failed_build_leaves_no_tmp_dir(tmp_path):
+    cache = DatasetCache(str(tmp_path))
+
+    def generate(entry_dir):
+        raise RuntimeError("generation failed")
+
+    with pytest.raises(RuntimeError):
+        cache.lookup("key", generate)
+    assert os.listdir(str(tmp_path)) == []
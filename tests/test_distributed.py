@@ -0,0 +1,56 @@
+import os
+import socket
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from MarkovDataGenerator import MarkovDataGenerator
+from agent import OfflineAHTAgentV2
+from distributed import make_distributed, shard_rows
+from replay import OfflineDataset
+from test_agent import make_agent
+
+NUM_UPDATES = 3
+BATCH_SIZE = 16
+MODULES = ["encoder", "decoder", "value_network", "target_value_network"]
+
+
+def batches(generator, rank=0, world_size=1):
+    dataset = OfflineDataset.from_data(generator, generator.generate_data(NUM_UPDATES * BATCH_SIZE, 8, seed=0))
+    for start in range(0, NUM_UPDATES * BATCH_SIZE, BATCH_SIZE):
+        yield dataset.get(torch.as_tensor(start + shard_rows(BATCH_SIZE, rank, world_size)))
+
+
+def train_worker(rank, world_size, port, path):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    torch.set_num_threads(1)
+    generator = MarkovDataGenerator()
+    # Ranks start from different weights, make_distributed broadcasts rank 0's
+    agent = make_agent(OfflineAHTAgentV2, generator, seed=rank, target_update_interval=2)
+    make_distributed(agent)
+    for batch in batches(generator, rank, world_size):
+        agent.train(*batch)
+    torch.save({module: getattr(agent, module).state_dict() for module in MODULES}, "{}.{}".format(path, rank))
+    dist.destroy_process_group()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_ranks_match_training_on_the_whole_batch(tmp_path):
+    path = str(tmp_path / "networks")
+    mp.spawn(train_worker, args=(2, free_port(), path), nprocs=2, join=True)
+
+    generator = MarkovDataGenerator()
+    agent = make_agent(OfflineAHTAgentV2, generator, seed=0, target_update_interval=2)
+    for batch in batches(generator):
+        agent.train(*batch)
+    for rank in range(2):
+        networks = torch.load("{}.{}".format(path, rank))
+        for module in MODULES:
+            for name, param in getattr(agent, module).state_dict().items():
+                torch.testing.assert_close(networks[module][name], param, rtol=0, atol=1e-5)
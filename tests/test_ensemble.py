@@ -0,0 +1,28 @@
+import copy
+import pytest
+import torch
+from agent import OfflineAHTAgent, OfflineAHTAgentV2
+from ensemble import AgentEnsemble
+from replay import OfflineDataset
+from test_agent import make_agent
+
+
+@pytest.mark.parametrize("cls", [OfflineAHTAgent, OfflineAHTAgentV2])
+def test_ensemble_matches_separately_trained_agents(generator, cls):
+    dataset = OfflineDataset.from_data(generator, generator.generate_data(64, 8, seed=0))
+    agents = [make_agent(cls, generator, seed=seed, target_update_interval=2) for seed in range(3)]
+    members = [copy.deepcopy(agent) for agent in agents]
+    ensemble = AgentEnsemble(members)
+
+    for start in range(0, 64, 16):
+        batch = dataset.get(torch.arange(start, start+16))
+        for agent in agents:
+            agent.train(*batch)
+        ensemble.train(*batch)
+    ensemble.write_back()
+
+    for agent, member in zip(agents, members):
+        for module in ["encoder", "decoder", "value_network", "target_value_network"]:
+            params = getattr(agent, module).state_dict()
+            for name, param in getattr(member, module).state_dict().items():
+                torch.testing.assert_close(param, params[name], rtol=0, atol=1e-5)
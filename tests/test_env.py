@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+from MarkovDataGenerator import MarkovDataGenerator
+from env import evaluate_policy
+from pomdp import AdvisingPOMDP
+from conftest import SCHEDULES, small_spec, stopping_spec
+
+SPECS = [None, stopping_spec()] + [small_spec(schedule) for schedule in SCHEDULES] + [
+    small_spec(termination={"stop_probs": [[0.2, 0.5], [0.1, 0.3]], "min_length": 2})
+]
+
+
+@pytest.mark.parametrize("spec", SPECS)
+def test_returns_match_exact_values_of_fixed_advice(spec):
+    generator = MarkovDataGenerator(spec)
+    pomdp = AdvisingPOMDP(generator, 5)
+    for action in range(len(generator.ai_advice_vals)):
+        exact = pomdp.evaluate_policy(lambda step, contexts, beliefs: np.full(len(contexts), action))[0]
+        results = evaluate_policy(
+            generator, lambda obs, state: (np.full(len(obs), action), state), 100000, 5, seed=action
+        )
+        assert abs(results["mean_return"] - exact) < 4 * results["return_stderr"]
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from MarkovDataGenerator import MarkovDataGenerator
+from episodes import EpisodeStore
+from conftest import SCHEDULES, assert_same_episodes, small_spec, stopping_spec
+
+GENERATOR_SPECS = [None, stopping_spec()]
+MARGINAL_SPECS = GENERATOR_SPECS + [small_spec(schedule) for schedule in SCHEDULES]
+
+
+@pytest.mark.parametrize("spec", GENERATOR_SPECS)
+def test_seeded_data_is_reproducible(spec):
+    g = MarkovDataGenerator(spec)
+    assert_same_episodes(g.generate_data(500, 10, seed=7), g.generate_data(500, 10, seed=7))
+
+
+def test_seeds_give_different_data(generator):
+    first = generator.generate_data(100, 10, seed=0)
+    second = generator.generate_data(100, 10, seed=1)
+    assert not np.array_equal(first.data["decision"], second.data["decision"])
+
+
+def test_trust_transition_table_matches_branch_logic(generator):
+    assert generator.verify_trust_transitions() == []
+
+
+@pytest.mark.parametrize("spec", GENERATOR_SPECS)
+def test_iter_data_is_chunk_size_invariant(spec):
+    g = MarkovDataGenerator(spec)
+    g.seed_block_size = 256
+    expected = g.generate_data(1000, 10, seed=7)
+    for chunk_size in [1, 97, 256, 1000, 4096]:
+        chunks = list(g.iter_data(1000, 10, chunk_size, seed=7, vectorize=False))
+        assert all(len(chunk) == chunk_size for chunk in chunks[:-1])
+        assert_same_episodes(EpisodeStore.concatenate(chunks), expected)
+
+    vectors = list(g.iter_data(1000, 10, 300, seed=7))
+    expected_vectors = g.to_vector_form(g.remove_latent_vars(expected))
+    for column, expected_column in enumerate(expected_vectors):
+        assert np.array_equal(np.concatenate([chunk[column] for chunk in vectors]), expected_column)
+
+
+@pytest.mark.parametrize("spec", GENERATOR_SPECS)
+def test_generate_data_is_worker_invariant(spec):
+    g = MarkovDataGenerator(spec)
+    g.seed_block_size = 256
+    expected = g.generate_data(1000, 10, seed=7)
+    assert_same_episodes(g.generate_data(1000, 10, seed=7, num_workers=2), expected)
+
+
+@pytest.mark.parametrize("spec", MARGINAL_SPECS)
+def test_exact_marginals_match_sampled_frequencies(spec):
+    g = MarkovDataGenerator(spec)
+    exact = g.exact_marginals(10)
+    empirical = g.empirical_marginals(g.generate_data(100000, 10, seed=0))
+    for name in ["type_trust", "case", "advice", "decision", "outcome"]:
+        # Frequencies of 100000 episodes are within about 0.005 (3 standard deviations)
+        np.testing.assert_allclose(empirical[name], exact[name], atol=0.01)
+    if g.variable_length:
+        np.testing.assert_allclose(empirical["alive"], exact["alive"], atol=0.01)
@@ -0,0 +1,76 @@
+import itertools
+import numpy as np
+import pytest
+from MarkovDataGenerator import MarkovDataGenerator
+from episodes import EpisodeStore
+from inference import ExactInference
+from conftest import SCHEDULES, small_spec
+
+TERMINATION = {"stop_probs": [[0.2, 0.5], [0.1, 0.3]], "min_length": 2}
+
+
+def all_episodes(generator, interaction_length, variable_length):
+    # Every observation sequence of every possible length, padded with -1
+    step_values = list(itertools.product(
+        range(len(generator.case_data_vals)), range(len(generator.ai_advice_vals)),
+        range(len(generator.human_answer_values)), range(len(generator.outcome_vals))
+    ))
+    rows, lengths = [], []
+    for length in range(1, interaction_length+1) if variable_length else [interaction_length]:
+        for steps in itertools.product(step_values, repeat=length):
+            rows.append(list(steps) + [(-1, -1, -1, -1)] * (interaction_length-length))
+            lengths.append(length)
+    rows = np.array(rows)
+    columns = {name: rows[:, :, column].astype(np.int8) for column, name in enumerate(["case", "advice", "decision", "outcome_val"])}
+    return EpisodeStore(generator.episode_vocabs, columns, lengths=np.array(lengths) if variable_length else None)
+
+
+@pytest.mark.parametrize("termination", [None, TERMINATION])
+@pytest.mark.parametrize("case_schedule", SCHEDULES)
+def test_likelihood_sums_to_one(case_schedule, termination):
+    generator = MarkovDataGenerator(small_spec(case_schedule, termination))
+    data = all_episodes(generator, 3, termination is not None)
+    total = np.exp(ExactInference(generator).log_likelihood(data)).sum()
+    assert total == pytest.approx(1.0, abs=1e-10)
+
+
+@pytest.mark.parametrize("case_schedule", SCHEDULES)
+def test_forward_backward_matches_brute_force(case_schedule):
+    generator = MarkovDataGenerator(small_spec(case_schedule))
+    inference = ExactInference(generator)
+    data = generator.remove_latent_vars(generator.generate_data(20, 4, seed=0))
+    results = inference.forward_backward(data)
+    case, advice, decision, outcome = inference.observed_columns(data)
+    num_types, num_trust = len(generator.type_vals), len(generator.trust_vals)
+
+    for episode in range(data.num_episodes):
+        # Joint probability of the observations and every (type, trust path)
+        joint = np.zeros((4, num_types, num_trust))
+        evidence = 0.0
+        for type_id in range(num_types):
+            for trust in itertools.product(range(num_trust), repeat=4):
+                prob = generator.type_probs_mat[type_id] * generator.init_trust_mat[type_id, trust[0]]
+                for t in range(4):
+                    c, a, d, o = case[episode, t], advice[episode, t], decision[episode, t], outcome[episode, t]
+                    prob *= generator.acceptance_mat[type_id, c, a, trust[t], d]
+                    if t < 3:
+                        relation = generator.relation_mat[a, d]
+                        prob *= generator.trust_transition_mat[type_id, c, trust[t], relation, o, trust[t+1]]
+                evidence += prob
+                for t in range(4):
+                    joint[t, type_id, trust[t]] += prob
+
+        observed = inference.observed_log_probs(case[episode:episode+1], advice[episode:episode+1], decision[episode:episode+1], outcome[episode:episode+1])
+        observed += inference.case_log_probs(case[episode:episode+1])
+        assert results["log_likelihood"][episode] == pytest.approx(np.log(evidence) + observed[0], abs=1e-10)
+        np.testing.assert_allclose(results["smoothed"][episode], joint / evidence, atol=1e-12)
+
+
+def test_case_log_probs_schedules():
+    case = np.array([[0, 1, 0], [1, 0, 1], [0, 0, 1]])
+    cycle = ExactInference(MarkovDataGenerator(small_spec("cycle")))
+    np.testing.assert_allclose(np.exp(cycle.case_log_probs(case)), [1.0, 0.0, 0.0])
+    random_start = ExactInference(MarkovDataGenerator(small_spec({"kind": "cycle", "random_start": True})))
+    np.testing.assert_allclose(np.exp(random_start.case_log_probs(case)), [0.5, 0.5, 0.0])
+    random = ExactInference(MarkovDataGenerator(small_spec({"kind": "random", "probs": [0.3, 0.7]})))
+    np.testing.assert_allclose(np.exp(random.case_log_probs(case)), [0.3*0.7*0.3, 0.7*0.3*0.7, 0.3*0.3*0.7])
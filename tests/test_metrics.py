@@ -0,0 +1,51 @@
+import csv
+import json
+import torch
+from metrics import CSVSink, JSONLSink, Metrics
+
+
+def read_csv(path):
+    with open(path, newline="") as csv_file:
+        return list(csv.DictReader(csv_file))
+
+
+def test_csv_sink_keeps_keys_of_later_records(tmp_path):
+    path = str(tmp_path / "metrics.csv")
+    sink = CSVSink(path)
+    records = [{"a": 1, "b": 2}, {"a": 3, "c": 4}, {"d": 5}, {"a": 6, "b": 7, "c": 8, "d": 9}]
+    for record in records:
+        sink.write(record)
+    sink.close()
+
+    rows = read_csv(path)
+    assert list(rows[0]) == ["a", "b", "c", "d"]
+    for row, record in zip(rows, records):
+        assert {name: value for name, value in row.items() if value != ""} == {
+            name: str(value) for name, value in record.items()
+        }
+
+
+def test_generation_then_training_records(tmp_path):
+    csv_path, jsonl_path = str(tmp_path / "metrics.csv"), str(tmp_path / "metrics.jsonl")
+    with Metrics([CSVSink(csv_path), JSONLSink(jsonl_path)], interval=2) as metrics:
+        with metrics.timer("vectorize"):
+            pass
+        metrics.count("episodes", 100)
+        metrics.emit()
+        for step in range(4):
+            with metrics.timer("forward"):
+                pass
+            metrics.record("q_loss", torch.tensor(float(step)))
+            metrics.count("updates")
+            metrics.step()
+
+    rows = read_csv(csv_path)
+    with open(jsonl_path) as jsonl_file:
+        records = [json.loads(line) for line in jsonl_file]
+    assert len(rows) == len(records) == 3
+    for row, record in zip(rows, records):
+        assert set(name for name, value in row.items() if value != "") == set(record)
+    assert records[0]["episodes"] == 100 and "vectorize_time" in records[0]
+    assert records[1]["updates"] == 2 and records[1]["q_loss_mean"] == 0.5
+    assert records[2]["q_loss_min"] == 2.0 and records[2]["q_loss_max"] == 3.0
+    assert float(rows[2]["forward_time"]) == records[2]["forward_time"]
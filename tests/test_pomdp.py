@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from MarkovDataGenerator import MarkovDataGenerator
+from pomdp import AdvisingPOMDP
+from conftest import SCHEDULES, small_spec
+
+SPECS = [small_spec(schedule) for schedule in SCHEDULES] + [
+    small_spec(termination={"stop_probs": [[0.2, 0.5], [0.1, 0.3]], "min_length": 2})
+]
+
+
+def expectimax(pomdp, step, context, belief):
+    # Optimal value by enumerating every action and observation, next_joints are discounted
+    q_values = pomdp.expected_rewards(np.array([context]), belief[None])[0]
+    if step+1 < pomdp.horizon:
+        joints = pomdp.next_joints(step, np.array([context]), belief[None])[0]
+        for action in range(pomdp.num_actions):
+            for decision in range(pomdp.num_decisions):
+                for outcome in range(pomdp.num_outcomes):
+                    joint = joints[action, decision, outcome]
+                    if joint.sum() <= 0:
+                        continue
+                    for next_context in np.nonzero(pomdp.context_transitions[context])[0]:
+                        q_values[action] += joint.sum() * pomdp.context_transitions[context, next_context] * expectimax(
+                            pomdp, step+1, next_context, joint / joint.sum()
+                        )
+    return q_values.max()
+
+
+def start_nodes(pomdp):
+    contexts = np.nonzero(pomdp.context_probs0)[0]
+    return contexts, np.repeat(pomdp.prior_belief()[None], len(contexts), axis=0)
+
+
+@pytest.mark.parametrize("spec", SPECS)
+def test_solve_matches_expectimax(spec):
+    pomdp = AdvisingPOMDP(MarkovDataGenerator(spec), 4, discount=0.9)
+    assert pomdp.solve()
+    contexts, beliefs = start_nodes(pomdp)
+    optimal = np.array([expectimax(pomdp, 0, context, belief) for context, belief in zip(contexts, beliefs)])
+
+    lower, upper = pomdp.bounds(0, contexts, beliefs)
+    np.testing.assert_allclose(lower, optimal, atol=1e-10)
+    assert (upper >= optimal - 1e-10).all()
+    np.testing.assert_allclose(pomdp.evaluate_policy(pomdp.policy, contexts, beliefs), optimal, atol=1e-10)
+
+
+@pytest.mark.parametrize("spec", SPECS)
+def test_point_based_solve_is_a_lower_bound(spec):
+    pomdp = AdvisingPOMDP(MarkovDataGenerator(spec), 4, discount=0.9)
+    exact = AdvisingPOMDP(MarkovDataGenerator(spec), 4, discount=0.9)
+    assert not pomdp.solve(num_points=20, max_reachable=1)
+    assert exact.solve()
+    contexts, beliefs = start_nodes(pomdp)
+    lower, _ = pomdp.bounds(0, contexts, beliefs)
+    optimal, _ = exact.bounds(0, contexts, beliefs)
+    assert (lower <= optimal + 1e-10).all()
+    assert (pomdp.evaluate_policy(pomdp.policy, contexts, beliefs) >= lower - 1e-10).all()
+
+
+def test_fixed_advice_values_match_blind_alphas(generator):
+    pomdp = AdvisingPOMDP(generator, 6)
+    blind = pomdp.blind_alphas()
+    contexts = np.nonzero(pomdp.context_probs0)[0]
+    prior = pomdp.prior_belief()
+    for action in range(pomdp.num_actions):
+        value = pomdp.evaluate_policy(lambda step, contexts, beliefs, action=action: np.full(len(contexts), action))[0]
+        expected = pomdp.context_probs0[contexts] @ (blind[0, contexts, action] * prior).sum(axis=(-2, -1))
+        assert value == pytest.approx(expected, abs=1e-10)
+
+
+def test_evaluate_policy_needs_contexts_with_beliefs(generator):
+    pomdp = AdvisingPOMDP(generator, 3)
+    contexts, beliefs = start_nodes(pomdp)
+    policy = lambda step, contexts, beliefs: np.zeros(len(contexts), dtype=np.int64)
+    with pytest.raises(ValueError):
+        pomdp.evaluate_policy(policy, beliefs=beliefs)
+    with pytest.raises(ValueError):
+        pomdp.evaluate_policy(policy, contexts=contexts)
+    with pytest.raises(ValueError):
+        pomdp.evaluate_policy(policy, contexts, beliefs[:, :1])
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+import torch
+from replay import OfflineDataset
+
+ENCODINGS = [("onehot", np.float64), ("onehot", np.float32), ("onehot", np.uint8), ("index", np.float32)]
+
+
+@pytest.mark.parametrize("variable_length", [False, True])
+@pytest.mark.parametrize("encoding,dtype", ENCODINGS)
+def test_from_data_encodings(generator, stopping_generator, encoding, dtype, variable_length):
+    g = stopping_generator if variable_length else generator
+    data = g.generate_data(64, 10, seed=0)
+    dataset = OfflineDataset.from_data(g, data, encoding=encoding, dtype=dtype, seed=0)
+    lengths = data.episode_lengths()
+    assert len(dataset) == 64
+    assert dataset.obs.dtype != torch.uint8
+
+    batch = dataset.get(torch.arange(64))
+    obs, nobs = batch[0], batch[-2] if variable_length else batch[-1]
+    # Previous decision of the first step and the observation after the last one are -1
+    assert (obs[:, 0, -1] == -1).all()
+    last_nobs = nobs[torch.arange(64), torch.as_tensor(lengths)-1]
+    assert (last_nobs == -1).all()
+    # Next observations are the observations shifted by one step
+    for episode, length in enumerate(lengths):
+        assert torch.equal(nobs[episode, :length-1], obs[episode, 1:length])
+    if variable_length:
+        assert torch.equal(batch[-1].cpu(), torch.as_tensor(lengths))
+
+
+@pytest.mark.parametrize("encoding,dtype", ENCODINGS)
+def test_onehot_features_match(generator, encoding, dtype):
+    data = generator.generate_data(32, 6, seed=1)
+    reference = OfflineDataset.from_data(generator, data, encoding="onehot", dtype=np.float64)
+    dataset = OfflineDataset.from_data(generator, data, encoding=encoding, dtype=dtype)
+    if encoding == "onehot":
+        assert torch.equal(dataset.obs.double(), reference.obs)
+        assert torch.equal(dataset.nobs.double(), reference.nobs)
+    else:
+        num_cases = len(generator.case_data_vals)
+        assert torch.equal(dataset.obs[..., 0].long(), reference.obs[..., :num_cases].argmax(-1))
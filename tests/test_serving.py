@@ -0,0 +1,101 @@
+import asyncio
+import numpy as np
+import pytest
+import torch
+from agent import OfflineAHTAgent, OfflineAHTAgentV2, obs_to_tensor
+from serving import AdvisingServer, SessionPool
+
+
+def make_agent(cls, generator, seed=0):
+    torch.manual_seed(seed)
+    return cls(
+        len(generator.case_data_vals), len(generator.ai_advice_vals), len(generator.human_answer_values),
+        16, 16, 8
+    )
+
+
+def session_observations(generator, num_sessions, num_steps, seed=0):
+    rng = np.random.default_rng(seed)
+    cases = rng.integers(len(generator.case_data_vals), size=(num_sessions, num_steps))
+    decisions = rng.integers(-1, len(generator.human_answer_values), size=(num_sessions, num_steps))
+    decisions[:, 0] = -1
+    return np.stack([cases, decisions], axis=-1)
+
+
+def expected_actions(agent, obs):
+    # Each session on its own, starting from a zero state
+    actions = []
+    for session_obs in obs:
+        lstm_hiddens = (torch.zeros(1, 1, agent.lstm_dim), torch.zeros(1, 1, agent.lstm_dim))
+        session_actions = []
+        with torch.inference_mode():
+            for step_obs in session_obs:
+                obs_tensor = obs_to_tensor(
+                    step_obs[None], agent.state_size, agent.human_action_size, agent.device, agent.dtype
+                )
+                action, lstm_hiddens = agent.act_step(obs_tensor, lstm_hiddens)
+                session_actions.append(action.item())
+        actions.append(session_actions)
+    return actions
+
+
+async def serve_sessions(server, obs, end_sessions=True):
+    async def session(session_id):
+        actions = []
+        for step_obs in obs[session_id]:
+            actions.append(await server.act(session_id, step_obs))
+        if end_sessions:
+            server.end_session(session_id)
+        return actions
+
+    return await asyncio.gather(*[session(session_id) for session_id in range(len(obs))])
+
+
+def run_server(agent, obs, end_sessions=True, **kwargs):
+    async def main():
+        async with AdvisingServer(agent, **kwargs) as server:
+            actions = await serve_sessions(server, obs, end_sessions)
+            return actions, server.stats()
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("cls", [OfflineAHTAgent, OfflineAHTAgentV2])
+def test_batched_actions_match_single_sessions(generator, cls):
+    agent = make_agent(cls, generator)
+    obs = session_observations(generator, 40, 6)
+    actions, stats = run_server(agent, obs, max_batch_size=16)
+    assert actions == expected_actions(agent, obs)
+    assert stats["requests"] == obs.shape[0] * obs.shape[1]
+    assert stats["mean_batch_size"] > 1
+
+
+def test_new_sessions_wait_for_a_free_slot(generator):
+    agent = make_agent(OfflineAHTAgentV2, generator)
+    obs = session_observations(generator, 20, 5)
+    actions, stats = run_server(agent, obs, max_sessions=4, idle_timeout=None)
+    # Live sessions are never evicted, so no session is reset in the middle of its episode
+    assert actions == expected_actions(agent, obs)
+    assert stats["evictions"] == 0
+    assert stats["slot_waits"] == 16
+
+
+def test_idle_sessions_are_evicted(generator):
+    agent = make_agent(OfflineAHTAgentV2, generator)
+    obs = session_observations(generator, 8, 3)
+    # Sessions never end, their slots are only freed once they have been idle for idle_timeout
+    actions, stats = run_server(agent, obs, end_sessions=False, max_sessions=4, idle_timeout=0.01)
+    assert actions == expected_actions(agent, obs)
+    assert stats["evictions"] >= 4
+    assert stats["slot_waits"] == 4
+
+
+def test_session_pool_never_evicts_live_sessions():
+    pool = SessionPool(2, 4)
+    assert pool.acquire("a", 0.0) != pool.acquire("b", 0.0)
+    with pytest.raises(RuntimeError):
+        pool.acquire("c", 0.0)
+    assert "a" in pool and "b" in pool
+
+    pool.release("a")
+    pool.acquire("c", 0.0)
+    assert len(pool) == 2 and pool.num_free == 0
@@ -0,0 +1,39 @@
+import os
+import numpy as np
+import pytest
+from storage import load_dataset, write_dataset
+from conftest import assert_same_episodes
+
+
+@pytest.mark.parametrize("variable_length", [False, True])
+def test_round_trip(generator, stopping_generator, tmp_path, variable_length):
+    g = stopping_generator if variable_length else generator
+    expected = g.generate_data(1000, 12, seed=3)
+    dataset = write_dataset(g, str(tmp_path / "data"), 1000, 12, seed=3, shard_size=300)
+    assert len(dataset.shards) == 4
+
+    assert_same_episodes(load_dataset(str(tmp_path / "data"))[:], expected)
+    episode_ids = np.random.default_rng(0).permutation(1000)[:200]
+    assert_same_episodes(dataset[episode_ids], expected[episode_ids])
+    assert_same_episodes(dataset[np.array([], dtype=np.int64)], expected[np.array([], dtype=np.int64)])
+
+
+def test_variable_length_shards_are_flat(stopping_generator, tmp_path):
+    expected = stopping_generator.generate_data(300, 12, seed=0)
+    dataset = write_dataset(stopping_generator, str(tmp_path / "data"), 300, 12, seed=0, shard_size=300)
+    case = np.load(os.path.join(str(tmp_path / "data"), "shard_00000", "case.npy"))
+    offsets = np.load(os.path.join(str(tmp_path / "data"), "shard_00000", "offsets.npy"))
+    assert case.shape == (expected.episode_lengths().sum(),)
+    assert (case >= 0).all()
+    assert np.array_equal(np.diff(offsets), expected.episode_lengths())
+    assert dataset.manifest["layout"] == "flat"
+
+
+@pytest.mark.parametrize("variable_length", [False, True])
+def test_indexing_matches_episode_store(generator, stopping_generator, tmp_path, variable_length):
+    g = stopping_generator if variable_length else generator
+    expected = g.generate_data(100, 6, seed=1)
+    dataset = write_dataset(g, str(tmp_path / "data"), 100, 6, seed=1, shard_size=30)
+    mask = np.arange(100) % 3 == 0
+    for index in [0, 45, -1, [-1], [99, -100, 31], slice(-20, None, 3), mask]:
+        assert_same_episodes(dataset[index], expected[index])